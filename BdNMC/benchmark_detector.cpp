@@ -0,0 +1,93 @@
+#include <iostream>
+#include <vector>
+#include <memory>
+#include <string>
+#include <chrono>
+#include <cstdlib>
+#include <cmath>
+#include "detector.h"
+#include "Particle.h"
+#include "Random.h"
+
+
+
+/*
+
+Throughput benchmark of detector::Ldet for each detector shape: samples
+trajectories from a spread of origins near the beam axis towards the
+detector region, then times the per-particle Ldet and the batch Ldet
+on them and reports particles/s for both. The batch lengths are checked
+against the per-particle ones.
+
+usage: ./benchmark_detector [number of trajectories] [batch size]
+
+*/
+
+
+
+//Relative difference above which the two Ldet versions are counted as disagreeing.
+const double TOLERANCE = 1e-6;
+
+void benchmark(const std::string &name, std::shared_ptr<detector> det, long ntraj, long batch_size){
+    typedef std::chrono::steady_clock clock;
+    std::vector<double> x(ntraj), y(ntraj), z(ntraj), px(ntraj), py(ntraj), pz(ntraj);
+    std::vector<Particle> parts(ntraj, Particle(0.01));
+    const double *center = det->Center();
+    double spread = 2*det->Bounding_Radius();
+    for(long i=0; i<ntraj; i++){
+        x[i] = Random::Gauss(0, 1);
+        y[i] = Random::Gauss(0, 1);
+        z[i] = Random::Flat(0, 50);
+        //Aims at a point near the detector, so that a fair fraction hits it.
+        px[i] = center[0]+Random::Flat(-spread, spread)-x[i];
+        py[i] = center[1]+Random::Flat(-spread, spread)-y[i];
+        pz[i] = center[2]+Random::Flat(-spread, spread)-z[i];
+        double norm = Random::Flat(0.1, 10)/sqrt(px[i]*px[i]+py[i]*py[i]+pz[i]*pz[i]);
+        px[i] *= norm; py[i] *= norm; pz[i] *= norm;
+        parts[i].ThreeMomentum(px[i], py[i], pz[i]);
+        parts[i].Set_Origin(x[i], y[i], z[i]);
+    }
+
+    std::vector<double> Lscalar(ntraj);
+    clock::time_point start = clock::now();
+    for(long i=0; i<ntraj; i++)
+        Lscalar[i] = det->Ldet(parts[i]);
+    double scalar_time = std::chrono::duration<double>(clock::now()-start).count();
+
+    std::vector<double> enter(ntraj), exit(ntraj), L(ntraj);
+    start = clock::now();
+    for(long first=0; first<ntraj; first+=batch_size){
+        trajectory_batch traj;
+        traj.n = std::min(batch_size, ntraj-first);
+        traj.x = &x[first]; traj.y = &y[first]; traj.z = &z[first];
+        traj.px = &px[first]; traj.py = &py[first]; traj.pz = &pz[first];
+        det->Ldet(traj, &enter[first], &exit[first], &L[first]);
+    }
+    double batch_time = std::chrono::duration<double>(clock::now()-start).count();
+
+    long hits = 0, mismatches = 0;
+    for(long i=0; i<ntraj; i++){
+        if(Lscalar[i]>0)
+            hits++;
+        if(std::fabs(L[i]-Lscalar[i])>TOLERANCE*std::max(1.0, std::fabs(Lscalar[i])))
+            mismatches++;
+    }
+    std::cout << name << ": " << hits << " of " << ntraj << " trajectories hit, "
+              << mismatches << " batch/per-particle mismatches" << std::endl;
+    std::cout << "  per-particle Ldet: " << ntraj/scalar_time << " particles/s" << std::endl;
+    std::cout << "  batch Ldet:        " << ntraj/batch_time << " particles/s (" << scalar_time/batch_time << "x)" << std::endl;
+}
+
+int main(int argc, char *argv[]){
+    long ntraj = argc>1 ? atol(argv[1]) : 1000000;
+    long batch_size = argc>2 ? atol(argv[2]) : 1024;
+    if(ntraj<=0 || batch_size<=0){
+        std::cerr << "usage: " << argv[0] << " [number of trajectories] [batch size]" << std::endl;
+        return 1;
+    }
+    Random(1);
+    benchmark("sphere", std::make_shared<detector_sphere>(1, 2, 100, 5), ntraj, batch_size);
+    benchmark("cylinder", std::make_shared<detector_cylinder>(1, 2, 100, 10, 3, 0.3, 0.2), ntraj, batch_size);
+    benchmark("cuboid", std::make_shared<detector_cuboid>(1, 2, 100, 4, 3, 10, 0.1, 0.4, 0.2), ntraj, batch_size);
+    return 0;
+}
@@ -0,0 +1,75 @@
+#include <iostream>
+#include <fstream>
+#include <string>
+#include <chrono>
+#include <cstdlib>
+#include "Particle_List.h"
+#include "Particle.h"
+
+
+
+/*
+
+Memory and throughput benchmark of Particle_List: loads a particle list
+(text or binary, see flux_to_binary.py) as main does with
+particle_list_position and particle_list_weight on, and reports the load
+time, the resident memory used per particle and the sampling rate. A
+positive batch size streams the list as particle_list_batch_size does.
+
+usage: ./benchmark_particle_list <particle list> [number of samples] [batch size]
+
+*/
+
+
+
+//Resident set size of this process in kB, from /proc/self/status.
+long resident_kB(){
+    std::ifstream status("/proc/self/status");
+    std::string key;
+    long value;
+    while(status >> key){
+        if(key=="VmRSS:"){
+            status >> value;
+            return value;
+        }
+        status.ignore(256, '\n');
+    }
+    return -1;
+}
+
+int main(int argc, char *argv[]){
+    if(argc<2){
+        std::cerr << "usage: " << argv[0] << " <particle list> [number of samples] [batch size]" << std::endl;
+        return 1;
+    }
+    std::string infile = argv[1];
+    long nsamples = argc>2 ? atol(argv[2]) : 10000000;
+    long batch_size = argc>3 ? atol(argv[3]) : 0;
+    typedef std::chrono::steady_clock clock;
+
+    long rss_before = resident_kB();
+    clock::time_point start = clock::now();
+    Particle_List plist(infile, true, true, batch_size);
+    double load_time = std::chrono::duration<double>(clock::now()-start).count();
+    long rss_after = resident_kB();
+
+    long count = Particle_List::Binary_Record_Count(infile);
+    std::cout << "Particle list: " << infile << (count>=0 ? " (binary)" : " (text)") << std::endl;
+    std::cout << "Load time: " << load_time << " s" << std::endl;
+    std::cout << "Resident memory: " << rss_before << " kB before load, " << rss_after << " kB after" << std::endl;
+
+    //Touches every field of the sampled particles so the loop cannot be optimized away.
+    Particle part(0);
+    double checksum = 0;
+    start = clock::now();
+    for(long i=0; i<nsamples; i++){
+        plist.sample_particle(part);
+        checksum += part.px+part.origin_coords[2]+part.w;
+    }
+    double sample_time = std::chrono::duration<double>(clock::now()-start).count();
+
+    std::cout << "Sampled " << nsamples << " particles in " << sample_time << " s: "
+              << nsamples/sample_time << " particles/s, " << 1e9*sample_time/nsamples << " ns/particle" << std::endl;
+    std::cout << "Resident memory after sampling: " << resident_kB() << " kB (checksum " << checksum << ")" << std::endl;
+    return 0;
+}
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+##################################################
+# Converts a text particle list (particle_list_file, e.g. the NuMI
+# pi0s.dat and etas.dat) into the binary format that Particle_List
+# memory maps: the magic "BDNMCFLX", the number of records as a
+# little-endian uint64, then one record per particle of
+# px py pz E x y z t w (doubles) and origin_id (int64).
+#
+# Fields are taken from each line as Particle_List::parse_line does:
+# px py pz E first, x y z if there are at least 7 fields, t if there
+# are at least 8, w from the second to last and origin_id from the last
+# field. Particle_List still applies particle_list_position and
+# particle_list_weight when reading, so one binary file serves all
+# parameter files. The format is recognized by its magic, so the binary
+# file can be given as particle_list_file directly.
+##################################################
+import optparse, struct, sys
+
+
+MAGIC  = b"BDNMCFLX"
+RECORD = struct.Struct("<9dq")
+HEADER = struct.Struct("<8sQ")
+
+
+def parse_line(line):
+    fields = line.split()
+    px, py, pz, E = [float(f) for f in fields[0:4]]
+    x = y = z = t = 0.
+    if len(fields) >= 7:
+        x, y, z = [float(f) for f in fields[4:7]]
+        if len(fields) >= 8:
+            t = float(fields[7])
+    w = float(fields[-2])
+    origin_id = int(fields[-1])
+    return RECORD.pack(px, py, pz, E, x, y, z, t, w, origin_id)
+
+
+def convert(infile, outfile):
+    count = 0
+    skipped = 0
+    with open(infile) as fin, open(outfile, "wb") as fout:
+        # the record count is filled in once the whole file is read
+        fout.write(HEADER.pack(MAGIC, 0))
+        for line in fin:
+            line = line.strip()
+            if len(line) == 0 or line[0] == '#':
+                continue
+            try:
+                fout.write(parse_line(line))
+            except (ValueError, IndexError):
+                print("Line is improperly formatted: " + line)
+                skipped += 1
+                continue
+            count += 1
+        fout.seek(0)
+        fout.write(HEADER.pack(MAGIC, count))
+    return count, skipped
+
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options] input.dat")
+    parser.add_option('-o', '--output', default = "", help='Output file. Default = input with .bin instead of .dat.')
+
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("need exactly one input particle list")
+
+    infile = args[0]
+    outfile = options.output
+    if outfile == "":
+        outfile = (infile[:-4] if infile.endswith(".dat") else infile) + ".bin"
+
+    count, skipped = convert(infile, outfile)
+    print("Wrote {} particles to {} ({} lines skipped)".format(count, outfile, skipped))
+    return 0 if count > 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
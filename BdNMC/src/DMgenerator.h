@@ -20,8 +20,20 @@ class DMGenerator{
         bool query_off_shell(){return OFF_SHELL;}
         void set_ntrials(int n_trials){ntrials = n_trials;}
         int NTrials(){return ntrials;}
+        //Emits the mediator of meson decays preferentially towards the sphere of given
+        //radius around center (the detector) with probability fraction, see
+        //Sample_Emission_Direction. The importance weight is carried in Particle::w.
+        void Set_Emission_Bias(const double center[3], double radius, double fraction){for(int i=0; i<3; i++) bias_center[i]=center[i]; bias_radius=radius; bias_fraction=fraction;}
+        //Copy of the generator for a worker thread of the simulation loop, so that
+        //adaptive state like pmax is not shared. Null if the generator does not support it.
+        virtual std::shared_ptr<DMGenerator> Clone(){return nullptr;}
         virtual ~DMGenerator(){};
     protected:
+        //meson -> gamma mediator, mediator -> dm1 dm2, off shell with V* angle theta if off_shell.
+        void Decay_To_DM(Particle &dm1, Particle &dm2, Particle &mediator, Particle &meson, bool off_shell, double theta = 0);
+        double bias_center[3];
+        double bias_radius;
+        double bias_fraction = 0;
         virtual void Evaluate_Branching_Ratio() {};
         double mv, mx, kappa, alphaD;
         bool OFF_SHELL = false;
@@ -35,6 +47,7 @@ class pion_decay_gen: public DMGenerator{
     public:
         pion_decay_gen(double MV, double MX, double kap, double alp, std::string type);
         ~pion_decay_gen(){};
+        std::shared_ptr<DMGenerator> Clone(){return std::make_shared<pion_decay_gen>(*this);}
         bool GenDM(std::list<Particle>& vec, std::function<double(Particle&)> det_int, Particle& part);
         void sample_dist(double& s, double& theta);
         void burn_in(int runs);
@@ -46,6 +59,7 @@ class eta_decay_gen: public DMGenerator{
     public:
         eta_decay_gen(double MV, double MX, double kap, double alp, std::string type);
         ~eta_decay_gen(){};
+        std::shared_ptr<DMGenerator> Clone(){return std::make_shared<eta_decay_gen>(*this);}
         bool GenDM(std::list<Particle>& vec, std::function<double(Particle&)> det_int, Particle& part);
         void sample_dist(double& s, double& theta);
         void burn_in(int runs);
@@ -56,6 +70,7 @@ class eta_decay_gen: public DMGenerator{
 class pion_decay_gen_baryonic: public DMGenerator{
     public:
         pion_decay_gen_baryonic(double MV, double MX, double kap, double alp);
+        std::shared_ptr<DMGenerator> Clone(){return std::make_shared<pion_decay_gen_baryonic>(*this);}
         bool GenDM(std::list<Particle>& vec, std::function<double(Particle&)> det_int, Particle& part);
         void sample_dist(double& s, double& theta);
         void burn_in(int runs);
@@ -66,6 +81,7 @@ class pion_decay_gen_baryonic: public DMGenerator{
 class eta_decay_gen_baryonic: public DMGenerator{
     public:
         eta_decay_gen_baryonic(double MV, double MX, double kap, double alp);
+        std::shared_ptr<DMGenerator> Clone(){return std::make_shared<eta_decay_gen_baryonic>(*this);}
         bool GenDM(std::list<Particle>& vec, std::function<double(Particle&)> det_int, Particle& part);
         void sample_dist(double& s, double& theta);
         void burn_in(int runs);
@@ -18,10 +18,22 @@ class Distribution {
 				(*i)->sample_particle(part);
 			}
 		}
+		//As above for the draw-th particle of a run. Distributions that are read in
+		//order, as Particle_List, return the same particle for the same draw on any
+		//thread; the others ignore draw.
+		void Sample_Particle(Particle &part, long draw)
+		{
+			part.Set_Mass(part_mass);
+			sample_particle(part, draw);
+			for(std::list<std::shared_ptr<Distribution> >::iterator i = dist_list.begin(); i!=dist_list.end(); i++){
+				(*i)->sample_particle(part);
+			}
+		}
 		void set_mass(double m){part_mass=m;}
 		void Add_Dist(std::shared_ptr<Distribution> distptr){dist_list.push_back(distptr);}//This should be unique, need to figure out proper syntax.
 	protected:
 		virtual void sample_particle(Particle &part) = 0;
+		virtual void sample_particle(Particle &part, long draw){sample_particle(part);}
 		std::list<std::shared_ptr<Distribution> > dist_list;
 	private:
 		double part_mass;
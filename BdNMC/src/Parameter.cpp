@@ -155,6 +155,11 @@ production_channel::production_channel(){
    	ZMAX=-1;
 	particle_list_position=false;
 	particle_list_weight=false;
+	particle_list_batch=0;
+	particle_list_shard=-1;
+	particle_list_shards=1;
+	particle_list_alias=false;
+	particle_list_acceptance=false;
 	dist_mods = std::unique_ptr<list<production_distribution> > (new list<production_distribution>);
 }
 
@@ -215,6 +220,20 @@ production_channel parse_production_channel(std::ifstream &instream, string &hol
 				if(lowercase(val)=="true")
 					tmpprod.particle_list_weight=true;
 			}
+			else if(key==part_list_batch_key)
+				tmpprod.particle_list_batch=stol(val);
+			else if(key==part_list_shard_key)
+				tmpprod.particle_list_shard=stol(val);
+			else if(key==part_list_shards_key)
+				tmpprod.particle_list_shards=stol(val);
+			else if(key==part_list_alias_key){
+				if(lowercase(val)=="true")
+					tmpprod.particle_list_alias=true;
+			}
+			else if(key==part_list_acceptance_key){
+				if(lowercase(val)=="true")
+					tmpprod.particle_list_acceptance=true;
+			}
 			else if(key == sanford_wang_key || key == distribution_parameter_key){
 				parse_parameter_file(val, tmpprod.dist_param_map);
 			}
@@ -398,6 +417,7 @@ Parameter::Parameter(std::ifstream &instream){
 		Set_Double(angle_upper_limit_key, angle_upper_limit, keymap, 2.1*pi);
 		Set_Double(timing_key, timing_cut, keymap, 0);
         Set_String(scatter_dist_filename_key, scatter_dist_filename, keymap, "");
+        Set_String(pmax_cache_key, pmax_cache, keymap, "");
 
 		Set_Target_Parameters(keymap);
 
@@ -410,8 +430,14 @@ Parameter::Parameter(std::ifstream &instream){
 		Set_Integer(seed_key, seed, keymap, -1);
 		
 		Set_Integer(max_trials_key,max_trials,keymap,-1);
+		Set_Integer(threads_key,threads,keymap,0);
 
 		Set_Double(efficiency_key, efficiency, keymap, 1.0);
+		Set_Double(emission_bias_key, emission_bias, keymap, 0);
+		if(emission_bias<0||emission_bias>=1){
+			cerr << "emission_bias must be in [0,1), disabling it.\n";
+			emission_bias = 0;
+		}
 		Set_Double(meson_per_pi0_key, meson_per_pi0, keymap, -1.0);
 		//output file
         if(keymap.count(outkey)==1){
@@ -502,6 +528,12 @@ void Parameter::Build_Detector(map<string, string> &keymap){
                 cerr << "Invalid detector shape declared: " << keymap[detkey] << endl;
                 integrity = -1;
             }
+            if(det){
+                vector<string> &arr = (keymap[detkey]=="sphere") ? spherearr : ((keymap[detkey]=="cylinder") ? cylinderarr : cuboidarr);
+                det_geometry = keymap[detkey];
+                for(vector<string>::iterator it = arr.begin(); it!=arr.end(); ++it)
+                    det_geometry += " " + keymap[*it];
+            }
              
         }
         else{
@@ -30,11 +30,20 @@ class production_channel{
 		double meson_per_pi0, PTMAX, PTMIN, ZMIN, ZMAX;
 		bool particle_list_position;
 		bool particle_list_weight;
+		long particle_list_batch;
+		long particle_list_shard, particle_list_shards;
+		bool particle_list_alias;
+		bool particle_list_acceptance;
 		production_channel();
 		bool query_dist_param(){return (dist_param_map.size()!=0);}
 		bool query_dist_param(const std::string &, double&);
 		bool par_list_pos(){return particle_list_position;} 
 		bool par_list_weight(){return particle_list_weight;} 
+		long par_list_batch(){return particle_list_batch;}
+		long par_list_shard(){return particle_list_shard;}
+		long par_list_shards(){return particle_list_shards;}
+		bool par_list_alias(){return particle_list_alias;}
+		bool par_list_acceptance(){return particle_list_acceptance;}
 		double Meson_Per_Pi0(){return meson_per_pi0;}
         double ptmin(){return PTMIN;}
 		double ptmax(){return PTMAX;}
@@ -77,6 +86,9 @@ class Parameter{
 		double Min_Angle(){return angle_lower_limit;}
 		double Timing_Cut(){return timing_cut;}
 		std::string Scatter_Dist_Filename(){return scatter_dist_filename;}
+		std::string PMax_Cache(){return pmax_cache;}
+		//Detector shape followed by its parameters as given in the parameter file.
+		std::string Detector_Geometry(){return det_geometry;}
 
 		double Target_E_Num(){return target_e_num;}
 		double Target_N_Num(){return target_n_num;}
@@ -88,10 +100,12 @@ class Parameter{
 		double P_Cross(){return p_cross;}
 
 		double Efficiency(){return efficiency;}
+		double Emission_Bias(){return emission_bias;}
 		int Sample_Size(){return samplesize;}
 		int Burn_In(){return burn_in;}
 		int Burn_Timeout(){return burn_timeout;}
 		int Max_Trials(){return max_trials;}
+		int Threads(){return threads;}
 		int Repeat(){return repeat;}
         int Seed(){return seed;}
 		double Protons_on_Target(){return POT;}
@@ -123,12 +137,14 @@ class Parameter{
 		double angle_upper_limit;
 		double angle_lower_limit;
 		double edmres;
+		double emission_bias;
 		int burn_in;
 		int burn_timeout;
 		int repeat;
 		int seed;
 		int sample_gen;
 		int max_trials;
+		int threads;
 		double meson_per_pi0;
         std::string output_file;
         std::string summary_file;
@@ -142,6 +158,8 @@ class Parameter{
 		double max_dm_energy;
 		double timing_cut;
 		std::string scatter_dist_filename="";
+		std::string pmax_cache="";
+		std::string det_geometry="";
 
 		double target_length;
 		double target_n_density;
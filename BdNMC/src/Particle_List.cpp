@@ -2,9 +2,16 @@
 #include "Distribution.h"
 #include "Particle_List.h"
 #include "Kinematics.h"
+#include "Random.h"
 #include <vector>
 #include <exception>
 #include <cmath>
+#include <algorithm>
+#include <cstring>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
 
 using std::string;		using std::cerr;
 using std::vector;
@@ -12,13 +19,56 @@ using std::cout;
 using std::endl;
 using std::stod;
 
-Particle_List::Particle_List(const string& infile, bool set_pos, bool use_weight){
+static const char flux_magic[8] = {'B','D','N','M','C','F','L','X'};
+static const std::size_t flux_header_len = 16;
+
+Particle_List::Particle_List(const string& infile, bool set_pos, bool use_weight, long batch, long shard, long shards, bool alias){
 	POS = set_pos;
     WEIGHT=use_weight;
+	ALIAS = alias && use_weight && set_pos;
+	if(alias && !ALIAS)
+		cerr << "Alias sampling of " << infile << " requires particle_list_weight and particle_list_position, reading it in order\n";
+	alias_weight = 1.;
+	acceptance = 1.;
+	draws = 0;
+	batch_size = batch;
 	part_count = 0;
-	instream.open(infile, std::ifstream::in);
+	records = NULL;
+	nrecords = 0;
+	record_index = 0;
+	map_addr = NULL;
+	map_len = 0;
+	binary = false;
+	data_start = 0;
+	shard_len = -1;
+	file_particles = -1;
+	if(shards<1)
+		shards = 1;
+	shard = ((shard%shards)+shards)%shards;
+	if(shards>1)
+		cout << "Reading shard " << shard << " of " << shards << " of " << infile << endl;
+	if(batch_size<=0 && open_binary(infile, shard, shards)){
+		if(ALIAS)
+			build_alias_table(records, nrecords, alias_table, alias_weight);
+		batch_draws = nrecords;
+		return;
+	}
+	long count = Binary_Record_Count(infile);
+	binary = count>=0;
+	if(binary){
+		data_start = flux_header_len+(count*shard/shards)*sizeof(_flux_record);
+		shard_len = count*(shard+1)/shards-count*shard/shards;
+		instream.open(infile, std::ifstream::in | std::ifstream::binary);
+		instream.seekg(data_start);
+	}
+	else{
+		instream.open(infile, std::ifstream::in);
+		if(instream.is_open() && shards>1)
+			open_text_shard(shard, shards);
+	}
+	shard_left = shard_len;
 	if(instream.is_open()){
-		if(load_particle_batch()==0){
+		if(load_particle_batch(partlist)==0){
 			std::cerr << "File empty: " << infile << endl;
 			throw -1;	
 		}
@@ -27,43 +77,270 @@ Particle_List::Particle_List(const string& infile, bool set_pos, bool use_weight
 		std::cerr << "Could not open " << infile << endl;
 		throw -1;
 	}
-	iter=partlist.begin();
+	if(batch_size>0 && (file_particles<0 || file_particles>batch_size)){
+		cout << "Streaming " << infile << " in batches of " << batch_size << " particles\n";
+		records = partlist.data();
+		nrecords = partlist.size();
+		batch_draws = nrecords;
+		if(ALIAS)
+			build_alias_table(records, nrecords, alias_table, alias_weight);
+		//The loader thread is started by the first sample_particle call.
+		return;
+	}
+	//The whole file is in memory, the stream is no longer needed.
+	if(file_particles>=0)
+		partlist.resize(file_particles);
+	partlist.shrink_to_fit();
+	instream.close();
+	records = partlist.data();
+	nrecords = partlist.size();
+	batch_draws = nrecords;
+	batch_size = 0;
+	if(ALIAS)
+		build_alias_table(records, nrecords, alias_table, alias_weight);
+}
+Particle_List::~Particle_List(){
+	if(loader.joinable())
+		loader.join();
+	if(map_addr!=NULL)
+		munmap(map_addr, map_len);
+	instream.close();
+}
+
+//Counts the particle lines of a text list and positions instream at the first
+//line of the shard.
+void Particle_List::open_text_shard(long shard, long shards){
+	string hold;
+	long count = 0;
+	while(std::getline(instream, hold))
+		if(hold.length()!=0 && hold[0]!='#')
+			count++;
+	long first = count*shard/shards;
+	shard_len = count*(shard+1)/shards-first;
+	instream.clear();
+	instream.seekg(0);
+	for(long i=0; i<first && std::getline(instream, hold);)
+		if(hold.length()!=0 && hold[0]!='#')
+			i++;
+	data_start = instream.tellg();
+}
+
+long Particle_List::Binary_Record_Count(const string& infile){
+	std::ifstream in(infile, std::ifstream::binary);
+	char magic[8];
+	uint64_t count;
+	if(!in.read(magic, 8) || memcmp(magic, flux_magic, 8)!=0 || !in.read((char *) &count, 8))
+		return -1;
+	return count;
+}
+
+//Maps a binary particle list into memory. Returns false if infile is not one.
+bool Particle_List::open_binary(const string& infile, long shard, long shards){
+	long count = Binary_Record_Count(infile);
+	if(count<0)
+		return false;
+	int fd = open(infile.c_str(), O_RDONLY);
+	struct stat st;
+	if(fd<0 || fstat(fd, &st)!=0){
+		std::cerr << "Could not open " << infile << endl;
+		throw -1;
+	}
+	if(count==0 || (std::size_t) st.st_size < flux_header_len+count*sizeof(_flux_record)){
+		std::cerr << "Binary particle list is empty or truncated: " << infile << endl;
+		close(fd);
+		throw -1;
+	}
+	map_len = st.st_size;
+	map_addr = mmap(NULL, map_len, PROT_READ, MAP_PRIVATE, fd, 0);
+	close(fd);
+	if(map_addr==MAP_FAILED){
+		map_addr = NULL;
+		std::cerr << "Could not map " << infile << endl;
+		throw -1;
+	}
+	madvise(map_addr, map_len, MADV_SEQUENTIAL);
+	records = (const _flux_record *) ((const char *) map_addr + flux_header_len) + count*shard/shards;
+	nrecords = count*(shard+1)/shards-count*shard/shards;
+	if(nrecords==0){
+		std::cerr << "Shard " << shard << " of " << infile << " is empty" << endl;
+		throw -1;
+	}
+	return true;
 }
-//Loads particles into the list until the entire file is read, or the list is of length batch_size.
-//If batch_size is negative, the entire file is read.
-//Note that batch_size is not yet implemented for some reason.
-int Particle_List::load_particle_batch(){
+
+//Loads particles into batch until the entire shard is read, or batch holds batch_size particles.
+//If batch_size is not positive, the entire shard is read. When streaming, reading wraps
+//around to the start of the shard at its end, so every batch is full.
+int Particle_List::load_particle_batch(vector<_flux_record> &batch){
 	int i=0;
 	int error_state;
-	/*if(instream.eof()){
-		cout << "Reload\n"; 
-		instream.seekg(0);
-	}*/
+	batch.clear();
+	if(batch_size>0)
+		batch.reserve(batch_size);
 	string hold;
-	while(std::getline(instream, hold)){
-		if((error_state=parse_line(hold))==0){
-			i++;
-			continue;
+	while(batch_size<=0 || i<batch_size){
+		if(shard_left==0);
+		else if(binary){
+			batch.resize(i+1);
+			if(instream.read((char *) &batch[i], sizeof(_flux_record))){
+				i++;
+				part_count++;
+				shard_left--;
+				continue;
+			}
+			batch.resize(i);
 		}
-		else if(error_state==1){
+		else if(std::getline(instream, hold)){
+			if((error_state=parse_line(hold, batch))!=1)
+				shard_left--;
+			if(error_state==0){
+				i++;
+				part_count++;
+				continue;
+			}
+			else if(error_state==1 || file_particles>=0){
+				continue;
+			}
+			else if(error_state==-1){
+				if(!POS)
+					cerr << "Format required is p_x p_y p_z" << endl;
+				else
+					cerr << "Format required is p_x p_y p_z x y z t" << endl;
+				cerr << "Line is improperly formatted: " << hold << endl;
+			}
+			else{
+				cerr << "Unknown error code: " << error_state << "\n";
+				cerr << "Line is improperly formatted: " << hold << "\n";
+			}
 			continue;
 		}
-		else if(error_state==-1){
-			if(!POS)
-				cerr << "Format required is p_x p_y p_z" << endl;
-			else
-				cerr << "Format required is p_x p_y p_z x y z t" << endl;
-			cerr << "Line is improperly formatted: " << hold << endl;
-		}
-		else{
-			cerr << "Unknown error code: " << error_state << "\n";
-			cerr << "Line is improperly formatted: " << hold << "\n";
-		}
+		//End of the shard.
+		if(file_particles<0)
+			file_particles = part_count;
+		if(batch_size<=0 || file_particles==0)
+			break;
+		instream.clear();
+		instream.seekg(data_start);
+		shard_left = shard_len;
 	}
 	return i;
 }
 
-int Particle_List::parse_line(string& line){
+void Particle_List::Set_Acceptance(std::function<bool(const _flux_record&)> accept_func){
+	accept = accept_func;
+	std::size_t read;
+	if(map_addr!=NULL){
+		//Only the accepted records are copied out of the mapped file.
+		read = nrecords;
+		partlist.clear();
+		for(std::size_t i=0; i<nrecords; i++)
+			if(accept(records[i]))
+				partlist.push_back(records[i]);
+		munmap(map_addr, map_len);
+		map_addr = NULL;
+	}
+	else
+		read = select_batch(partlist);
+	if(partlist.empty()){
+		std::cerr << "No particle of the particle list passes the acceptance prefilter" << endl;
+		throw -1;
+	}
+	if(batch_size<=0)
+		partlist.shrink_to_fit();
+	acceptance = (double) partlist.size()/read;
+	batch_draws = read;
+	records = partlist.data();
+	nrecords = partlist.size();
+	record_index = 0;
+	if(ALIAS)
+		build_alias_table(records, nrecords, alias_table, alias_weight);
+	cout << "Acceptance prefilter kept " << nrecords << " of " << read << " particles\n";
+}
+
+//Drops the particles of batch rejected by accept and returns the number read. When
+//streaming, a batch left empty is replaced by the following ones until one is not.
+std::size_t Particle_List::select_batch(vector<_flux_record> &batch){
+	std::size_t read = batch.size();
+	if(!accept)
+		return read;
+	auto rejected = [this](const _flux_record &rec){return !accept(rec);};
+	batch.erase(std::remove_if(batch.begin(), batch.end(), rejected), batch.end());
+	//More than a full pass without an accepted particle means there is none.
+	while(batch.empty() && batch_size>0 && (file_particles<0 || read<=(std::size_t) (file_particles+batch_size))){
+		read += load_particle_batch(batch);
+		batch.erase(std::remove_if(batch.begin(), batch.end(), rejected), batch.end());
+	}
+	return read;
+}
+
+//Runs on the loader thread: reads the next batch, applies the acceptance prefilter
+//and builds the alias table.
+void Particle_List::load_next_batch(){
+	load_particle_batch(next_batch);
+	next_batch_draws = select_batch(next_batch);
+	next_acceptance = next_batch.empty() ? 0 : (double) next_batch.size()/next_batch_draws;
+	if(ALIAS)
+		build_alias_table(next_batch.data(), next_batch.size(), next_alias_table, next_alias_weight);
+}
+
+//Swaps in the batch read by the loader thread and starts reading the next one.
+void Particle_List::next_particle_batch(){
+	loader.join();
+	if(next_batch.empty()){
+		std::cerr << "No particle of the particle list passes the acceptance prefilter" << endl;
+		throw -1;
+	}
+	partlist.swap(next_batch);
+	alias_table.swap(next_alias_table);
+	alias_weight = next_alias_weight;
+	acceptance = next_acceptance;
+	batch_draws = next_batch_draws;
+	draws = 0;
+	records = partlist.data();
+	nrecords = partlist.size();
+	record_index = 0;
+	loader = std::thread(&Particle_List::load_next_batch, this);
+}
+
+//Builds the Walker alias table of the |w| of n records (Vose's method) and sets
+//mean_w to their mean, the weight carried by every particle drawn from it.
+void Particle_List::build_alias_table(const _flux_record *rec, std::size_t n, vector<_alias_entry> &table, double &mean_w){
+	table.resize(n);
+	double sum = 0;
+	for(std::size_t i=0; i<n; i++)
+		sum += std::abs(rec[i].w);
+	mean_w = sum/n;
+	if(sum<=0){
+		for(std::size_t i=0; i<n; i++)
+			table[i] = _alias_entry{1., i};
+		return;
+	}
+	vector<std::size_t> small, large;
+	for(std::size_t i=0; i<n; i++){
+		table[i] = _alias_entry{std::abs(rec[i].w)/mean_w, i};
+		if(table[i].prob<1.)
+			small.push_back(i);
+		else
+			large.push_back(i);
+	}
+	while(!small.empty() && !large.empty()){
+		std::size_t s = small.back(), l = large.back();
+		small.pop_back();
+		table[s].alias = l;
+		table[l].prob -= 1.-table[s].prob;
+		if(table[l].prob<1.){
+			large.pop_back();
+			small.push_back(l);
+		}
+	}
+	//Whatever is left is 1 up to rounding.
+	for(std::size_t i : small)
+		table[i].prob = 1.;
+	for(std::size_t i : large)
+		table[i].prob = 1.;
+}
+
+int Particle_List::parse_line(string& line, vector<_flux_record> &batch){
 	if(line.length()==0||line[0]=='#')
 		return 1;//Line can be skipped.
 	std::size_t space_pos=0;
@@ -92,16 +369,9 @@ int Particle_List::parse_line(string& line){
 			}
 		}
                 int id = stol(sublist[sublist.size()-1]);
-                if(WEIGHT) {
+                if(WEIGHT)
                   w = stod(sublist[sublist.size()-2]);
-                  partlist.push_back(_part(px,py,pz,E,x,y,z,t));
-                  partlist.back().w = w;
-                  partlist.back().origin_id = id;
-                }
-                else {
-                  partlist.push_back(_part(px,py,pz,E,x,y,z,t));
-                  partlist.back().origin_id = id;
-                }
+                batch.push_back(_flux_record{px,py,pz,E,x,y,z,t,w,id});
 	}
 	catch(std::exception e){
 		return -1;
@@ -110,18 +380,47 @@ int Particle_List::parse_line(string& line){
 }
 
 void Particle_List::sample_particle(Particle &part){
-	if(iter==partlist.end()){
-		iter = partlist.begin();
+	if(batch_size>0){
+		if(!loader.joinable())
+			loader = std::thread(&Particle_List::load_next_batch, this);
+		if(draws==batch_draws)
+			next_particle_batch();
+		draws++;
 	}
-	part.ThreeMomentum(iter->px,iter->py,iter->pz);
-	if(POS){
-		part.Set_Origin(iter->x,iter->y,iter->z);
-		part.Set_Creation_Time(iter->t);
- 		//part.Set_Position(iter->x,iter->y,iter->z);
-		part.Set_Time(iter->t);
-                part.w = iter->w;
-                part.origin_id = iter->origin_id;
-	}
-	iter++;
+	if(record_index==nrecords)
+		record_index = 0;
+	set_particle(part, record_index++);
 }
 
+void Particle_List::sample_particle(Particle &part, long draw){
+	if(batch_size>0){
+		std::cerr << "Particle_List: indexed draws are not available when streaming\n";
+		throw -1;
+	}
+	set_particle(part, draw%nrecords);
+}
+
+//Fills part from record index, or from an alias draw of it.
+void Particle_List::set_particle(Particle &part, std::size_t index){
+	if(ALIAS){
+		double u = Random::Flat(0,1)*nrecords;
+		index = std::min((std::size_t) u, nrecords-1);
+		if(u-index>=alias_table[index].prob)
+			index = alias_table[index].alias;
+	}
+	const _flux_record &rec = records[index];
+	part.ThreeMomentum(rec.px,rec.py,rec.pz);
+	if(POS){
+		part.Set_Origin(rec.x,rec.y,rec.z);
+		part.Set_Creation_Time(rec.t);
+		part.Set_Time(rec.t);
+		part.origin_id = rec.origin_id;
+		if(ALIAS)
+			part.w = acceptance*std::copysign(alias_weight, rec.w);
+		else
+			part.w = acceptance*(WEIGHT ? rec.w : 1.);
+	}
+	else
+		//the file weights only apply with positions, as they always have
+		part.w = acceptance;
+}
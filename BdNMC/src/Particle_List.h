@@ -4,34 +4,98 @@
 #include <string>
 #include <iostream>
 #include <fstream>
-#include <list>
+#include <vector>
 #include <memory>
+#include <thread>
+#include <functional>
+#include <cstdint>
 #include "Distribution.h"
 
-struct _part{
+//One particle of the list. Text lists are parsed into a contiguous array of
+//these; binary lists written by flux_to_binary.py (the 8 byte magic
+//"BDNMCFLX", the number of records as a uint64, then the records) are
+//memory mapped and used in place.
+struct _flux_record{
 	double px,py,pz,E,x,y,z,t,w;
-        long origin_id;
-	_part(double Px, double Py, double Pz, double e, double X, double Y, double Z, double T){px=Px; py=Py; pz=Pz; E=e;x=X;y=Y;z=Z;t=T;w=1.;origin_id=-1;}
+	int64_t origin_id;
+};
+
+static_assert(sizeof(_flux_record)==80, "binary particle list records are 80 bytes");
+
+//One bin of a Walker alias table: bin i is kept with probability prob,
+//otherwise alias is drawn instead.
+struct _alias_entry{
+	double prob;
+	std::size_t alias;
 };
 
 class Particle_List: public Distribution{
 
 public:
-	Particle_List(const std::string&, bool set_pos = false, bool use_weight = false);
-	~Particle_List(){instream.close();}
+	//If batch_size is positive, the list is streamed: only batch_size particles
+	//are held in memory while the next batch is read on a background thread,
+	//wrapping around to the start of the file at its end.
+	//If shards is greater than one, the file is split into that many contiguous
+	//slices and only slice shard is read, so that grid jobs sample disjoint mesons.
+	//If alias is set (it requires use_weight and set_pos), particles are drawn in proportion
+	//to |w| from a Walker alias table and carry the mean |w| with the sign of w,
+	//instead of being read in order with their own weight.
+	Particle_List(const std::string&, bool set_pos = false, bool use_weight = false, long batch_size = 0, long shard = 0, long shards = 1, bool alias = false);
+	~Particle_List();
+	//Returns the number of records of a binary particle list, -1 if the file is not one.
+	static long Binary_Record_Count(const std::string&);
+	//Drops the particles for which accept is false before sampling, e.g. those that
+	//cannot reach the detector. The weights of the remaining ones are multiplied by
+	//the accepted fraction (per batch when streaming), so weighted sums per trial are
+	//unchanged. Must be called before the first particle is sampled.
+	void Set_Acceptance(std::function<bool(const _flux_record&)> accept);
 	//Get_Particle returns the momentum and direction of a particle from a list.
 	void sample_particle(Particle &part);
+	//Reads record draw modulo the list size without moving the cursor of
+	//sample_particle, so it may be called from several threads. Not available
+	//when streaming.
+	void sample_particle(Particle &part, long draw);
+	bool Streaming(){return batch_size>0;}
 	void Get_Particle(double& pmom, double& theta, double& phi);
 private:
 	//determines how many particles should be read in from file at once.
 	std::ifstream instream;
-	//int batch_size;
-	std::list<_part> partlist;
-	std::list<_part>::iterator iter;
-	int parse_line(std::string &line);
-	int load_particle_batch();
+	long batch_size;
+	std::vector<_flux_record> partlist;
+	int parse_line(std::string &line, std::vector<_flux_record> &batch);
+	int load_particle_batch(std::vector<_flux_record> &batch);
+	//Streaming mode: next_batch is filled by loader while partlist is sampled.
+	bool binary;
+	//Start of the shard in the file, its length in records or non-comment
+	//lines (-1 for the rest of the file) and what is left of it in this pass.
+	std::streamoff data_start;
+	long shard_len, shard_left;
+	long file_particles;
+	void open_text_shard(long shard, long shards);
+	std::vector<_flux_record> next_batch;
+	std::thread loader;
+	void load_next_batch();
+	void next_particle_batch();
+	//Acceptance prefilter, see Set_Acceptance. batch_draws is the number of
+	//particles read for the current batch, which is sampled that many times.
+	std::function<bool(const _flux_record&)> accept;
+	double acceptance, next_acceptance;
+	std::size_t batch_draws, next_batch_draws, draws;
+	std::size_t select_batch(std::vector<_flux_record> &batch);
+	//Weight-proportional sampling, see the constructor.
+	std::vector<_alias_entry> alias_table, next_alias_table;
+	double alias_weight, next_alias_weight;
+	void build_alias_table(const _flux_record *, std::size_t, std::vector<_alias_entry> &, double &);
+	//Binary particle lists are read straight from the mapped file.
+	bool open_binary(const std::string&, long shard, long shards);
+	//Points to the mapped records, or to partlist for text lists.
+	const _flux_record *records;
+	std::size_t nrecords, record_index;
+	void set_particle(Particle &part, std::size_t index);
+	void *map_addr;
+	std::size_t map_len;
 	int part_count;
-	bool POS, WEIGHT;
+	bool POS, WEIGHT, ALIAS;
         long origin_id;
 	//int load_particle_batch();
 };
@@ -1,7 +1,8 @@
 #include "Random.h"
 
-std::default_random_engine generator;
-std::uniform_real_distribution<double> distribution;
+//Each thread draws from its own engine, seeded by constructing a Random on that thread.
+thread_local std::default_random_engine generator;
+thread_local std::uniform_real_distribution<double> distribution;
 //------------------------------------------------------------------------------
 // The constructors
 // Set seed from the system timer or initiate seed yourself
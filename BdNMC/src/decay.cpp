@@ -3,6 +3,7 @@
 #include <iostream>
 #include <fstream>
 #include "Kinematics.h"
+#include <algorithm>
 
 
 //std::ofstream datalog_decay("decaylog.dat",std::ios::out);
@@ -34,17 +35,19 @@ void DecayDP(Particle &daughter, Particle &parent){
 // cascade decay for parent -> mediator + X, mediator > daughter1 + daughter 2
 //This assumes no meaningful propagation before the decay occurs
 void DecayDM(Particle &daughter1, Particle &daughter2, Particle &mediator, Particle &parent){
+	double ym = Random::Flat(0,1);
+	double zm = Random::Flat(0,1);
+	DecayDM(daughter1, daughter2, mediator, parent, acos(-1+2*ym), 2.0*pi*zm);
+}
+
+//As above, with the mediator emitted at (thetam, phim) in the parent rest frame.
+void DecayDM(Particle &daughter1, Particle &daughter2, Particle &mediator, Particle &parent, double thetam, double phim){
 	double pmx, pmy, pmz, Em, pm;
-	double ym, zm, thetam, phim;	
 	double pdx, pdy, pdz, Ed, pd;
 	double yd, zd, thetad, phid;	
 	double lam;	
 	//double polarX1, polarX2;
 	//Particle darkphoton(MV);
-	ym = Random::Flat(0,1);
-	zm = Random::Flat(0,1);
-    thetam = acos(-1+2*ym);
-	phim = 2.0*pi*zm;
 	double Md, Mm, Mp;
 	Md = daughter1.m;
 	Mm = mediator.m;
@@ -120,19 +123,27 @@ void TwoBodyDecay(Particle &parent, Particle &daughter1, Particle &daughter2, do
 /*I should check that this is handled properly. Not quite sure that it is, though
 it probably won't change very much if the angle is handled differently.
 */
-void DecayDM_Off_Shell(Particle &daughter1, Particle &daughter2, Particle &mediator, Particle &parent, double theta){
+//Decays the mediator at rest into daughter1 and daughter2 and sets it to move along z with
+//the momentum of parent -> mediator + photon in the parent rest frame.
+static void off_shell_rest_frame(Particle &daughter1, Particle &daughter2, Particle &mediator, Particle &parent, double theta){
     TwoBodyDecay(mediator, daughter1, daughter2, theta);
     mediator.ThreeMomentum(0,0,TriangleFunc(parent.m,mediator.m,0));
     daughter1.Lorentz(mediator);
     daughter2.Lorentz(mediator);
-    double mtheta=acos(Random::Flat(-1,1));
-    double mphi = Random::Flat(0,1)*2*pi;
-    mediator.Rotate_z(mtheta);
-    mediator.Rotate_y(mphi);
-    daughter1.Rotate_z(mtheta);
-    daughter1.Rotate_y(mphi);
-    daughter2.Rotate_z(mtheta);
-    daughter2.Rotate_y(mphi);
+}
+
+//Rotates the system so that the mediator moves at polar angle mtheta and azimuth mphi.
+static void off_shell_rotate(Particle &daughter1, Particle &daughter2, Particle &mediator, double mtheta, double mphi){
+    mediator.Rotate_y(mtheta);
+    mediator.Rotate_z(mphi);
+    daughter1.Rotate_y(mtheta);
+    daughter1.Rotate_z(mphi);
+    daughter2.Rotate_y(mtheta);
+    daughter2.Rotate_z(mphi);
+}
+
+//Boosts the rotated system to the lab frame of parent and links the particles.
+static void off_shell_to_lab(Particle &daughter1, Particle &daughter2, Particle &mediator, Particle &parent){
     mediator.Lorentz(parent);
     daughter1.Lorentz(parent);
     daughter2.Lorentz(parent);
@@ -141,6 +152,24 @@ void DecayDM_Off_Shell(Particle &daughter1, Particle &daughter2, Particle &media
 	Link_Particles_Immediate(mediator,daughter2);
 }
 
+//The mediator is emitted isotropically in the parent rest frame, its angles are drawn after
+//the mediator decay.
+void DecayDM_Off_Shell(Particle &daughter1, Particle &daughter2, Particle &mediator, Particle &parent, double theta){
+    off_shell_rest_frame(daughter1, daughter2, mediator, parent, theta);
+    double mtheta=acos(Random::Flat(-1,1));
+    double mphi = Random::Flat(0,1)*2*pi;
+    off_shell_rotate(daughter1, daughter2, mediator, mtheta, mphi);
+    off_shell_to_lab(daughter1, daughter2, mediator, parent);
+}
+
+//As above, with the mediator emitted at polar angle mtheta and azimuth mphi in the parent
+//rest frame, as Sample_Emission_Direction gives them.
+void DecayDM_Off_Shell(Particle &daughter1, Particle &daughter2, Particle &mediator, Particle &parent, double theta, double mtheta, double mphi){
+    off_shell_rest_frame(daughter1, daughter2, mediator, parent, theta);
+    off_shell_rotate(daughter1, daughter2, mediator, mtheta, mphi);
+    off_shell_to_lab(daughter1, daughter2, mediator, parent);
+}
+
 void Meson_Capture_Off_Shell(Particle &daughter1, Particle &daughter2, Particle &mediator, double theta){
     double thetad = mediator.Theta();
     double phid = mediator.Phi();
@@ -156,3 +185,118 @@ void Meson_Capture_Off_Shell(Particle &daughter1, Particle &daughter2, Particle
 	Link_Particles(mediator,daughter1);
 	Link_Particles(mediator,daughter2);
 }
+
+//Two unit vectors perpendicular to the unit vector a and to each other.
+static void perpendicular_frame(const double a[3], double e1[3], double e2[3]){
+    double t[3] = {0,0,0};
+    t[(fabs(a[0])<0.9) ? 0 : 1] = 1;
+    e1[0] = a[1]*t[2]-a[2]*t[1]; e1[1] = a[2]*t[0]-a[0]*t[2]; e1[2] = a[0]*t[1]-a[1]*t[0];
+    double norm = sqrt(e1[0]*e1[0]+e1[1]*e1[1]+e1[2]*e1[2]);
+    for(int i=0; i<3; i++)
+        e1[i] /= norm;
+    e2[0] = a[1]*e1[2]-a[2]*e1[1]; e2[1] = a[2]*e1[0]-a[0]*e1[2]; e2[2] = a[0]*e1[1]-a[1]*e1[0];
+}
+
+//Rest frame direction n of a particle of momentum pstar and energy Estar emitted by parent
+//that moves along the lab direction u. If there is none, returns false and sets n to the
+//direction of largest lab angle to parent in the plane of u, the closest to u.
+static bool rest_frame_direction(Particle &parent, double pstar, double Estar, const double u[3], double n[3]){
+    double pmom = parent.Momentum();
+    if(pmom==0){
+        for(int i=0; i<3; i++)
+            n[i] = u[i];
+        return true;
+    }
+    double pdir[3] = {parent.px/pmom, parent.py/pmom, parent.pz/pmom};
+    double beta = pmom/parent.E;
+    double gamma = parent.E/parent.m;
+    double upar = u[0]*pdir[0]+u[1]*pdir[1]+u[2]*pdir[2];
+    double uperp[3] = {u[0]-upar*pdir[0], u[1]-upar*pdir[1], u[2]-upar*pdir[2]};
+    double sperp = sqrt(uperp[0]*uperp[0]+uperp[1]*uperp[1]+uperp[2]*uperp[2]);
+    //The lab momentum k*u boosted back has length pstar, the larger root is taken.
+    double A = sperp*sperp+upar*upar/gamma/gamma;
+    double B = -2*upar*beta*Estar/gamma;
+    double C = beta*beta*Estar*Estar-pstar*pstar;
+    double disc = B*B-4*A*C;
+    double k = disc<0 ? 0 : (-B+sqrt(disc))/(2*A);
+    if(k>0){
+        double ppar = k*upar/gamma-beta*Estar;
+        for(int i=0; i<3; i++)
+            n[i] = (k*uperp[i]+ppar*pdir[i])/pstar;
+        return true;
+    }
+    double cos0 = -pstar/Estar/beta;
+    double sin0 = sqrt(1-cos0*cos0);
+    for(int i=0; i<3; i++)
+        n[i] = cos0*pdir[i]+(sperp>0 ? sin0*uperp[i]/sperp : 0);
+    return false;
+}
+
+//Samples the direction (theta, phi) in the rest frame of parent of a mediator of momentum
+//pstar and mass mstar that decays to two particles of mass mdaughter. With probability
+//fraction it is drawn uniformly from a cone of rest frame directions pointing the mediator
+//towards the sphere of given radius around center in the lab, widened by the largest angle
+//between the mediator and its daughters; otherwise isotropically. Returns the importance
+//weight of the direction, the ratio of the isotropic density to that of this mixture.
+double Sample_Emission_Direction(Particle &parent, double pstar, double mstar, double mdaughter, const double center[3], double radius, double fraction, double &theta, double &phi){
+    double Estar = sqrt(pstar*pstar+mstar*mstar);
+    double d[3];
+    for(int i=0; i<3; i++)
+        d[i] = center[i]-parent.end_coords[i];
+    double D = sqrt(d[0]*d[0]+d[1]*d[1]+d[2]*d[2]);
+    double cone = pi;
+    double axis[3];
+    if(fraction>0 && D>radius){
+        double u[3] = {d[0]/D, d[1]/D, d[2]/D};
+        rest_frame_direction(parent, pstar, Estar, u, axis);
+        //Rest frame images of four edges of the lab cone around the detector.
+        double delta = asin(radius/D);
+        double e1[3], e2[3];
+        perpendicular_frame(u, e1, e2);
+        double cos_cone = 1;
+        for(int edge=0; edge<4; edge++){
+            double *e = (edge<2) ? e1 : e2;
+            double sign = (edge%2==0) ? 1 : -1;
+            double ue[3], ne[3];
+            for(int i=0; i<3; i++)
+                ue[i] = cos(delta)*u[i]+sign*sin(delta)*e[i];
+            rest_frame_direction(parent, pstar, Estar, ue, ne);
+            cos_cone = std::min(cos_cone, ne[0]*axis[0]+ne[1]*axis[1]+ne[2]*axis[2]);
+        }
+        //Largest angle between the daughters and the mediator in the parent rest frame.
+        double beta_med = pstar/Estar;
+        double beta_dau = sqrt(std::max(0.0, 1-4*mdaughter*mdaughter/mstar/mstar));
+        double spread = pi;
+        if(beta_med>beta_dau)
+            spread = atan(beta_dau/(Estar/mstar*sqrt(beta_med*beta_med-beta_dau*beta_dau)));
+        cone = acos(std::max(-1.0,std::min(1.0,cos_cone)))+spread;
+    }
+    if(cone>=pi){
+        //No useful cone, isotropic emission.
+        theta = acos(Random::Flat(-1,1));
+        phi = Random::Flat(0,1)*2*pi;
+        return 1.0;
+    }
+    double cos_cone = cos(cone);
+    double n[3];
+    if(Random::Flat(0,1)<fraction){
+        double ct = 1-Random::Flat(0,1)*(1-cos_cone);
+        double st = sqrt(1-ct*ct);
+        double ph = Random::Flat(0,1)*2*pi;
+        double a1[3], a2[3];
+        perpendicular_frame(axis, a1, a2);
+        for(int i=0; i<3; i++)
+            n[i] = ct*axis[i]+st*(cos(ph)*a1[i]+sin(ph)*a2[i]);
+    }
+    else{
+        double ct = Random::Flat(-1,1);
+        double st = sqrt(1-ct*ct);
+        double ph = Random::Flat(0,1)*2*pi;
+        n[0] = st*cos(ph); n[1] = st*sin(ph); n[2] = ct;
+    }
+    theta = acos(std::max(-1.0,std::min(1.0,n[2])));
+    phi = atan2(n[1],n[0]);
+    bool in_cone = n[0]*axis[0]+n[1]*axis[1]+n[2]*axis[2] >= cos_cone;
+    double density = (1-fraction)/(4*pi)+(in_cone ? fraction/(2*pi*(1-cos_cone)) : 0);
+    return 1.0/(4*pi)/density;
+}
@@ -12,7 +12,10 @@
 
 void DecayDP (Particle &, Particle &);
 void DecayDM (Particle &, Particle &, Particle &, Particle &);
+void DecayDM (Particle &daughter1, Particle &daughter2, Particle &mediator, Particle &parent, double thetam, double phim);
 void DecayDM_Off_Shell(Particle &daughter1, Particle &daughter2, Particle &mediato, Particle &parent, double theta);
+void DecayDM_Off_Shell(Particle &daughter1, Particle &daughter2, Particle &mediator, Particle &parent, double theta, double thetam, double phim);
+double Sample_Emission_Direction(Particle &parent, double pstar, double mstar, double mdaughter, const double center[3], double radius, double fraction, double &theta, double &phi);
 void TwoBodyDecay (Particle &parent, Particle &daughter1, Particle &daughter2);
 void TwoBodyDecay (Particle &parent, Particle &daughter1, Particle &daughter2, double thetad);
 void TwoBodyDecay (Particle &parent, Particle &daughter1, Particle &daughter2, double thetad, double phid);
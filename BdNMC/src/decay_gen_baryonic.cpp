@@ -74,10 +74,10 @@ bool pion_decay_gen_baryonic::GenDM(std::list<Particle>& vec, std::function<doub
         double s, theta;//theta is the angle relative to the gamma in the V* rest frame
         sample_dist(s, theta);
         darkphoton.Set_Mass(sqrt(s));
-        DecayDM_Off_Shell(darkmatter1, darkmatter2, darkphoton, meson, theta);
+        Decay_To_DM(darkmatter1, darkmatter2, darkphoton, meson, true, theta);
     }
     else
-        DecayDM(darkmatter1, darkmatter2, darkphoton, meson);
+        Decay_To_DM(darkmatter1, darkmatter2, darkphoton, meson, false);
 /*
     darkmatter1.report(datalogpion);
     darkmatter2.report(datalogpion);
@@ -166,10 +166,10 @@ bool eta_decay_gen_baryonic::GenDM(std::list<Particle>& vec, std::function<doubl
         double s, theta;//theta is the angle relative to the gamma in the V* rest frame
         sample_dist(s, theta);
         darkphoton.Set_Mass(sqrt(s));
-        DecayDM_Off_Shell(darkmatter1, darkmatter2, darkphoton, meson, theta);
+        Decay_To_DM(darkmatter1, darkmatter2, darkphoton, meson, true, theta);
     }
     else
-        DecayDM(darkmatter1, darkmatter2, darkphoton, meson);
+        Decay_To_DM(darkmatter1, darkmatter2, darkphoton, meson, false);
 
     vec.push_back(meson);
     if((intersect1=det_int(darkmatter1))>0 || (intersect2=det_int(darkmatter2))>0){
@@ -2,6 +2,7 @@
 #include "branchingratios.h"
 #include "decay.h"
 #include "constants.h"
+#include "Kinematics.h"
 #include <cstdlib>
 #include <iostream>
 #include <fstream>
@@ -19,6 +20,22 @@ using std::cerr;
 using std::endl;
 const int BURN_MAX = 1000;
 
+void DMGenerator::Decay_To_DM(Particle &dm1, Particle &dm2, Particle &mediator, Particle &meson, bool off_shell, double theta){
+    if(bias_fraction<=0){
+        if(off_shell)
+            DecayDM_Off_Shell(dm1, dm2, mediator, meson, theta);
+        else
+            DecayDM(dm1, dm2, mediator, meson);
+        return;
+    }
+    double mtheta, mphi;
+    meson.w *= Sample_Emission_Direction(meson, TriangleFunc(meson.m, mediator.m, 0), mediator.m, dm1.m, bias_center, bias_radius, bias_fraction, mtheta, mphi);
+    if(off_shell)
+        DecayDM_Off_Shell(dm1, dm2, mediator, meson, theta, mtheta, mphi);
+    else
+        DecayDM(dm1, dm2, mediator, meson, mtheta, mphi);
+}
+
 pion_decay_gen::pion_decay_gen(double MV, double MX, double kap, double alp, std::string decay_type){
     set_model_params_dp(MV, MX, kap, alp, decay_type);
     chan_name="pi0_decay";
@@ -105,10 +122,10 @@ bool pion_decay_gen::GenDM(std::list<Particle>& vec, std::function<double(Partic
 		double s, theta;//theta is the angle relative to the gamma in the V* rest frame
         sample_dist(s, theta);
         darkphoton.Set_Mass(sqrt(s));
-        DecayDM_Off_Shell(darkmatter1, darkmatter2, darkphoton, meson, theta);
+        Decay_To_DM(darkmatter1, darkmatter2, darkphoton, meson, true, theta);
     }
     else
-        DecayDM(darkmatter1, darkmatter2, darkphoton, meson);
+        Decay_To_DM(darkmatter1, darkmatter2, darkphoton, meson, false);
 /*
     darkmatter1.report(cout);
     darkmatter2.report(cout);
@@ -208,10 +225,10 @@ bool eta_decay_gen::GenDM(std::list<Particle>& vec, std::function<double(Particl
         double s, theta;//theta is the angle relative to the gamma in the V* rest frame
         sample_dist(s, theta);
         darkphoton.Set_Mass(sqrt(s));
-        DecayDM_Off_Shell(darkmatter1, darkmatter2, darkphoton, meson, theta);
+        Decay_To_DM(darkmatter1, darkmatter2, darkphoton, meson, true, theta);
     }
     else{
-        DecayDM(darkmatter1, darkmatter2, darkphoton, meson);
+        Decay_To_DM(darkmatter1, darkmatter2, darkphoton, meson, false);
     }
 
     intersect1=det_int(darkmatter1);
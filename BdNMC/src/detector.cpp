@@ -32,6 +32,7 @@ detector_sphere::detector_sphere (double x, double y, double z, double radius){
 // distance DM travels through detector
 double detector_sphere::Ldet (Particle &DM) {
 	double Ldetenter, Ldetexit;
+    double b[3], o[3];
     double A, B, C;	
 //cout << DM.name << " " << DM.E << " " << DM.px << " " << DM.py << " " << DM.pz << " " << DM.m << " " << DM.origin_coords[0] << " " << DM.origin_coords[1] << " " << DM.origin_coords[2] << " " << DM.origin_coords[3] << " " << DM.end_coords[0] << " " << DM.end_coords[1] << " " << DM.end_coords[2] << " " << DM.end_coords[3] << std::endl;
     b[0]=DM.px;b[1]=DM.py;b[2]=DM.pz;
@@ -81,6 +82,45 @@ double detector_sphere::Ldet (Particle &DM) {
         return 0;
 }
 
+//The batch versions find the interval of the trajectory parameter t (position
+//origin + t*p) inside the detector without branches, so the loops vectorize.
+
+//Narrows [t1,t2] to the t where (t*bf-of)/ff is between -1 and 1, the slab between
+//two opposite faces whose center is at f from the detector center, with bf = p.f,
+//of = o.f and ff = f.f.
+static inline void clip_slab(double bf, double of, double ff, double &t1, double &t2){
+    bool parallel = bf==0;
+    double inv_bf = 1/(parallel ? 1.0 : bf);
+    double a1 = (of-ff)*inv_bf, a2 = (of+ff)*inv_bf;
+    //Parallel to the faces, the trajectory is inside the slab everywhere or nowhere.
+    double edge = std::fabs(of)<=ff ? HUGE_VAL : -HUGE_VAL;
+    double lo = parallel ? -edge : std::min(a1, a2);
+    double hi = parallel ? edge : std::max(a1, a2);
+    t1 = std::max(t1, lo);
+    t2 = std::min(t2, hi);
+}
+void detector_sphere::Ldet (const trajectory_batch &traj, double *__restrict__ enter, double *__restrict__ exit, double *__restrict__ L){
+    const double cx = r[0], cy = r[1], cz = r[2], R2 = Rdet*Rdet;
+    const double *__restrict__ x = traj.x, *__restrict__ y = traj.y, *__restrict__ z = traj.z;
+    const double *__restrict__ px = traj.px, *__restrict__ py = traj.py, *__restrict__ pz = traj.pz;
+    for(std::size_t i=0; i<traj.n; i++){
+        double ox = cx-x[i], oy = cy-y[i], oz = cz-z[i];
+        double A = px[i]*px[i]+py[i]*py[i]+pz[i]*pz[i];
+        double B = -2*(ox*px[i]+oy*py[i]+oz*pz[i]);
+        double C = ox*ox+oy*oy+oz*oz-R2;
+        double disc = B*B-4*A*C;
+        double root = std::sqrt(std::max(disc, 0.0));
+        double inv = 1/(2*A);
+        double t1 = std::max((-B-root)*inv, 0.0);
+        double t2 = std::max((-B+root)*inv, 0.0);
+        bool hit = (disc>=0) & (A>0) & (t2>t1);
+        double speed = std::sqrt(A);
+        enter[i] = hit ? t1*speed : 0;
+        exit[i] = hit ? t2*speed : 0;
+        L[i] = hit ? (t2-t1)*speed : 0;
+    }
+}
+
 /*******************
  *detector_cylinder*
  *******************/
@@ -108,6 +148,7 @@ detector_cylinder::detector_cylinder (double x, double y, double z, double detle
 //originating in the detector, or going in the opposite direction. Both cases are handled
 //properly by the Ldet calculation.
 double detector_cylinder::Ldet (Particle &DM){
+    double b[3], o[3];
     b[0]=DM.px;b[1]=DM.py;b[2]=DM.pz;
    
 	for(int i=0; i<3; i++){
@@ -199,6 +240,42 @@ double detector_cylinder::Ldet (Particle &DM){
         throw crossings.size();
 }
 
+//Intersection of the slab between the circular faces with the infinite cylinder.
+void detector_cylinder::Ldet (const trajectory_batch &traj, double *__restrict__ enter, double *__restrict__ exit, double *__restrict__ L){
+    const double cx = r[0], cy = r[1], cz = r[2], R2 = Rdet*Rdet;
+    const double lx = l[0], ly = l[1], lz = l[2], ll = lx*lx+ly*ly+lz*lz;
+    const double *__restrict__ x = traj.x, *__restrict__ y = traj.y, *__restrict__ z = traj.z;
+    const double *__restrict__ px = traj.px, *__restrict__ py = traj.py, *__restrict__ pz = traj.pz;
+    for(std::size_t i=0; i<traj.n; i++){
+        double ox = cx-x[i], oy = cy-y[i], oz = cz-z[i];
+        double bb = px[i]*px[i]+py[i]*py[i]+pz[i]*pz[i];
+        double ob = ox*px[i]+oy*py[i]+oz*pz[i];
+        double oo = ox*ox+oy*oy+oz*oz;
+        double bl = px[i]*lx+py[i]*ly+pz[i]*lz;
+        double ol = ox*lx+oy*ly+oz*lz;
+        //Radial distance from the axis at most Rdet: X t^2 + Y t + Z <= 0.
+        double X = bb*ll-bl*bl;
+        double Y = -2*ob*ll+2*bl*ol;
+        double Z = oo*ll-ol*ol-R2*ll;
+        double disc = Y*Y-4*X*Z;
+        double root = std::sqrt(std::max(disc, 0.0));
+        double inv_X = 1/(2*(X>0 ? X : 1.0));
+        //Along the axis the radial condition holds everywhere or nowhere.
+        bool along = X<=0;
+        double edge = Z<=0 ? HUGE_VAL : -HUGE_VAL;
+        double rad_in = along ? -edge : (-Y-root)*inv_X;
+        double rad_out = along ? edge : (-Y+root)*inv_X;
+        bool rad_hit = along | (disc>0);
+        double t1 = std::max(rad_in, 0.0), t2 = rad_out;
+        clip_slab(bl, ol, ll, t1, t2);
+        bool hit = rad_hit & (bb>0) & (t2>t1);
+        double speed = std::sqrt(bb);
+        enter[i] = hit ? t1*speed : 0;
+        exit[i] = hit ? t2*speed : 0;
+        L[i] = hit ? (t2-t1)*speed : 0;
+    }
+}
+
 /*******************
  *detector_cuboid*
  *******************/
@@ -241,6 +318,7 @@ detector_cuboid::detector_cuboid(double x, double y, double z, double detwidth,
 }
 
 double detector_cuboid::Ldet (Particle &DM){
+    double b[3];
     b[0]=DM.px;b[1]=DM.py;b[2]=DM.pz;
     //cout << b[0] << " " << b[1] << " " << b[2] << endl; 
     double o[3];
@@ -388,4 +466,25 @@ double detector_cuboid::Ldet (Particle &DM){
     }
 }
 
-
+//Intersection of the three slabs between opposite faces.
+void detector_cuboid::Ldet (const trajectory_batch &traj, double *__restrict__ enter, double *__restrict__ exit, double *__restrict__ L){
+    const double cx = r[0], cy = r[1], cz = r[2];
+    const double f0x = face[0][0], f0y = face[0][1], f0z = face[0][2], ff0 = ip(face[0],face[0]);
+    const double f1x = face[1][0], f1y = face[1][1], f1z = face[1][2], ff1 = ip(face[1],face[1]);
+    const double f2x = face[2][0], f2y = face[2][1], f2z = face[2][2], ff2 = ip(face[2],face[2]);
+    const double *__restrict__ x = traj.x, *__restrict__ y = traj.y, *__restrict__ z = traj.z;
+    const double *__restrict__ px = traj.px, *__restrict__ py = traj.py, *__restrict__ pz = traj.pz;
+    for(std::size_t i=0; i<traj.n; i++){
+        double ox = cx-x[i], oy = cy-y[i], oz = cz-z[i];
+        double t1 = 0, t2 = HUGE_VAL;
+        clip_slab(px[i]*f0x+py[i]*f0y+pz[i]*f0z, ox*f0x+oy*f0y+oz*f0z, ff0, t1, t2);
+        clip_slab(px[i]*f1x+py[i]*f1y+pz[i]*f1z, ox*f1x+oy*f1y+oz*f1z, ff1, t1, t2);
+        clip_slab(px[i]*f2x+py[i]*f2y+pz[i]*f2z, ox*f2x+oy*f2y+oz*f2z, ff2, t1, t2);
+        double bb = px[i]*px[i]+py[i]*py[i]+pz[i]*pz[i];
+        bool hit = (bb>0) & (t2>t1);
+        double speed = std::sqrt(bb);
+        enter[i] = hit ? t1*speed : 0;
+        exit[i] = hit ? t2*speed : 0;
+        L[i] = hit ? (t2-t1)*speed : 0;
+    }
+}
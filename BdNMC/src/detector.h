@@ -5,6 +5,8 @@
 #include "Particle.h"
 #include <string>
 #include <vector>
+#include <cmath>
+#include <cstddef>
 class Material {
     public:
         Material(double nd, double np, double nn, double ne, double m, std::string name) {nDensity=nd; Proton_Number=np; Neutron_Number=nn; Electron_Number=ne; matname=name; mass=m;}
@@ -19,10 +21,22 @@ class Material {
         std::string matname;
 };
 
+//Straight trajectories for the batch Ldet, one array per coordinate so that its
+//loops vectorize. Trajectory i starts at (x[i],y[i],z[i]) and moves along (px[i],py[i],pz[i]).
+struct trajectory_batch{
+    std::size_t n;
+    const double *x, *y, *z;
+    const double *px, *py, *pz;
+};
+
 class detector {
     //double xdet, ydet, zdet, Rdet;
 public:
     virtual double Ldet (Particle &) = 0;
+    //Batch version of Ldet: for every trajectory, the distances from its start at which
+    //it enters and leaves the detector (enter is 0 if it starts inside) and the length
+    //L it travels inside, which is zero when it misses and then enter = exit.
+    virtual void Ldet (const trajectory_batch &, double *enter, double *exit, double *L) = 0;
 //	virtual void intersect (int &, int &, Particle) = 0;
     detector(){ p_num_tot=0; n_num_tot=0; e_num_tot=0;}
     virtual ~detector(){};
@@ -37,12 +51,13 @@ public:
     double PNtot(){ return p_num_tot;}
     double NNtot(){ return n_num_tot;}
     double ENtot(){ return e_num_tot;}
+    //Center of the detector and the radius of a sphere around it that contains it.
+    const double *Center(){return r;}
+    virtual double Bounding_Radius() = 0;
     
     //double cross_point[2];//holds the last entrance and exit points of a particle.
 protected:
     double r[3];
-    double b[3];
-	double o[3];
     std::vector<Material> matvec;
     double p_num_tot, n_num_tot, e_num_tot;
 };
@@ -52,6 +67,8 @@ public:
     detector_sphere(double x, double y, double z, double R);
     ~detector_sphere(){}
     double Ldet (Particle &);
+    void Ldet (const trajectory_batch &, double *enter, double *exit, double *L);
+    double Bounding_Radius(){return Rdet;}
 //  void intersect (const int &, const int &, const Particle &);
 private:
     double Rdet;
@@ -63,6 +80,8 @@ class detector_cylinder: public detector{
                 double detTheta, double detPhi);
         ~detector_cylinder(){}
         double Ldet (Particle &);
+        void Ldet (const trajectory_batch &, double *enter, double *exit, double *L);
+        double Bounding_Radius(){return sqrt(Rdet*Rdet+Ldetector*Ldetector/4);}
         //double Ldeto (const Particle &, const double offset[3]);
     private:
         double Rdet, Ldetector;
@@ -79,6 +98,8 @@ class detector_cuboid: public detector{
         detector_cuboid(double xdet, double ydet, double zdet, double detlength, double detwidth, double detheight, double detPhi, double detTheta ,double detPsi);
         ~detector_cuboid(){}
         double Ldet (Particle &);
+        void Ldet (const trajectory_batch &, double *enter, double *exit, double *L);
+        double Bounding_Radius(){return sqrt(face_dist[0]*face_dist[0]+face_dist[1]*face_dist[1]+face_dist[2]*face_dist[2])/2;}
     private:
         //double Hdetector, Wdetector, Ldetector;
         //These each point to the center of one of the cuboid's faces.
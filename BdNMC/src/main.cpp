@@ -9,6 +9,14 @@
 #include <numeric>
 #include <memory>
 #include <algorithm> 
+#include <thread>
+#include <mutex>
+#include <condition_variable>
+#include <atomic>
+#include <map>
+#include <random>
+#include <sstream>
+#include <iomanip>
 
 #include "constants.h"
 
@@ -21,6 +29,7 @@
 #include "detector.h"
 #include "record.h"
 #include "record_root.h"
+#include "pmax_cache.h"
 #include "Particle.h"
 #include "Random.h"
 #include "decay.h"
@@ -70,6 +79,26 @@ double t_delay_fraction(double tcut, double pos, double speed){
     return 1 - (tcut-tdelay)/tcut;
 }
 
+//True if a DM particle from the decay of a meson of mass M with momentum p at pos
+//can reach the sphere of radius R around center. In M -> gamma DM DM the DM speed in
+//the meson rest frame is at most that of M -> DM X with m_X = mdm, which bounds the
+//lab angle between the DM and the meson.
+bool dm_can_reach(const double p[3], const double pos[3], double M, double mdm, const double center[3], double R){
+  double d[3] = {center[0]-pos[0], center[1]-pos[1], center[2]-pos[2]};
+  double D = sqrt(d[0]*d[0]+d[1]*d[1]+d[2]*d[2]);
+  double pmom = sqrt(p[0]*p[0]+p[1]*p[1]+p[2]*p[2]);
+  if(D<=R || pmom==0 || 2*mdm>=M)
+    return true;
+  double beta_dm = sqrt(1-4*mdm*mdm/M/M);
+  double beta = pmom/sqrt(pmom*pmom+M*M);
+  if(beta<=beta_dm)
+    return true;
+  double gamma = sqrt(pmom*pmom+M*M)/M;
+  double theta_max = atan(beta_dm/(gamma*sqrt(beta*beta-beta_dm*beta_dm)));
+  double cos_angle = (p[0]*d[0]+p[1]*d[1]+p[2]*d[2])/pmom/D;
+  return acos(std::max(-1.0,std::min(1.0,cos_angle))) <= theta_max+asin(R/D);
+}
+
 int main(int argc, char* argv[]){
 
 
@@ -228,12 +257,13 @@ int main(int argc, char* argv[]){
 
   //Detector setup
   std::shared_ptr<detector> det = std::shared_ptr<detector>(par->Get_Detector());
-  function<double(Particle&)> det_int = bind(&detector::Ldet,det,_1);//should get rid of this eventually, just pass detector object references.
+  function<double(Particle&)> det_int = [det](Particle &part){return det->Ldet(part);};//should get rid of this eventually, just pass detector object references.
   //function<double(Particle)> det_int = [](Particle x){return 1.0;};
 
   //Production Mode
   vector<std::shared_ptr<DMGenerator> > DMGen_list;//Should be a unique_ptr
   vector<std::shared_ptr<Distribution> > PartDist_list;//This is an abstract class from which all distributions inherit.
+  vector<std::shared_ptr<Particle_List> > PartList_list;//The particle list of each channel, if it has one.
   vector<double> number_of_mesons; 
   vector<double> Vnum_list;
   vector<string> proddist_vec;
@@ -256,6 +286,7 @@ int main(int argc, char* argv[]){
     string proddist = proditer->Prod_Dist();
     std::shared_ptr<DMGenerator> DMGen;
     std::shared_ptr<Distribution> PartDist;
+    std::shared_ptr<Particle_List> PartList;
     double Vnum;
     cout << "Setting up distribution " << proddist << " for channel " << prodchoice << endl;
     //Don't delete these without good reason! They're used immediately!
@@ -275,19 +306,35 @@ int main(int argc, char* argv[]){
       if(set_weight){
         cout << "weights were read from particle_list file\n";
       }
+      bool set_alias = proditer->par_list_alias();
+      if(set_alias && set_weight){
+        cout << "particles are sampled in proportion to their weights\n";
+      }
 
-      std::ifstream in(proditer->particle_list_file);
-      std::string unused;
-      while ( std::getline(in, unused) ){
-        ++numLines;
-      } 
+      long nrecords = Particle_List::Binary_Record_Count(proditer->particle_list_file);
+      if(nrecords>=0){
+        numLines += nrecords;
+      }
+      else{
+        std::ifstream in(proditer->particle_list_file);
+        std::string unused;
+        while ( std::getline(in, unused) ){
+          ++numLines;
+        } 
+      }
 
       std::cout << "Number of lines on input file: " << numLines << std::endl;
       number_of_mesons.push_back(numLines); 
 
 
-      std::shared_ptr<Particle_List> pl(new Particle_List(proditer->particle_list_file,set_pos,set_weight));
+      //Grid jobs read the shard of their process number unless one is given.
+      long shard = proditer->par_list_shard();
+      if(shard<0)
+        shard = getenv("PROCESS") ? atol(getenv("PROCESS")) : 0;
+
+      std::shared_ptr<Particle_List> pl(new Particle_List(proditer->particle_list_file,set_pos,set_weight,proditer->par_list_batch(),shard,proditer->par_list_shards(),set_alias));
       PartDist = pl;
+      PartList = pl;
     }
     else if(proddist=="burmansmith"){
       std::shared_ptr<BurmanSmith> bs(new BurmanSmith(beam_energy,target_p));
@@ -496,12 +543,39 @@ int main(int argc, char* argv[]){
     }
 
     std::shared_ptr<list<production_distribution> > distmodlist = proditer-> Get_Dist_Mods_List();
+    double list_offset[3] = {0,0,0};
     for(list<production_distribution>::iterator distiter = distmodlist->begin(); distiter!=distmodlist->end();distiter++){
       list<std::shared_ptr<Distribution> > distlist;
       if(distiter->name()=="position_offset"){
         std::shared_ptr<Distribution> tmpdist (new Position_Offset(distiter->get_offset(0),distiter->get_offset(1),distiter->get_offset(2),distiter->get_offset(3)));
         PartDist->Add_Dist(tmpdist);
+        for(int j=0; j<3; j++)
+          list_offset[j]+=distiter->get_offset(j);
+      }
+    }
+
+    //Skip the mesons of the list whose DM can never reach the detector.
+    if(PartList && proditer->par_list_acceptance()){
+      double meson_mass = (prodchoice=="pi0_decay"||prodchoice=="pi0_decay_baryonic") ? mpi0 : meta;
+      if(prodchoice=="pi0_decay"||prodchoice=="pi0_decay_baryonic"||prodchoice=="eta_decay"||prodchoice=="eta_decay_baryonic"){
+        const double *det_center = det->Center();
+        double center[3] = {det_center[0]-list_offset[0], det_center[1]-list_offset[1], det_center[2]-list_offset[2]};
+        double radius = det->Bounding_Radius();
+        PartList->Set_Acceptance([=](const _flux_record &rec){
+          double p[3] = {rec.px, rec.py, rec.pz};
+          double pos[3] = {rec.x, rec.y, rec.z};
+          return dm_can_reach(p, pos, meson_mass, mdm, center, radius);
+        });
       }
+      else
+        cerr << "particle_list_acceptance is only implemented for pi0 and eta decays, ignoring it for " << prodchoice << endl;
+    }
+    //Point a fraction of the DM emissions towards the detector, compensated by the event weights.
+    if(par->Emission_Bias()>0){
+      if(prodchoice=="pi0_decay"||prodchoice=="pi0_decay_baryonic"||prodchoice=="eta_decay"||prodchoice=="eta_decay_baryonic")
+        DMGen->Set_Emission_Bias(det->Center(), det->Bounding_Radius(), par->Emission_Bias());
+      else
+        cerr << "emission_bias is only implemented for pi0 and eta decays, ignoring it for " << prodchoice << endl;
     }
     if(outmode=="particle_list"){
       Particle part(0);
@@ -522,6 +596,7 @@ int main(int argc, char* argv[]){
     proddist_vec.push_back(proddist);
     DMGen_list.push_back(DMGen);
     PartDist_list.push_back(PartDist);
+    PartList_list.push_back(PartList);
     Vnum_list.push_back(Vnum);
     Vnumtot+=Vnum;
   }//End of Production distribution loop. 
@@ -722,6 +797,48 @@ int main(int argc, char* argv[]){
     cout << "Detector_Mode selected.\nSkipping Burn-In.\n";
   }
 
+  //pMax depends on the model, the detector, the signal channel and its limits, and the
+  //production channels with everything that changes their flux or DM weights. Runs that
+  //share them read it from the cache instead of burning in. The particle list shard is left
+  //out: every shard samples the same flux distribution, so the grid jobs of one mass point
+  //share their pMax.
+  string pmax_cache = par->PMax_Cache();
+  string pmax_key;
+  if(pmax_cache!="" && BURN_MAX!=0){
+    std::ostringstream key;
+    key << std::setprecision(10) << mv << " " << mdm << " " << alD << " " << kappa << " " << decay_type << " " << sigchoice;
+    key << " " << min_scatter_energy << " " << max_scatter_energy << " " << min_angle << " " << max_angle << " " << EDMRES << " " << par->Coherent();
+    key << " " << par->Detector_Geometry();
+    for(unsigned m=0; m<det->mat_num(); m++)
+      key << " " << det->matname(m) << " " << det->get_nDensity(m) << " " << det->PN(m) << " " << det->NN(m) << " " << det->EN(m) << " " << det->M(m);
+    for(int i=0; i<chan_count; i++)
+      key << " " << DMGen_list[i]->Channel_Name() << " " << proddist_vec[i];
+    key << " " << par->Emission_Bias();
+    for(list<production_channel>::iterator proditer = prodlist->begin(); proditer!=prodlist->end(); proditer++){
+      key << " " << proditer->Meson_Per_Pi0();
+      if(proditer->Prod_Dist()=="particle_list"){
+        //the size tells apart different lists behind the same file name
+        std::ifstream list_file(proditer->Part_List_File(), std::ios::binary|std::ios::ate);
+        key << " " << proditer->Part_List_File() << " " << (list_file.is_open() ? (long)list_file.tellg() : -1L);
+        key << " " << proditer->par_list_pos() << " " << proditer->par_list_weight();
+        key << " " << proditer->par_list_alias() << " " << proditer->par_list_acceptance();
+      }
+      std::shared_ptr<list<production_distribution> > distmodlist = proditer->Get_Dist_Mods_List();
+      for(list<production_distribution>::iterator distiter = distmodlist->begin(); distiter!=distmodlist->end(); distiter++){
+        key << " " << distiter->name();
+        for(int j=0; j<4; j++)
+          key << " " << distiter->get_offset(j);
+      }
+    }
+    pmax_key = key.str();
+    double cached_pmax;
+    if(Read_PMax_Cache(pmax_cache, pmax_key, cached_pmax)){
+      SigGen->set_pMax(cached_pmax);
+      BURN_MAX = 0;
+      cout << "pMax = " << cached_pmax << " read from " << pmax_cache << ", skipping Burn-In.\n";
+    }
+  }
+
 
 
 
@@ -775,16 +892,224 @@ int main(int argc, char* argv[]){
   vector<double> timing_efficiency(chan_count,0.0);
 
   //int escat=0;lso thought it could have used Leatherhead, or some of the other mutanimals. He probably would have fit right in with the Scale tail clan.
-  bool scatter_switch;
   int trials_max = par->Max_Trials();
-  //if(SigGen->get_pMax()*Vnumtot<=1){
+  //Records the particles of a trial of channel i whose decay reached the detector,
+  //scattering them if the output mode asks for it.
+  auto record_trial = [&](int i, list<Particle> &vec){
+    bool scatter_switch = false;
+    bool isOther = false;
+    //Yes, this list is named vec.  
+
+    // We create a Particle iterator to go through the particles produced from the decay 
+    for(list<Particle>::iterator iter = vec.begin(); iter != vec.end();iter++){
+      //The way this is structured means I can't do my usual repeat thing to boost stats. 
+      if(isOther){
+        nother+=1;
+        continue;
+      }
+
+      // Check if the particle is DM 
+      if(iter->name.compare(sig_part_name)==0){
+        NDM_list[i]++;
+
+
+
+        /*
+          LM: 
+          This if is used to store in the comprehensive output
+          all the DM particles that cross the detector 
+          I think this is also one of Pawel's additions  
+        */
+        if(outmode=="dm_detector_distribution"){
+          *comprehensive_out << DMGen_list[i]->Channel_Name() << " " << det->Ldet(*iter) << " ";
+          iter->report(*comprehensive_out);
+          scatter_switch=true;
+          isOther = true;
+          continue;
+        }
+
+
+
+        /*
+          LM: 
+          This if is only used if you want to store the DM particles
+          crossing the detector in a root file rather than in
+          the comprehensive output stream 
+        */
+        if(outmode == "root_output" || outmode == "dm_dist_root"){
+          record_root(outtree, vec, nevent, isOther, DMGen_list[i]->Channel_Name(), det);
+          isOther = true;
+          scatter_switch=true;
+          continue;
+        }
+
+
+
+        // This happens regardless of the output mode...
+        // Here we provide a DM particle and the starting particle vector
+        // It increases the number of scatters 
+        if(SigGen->probscatter(det, vec, iter)){
+          scat_list[i]++;
+          if(timing_cut>0){
+            timing_efficiency[i]+=t_delay_fraction(timing_cut,sqrt(pow(iter->end_coords[0],2)+pow(iter->end_coords[1],2)+pow(iter->end_coords[2],2)),iter->Speed());
+          }
+          else{
+            timing_efficiency[i]+=1;
+          }
+          scatter_switch = true;	
+        }
+        
+
+        else{
+          iter = vec.erase(iter);
+          iter--;
+        }
+      }    
+    }
+
+
+    // This output mode is used to ouput the particles in a text file 
+    // it also increases nevent by one 
+    if(scatter_switch && outmode=="comprehensive"){
+      *comprehensive_out << "event " << ++nevent << endl;
+      Record_Particles(*comprehensive_out, vec);
+      *comprehensive_out << "endevent " << nevent << endl << endl;    
+    }
+    
+
+
+    // If we are in dm_dist_root or dm_detector_distribution
+    // We increase nevent every time a particle intersects with the detector
+    else if(scatter_switch && outmode=="dm_dist_root"){
+
+      ++nevent;
+      if(nevent%100 == 0) std::cout << "Event " << nevent << "/" << samplesize << std::endl;
+
+    }
+
+    else if(scatter_switch && outmode=="dm_detector_distribution"){
+      ++nevent;
+      //if(nevent%100 == 0) std::cout << "Event " << nevent << "/" << samplesize << std::endl;
+    }
+
+  };
+
+  //With threads > 0 the trials are split into blocks of THREAD_BLOCK trials, each
+  //simulated by a worker with its own random stream, generator copies and particle
+  //list draws, and recorded here in block order. The result only depends on the
+  //seed, not on the number of threads, but it is a different sample from the
+  //serial loop of threads 0 with the same seed, which is left unchanged.
+  const long THREAD_BLOCK = 10000;
+  int nthreads = par->Threads();
+  if(nthreads>0 && outmode!="root_output" && outmode!="dm_dist_root" && outmode!="dm_detector_distribution"){
+    cerr << "threads is only implemented for the root_output, dm_dist_root and dm_detector_distribution output modes, running serially.\n";
+    nthreads = 0;
+  }
+  for(int i=0; nthreads>0 && i<chan_count; i++){
+    if(!DMGen_list[i]->Clone() || !PartList_list[i] || PartList_list[i]->Streaming()){
+      cerr << "threads is only implemented for pi0 and eta decays of unstreamed particle lists, running serially.\n";
+      nthreads = 0;
+    }
+  }
+
   if(SigGen->get_pMax()<=0 && (outmode!="dm_detector_distribution" && outmode != "dm_dist_root")){
     cout << "pMax less than tolerance limit, skipping remainder of run\n";
   }
+  else if(nthreads>0){
+    cout << "Running on " << nthreads << " threads\n";
+    unsigned base_seed = par->Seed()>=0 ? par->Seed() : (unsigned)(Random::Flat(0,1)*4294967295.0);
+    long nblocks = trials_max>0 ? (trials_max+THREAD_BLOCK-1)/THREAD_BLOCK : -1;
+    //The channel of each trial of a block, and the particles of those that reached the detector.
+    struct trial_block{
+      vector<int> channel;
+      vector<std::pair<long, list<Particle> > > hits;
+    };
+    std::map<long, trial_block> done_blocks;
+    std::mutex block_mutex;
+    std::condition_variable block_ready;
+    std::atomic<long> next_block(0);
+    std::atomic<bool> stop(false);
+    long committed = 0;
+
+    auto run_block = [&](long block, trial_block &out){
+      std::seed_seq seq{base_seed, (unsigned) block};
+      unsigned block_seed;
+      seq.generate(&block_seed, &block_seed+1);
+      Random rng(block_seed);
+      vector<std::shared_ptr<DMGenerator> > gens;
+      for(int i=0; i<chan_count; i++)
+        gens.push_back(DMGen_list[i]->Clone());
+      long first = block*THREAD_BLOCK;
+      long ntrials = trials_max>0 ? std::min(THREAD_BLOCK, trials_max-first) : THREAD_BLOCK;
+      for(long k=0; k<ntrials; k++){
+        int i;
+        double vrnd = Random::Flat(0.0,1)*Vnumtot;
+        for(i=0; i<chan_count; i++){
+          if(vrnd<=Vnum_list[i])
+            break;
+          else
+            vrnd-=Vnum_list[i];
+        }
+        out.channel.push_back(i);
+        list<Particle> vec;
+        Particle dist_part (0);
+        PartDist_list[i]->Sample_Particle(dist_part, first+k);
+        if(gens[i]->GenDM(vec, det_int, dist_part))
+          out.hits.push_back(std::make_pair(k, std::move(vec)));
+      }
+    };
+
+    auto worker = [&](){
+      while(!stop){
+        long block = next_block++;
+        if(nblocks>=0 && block>=nblocks)
+          return;
+        {
+          //Keeps the workers a few blocks ahead of the writer at most.
+          std::unique_lock<std::mutex> lock(block_mutex);
+          block_ready.wait(lock, [&]{return stop || block<committed+4*nthreads;});
+          if(stop)
+            return;
+        }
+        trial_block out;
+        run_block(block, out);
+        std::lock_guard<std::mutex> lock(block_mutex);
+        done_blocks[block] = std::move(out);
+        block_ready.notify_all();
+      }
+    };
+
+    vector<std::thread> workers;
+    for(int n=0; n<nthreads; n++)
+      workers.push_back(std::thread(worker));
+    while((nevent < samplesize) && (nblocks<0 || committed<nblocks)){
+      trial_block blk;
+      {
+        std::unique_lock<std::mutex> lock(block_mutex);
+        block_ready.wait(lock, [&]{return done_blocks.count(committed)>0;});
+        blk = std::move(done_blocks[committed]);
+        done_blocks.erase(committed++);
+        block_ready.notify_all();
+      }
+      std::size_t h = 0;
+      for(long k=0; k<(long)blk.channel.size() && nevent<samplesize; k++, trials++){
+        int i = blk.channel[k];
+        trials_list[i]++;
+        if(h<blk.hits.size() && blk.hits[h].first==k)
+          record_trial(i, blk.hits[h++].second);
+      }
+    }
+    {
+      std::lock_guard<std::mutex> lock(block_mutex);
+      stop = true;
+      block_ready.notify_all();
+    }
+    for(auto &w : workers)
+      w.join();
+  }
   else{
     for(; (nevent < samplesize) && ((trials < trials_max)||(trials_max<=0)); trials++){
       int i;
-      scatter_switch = false;
       double vrnd = Random::Flat(0.0,1)*Vnumtot;
       for(i=0; i<chan_count; i++){
         //cout << i << " vrnd=" <<  vrnd << " vs Vnum_list " << Vnum_list[i] <<  endl;
@@ -799,106 +1124,13 @@ int main(int argc, char* argv[]){
       list<Particle> vec;
       Particle dist_part (0);
       PartDist_list[i]->Sample_Particle(dist_part);
-      bool isOther = false;
-      if(DMGen_list[i]->GenDM(vec, det_int, dist_part)){
-        //Yes, this list is named vec.  
-
-        // We create a Particle iterator to go through the particles produced from the decay 
-        for(list<Particle>::iterator iter = vec.begin(); iter != vec.end();iter++){
-          //The way this is structured means I can't do my usual repeat thing to boost stats. 
-          if(isOther){
-            nother+=1;
-            continue;
-          }
-
-          // Check if the particle is DM 
-          if(iter->name.compare(sig_part_name)==0){
-            NDM_list[i]++;
-
-
-
-            /*
-              LM: 
-              This if is used to store in the comprehensive output
-              all the DM particles that cross the detector 
-              I think this is also one of Pawel's additions  
-            */
-            if(outmode=="dm_detector_distribution"){
-              *comprehensive_out << DMGen_list[i]->Channel_Name() << " " << det->Ldet(*iter) << " ";
-              iter->report(*comprehensive_out);
-              scatter_switch=true;
-              isOther = true;
-              continue;
-            }
-
-
-
-            /*
-              LM: 
-              This if is only used if you want to store the DM particles
-              crossing the detector in a root file rather than in
-              the comprehensive output stream 
-            */
-            if(outmode == "root_output" || outmode == "dm_dist_root"){
-              record_root(outtree, vec, nevent, isOther, DMGen_list[i]->Channel_Name(), det);
-              isOther = true;
-              scatter_switch=true;
-              continue;
-            }
-
-
-
-            // This happens regardless of the output mode...
-            // Here we provide a DM particle and the starting particle vector
-            // It increases the number of scatters 
-            if(SigGen->probscatter(det, vec, iter)){
-              scat_list[i]++;
-              if(timing_cut>0){
-                timing_efficiency[i]+=t_delay_fraction(timing_cut,sqrt(pow(iter->end_coords[0],2)+pow(iter->end_coords[1],2)+pow(iter->end_coords[2],2)),iter->Speed());
-              }
-              else{
-                timing_efficiency[i]+=1;
-              }
-              scatter_switch = true;	
-            }
-            
-
-            else{
-              iter = vec.erase(iter);
-              iter--;
-            }
-          }    
-        }
-
-      }
-
-      // This output mode is used to ouput the particles in a text file 
-      // it also increases nevent by one 
-      if(scatter_switch && outmode=="comprehensive"){
-        *comprehensive_out << "event " << ++nevent << endl;
-        Record_Particles(*comprehensive_out, vec);
-        *comprehensive_out << "endevent " << nevent << endl << endl;    
-      }
-      
-
-
-      // If we are in dm_dist_root or dm_detector_distribution
-      // We increase nevent every time a particle intersects with the detector
-      else if(scatter_switch && outmode=="dm_dist_root"){
-
-        ++nevent;
-        if(nevent%100 == 0) std::cout << "Event " << nevent << "/" << samplesize << std::endl;
-
-      }
-
-      else if(scatter_switch && outmode=="dm_detector_distribution"){
-        ++nevent;
-        //if(nevent%100 == 0) std::cout << "Event " << nevent << "/" << samplesize << std::endl;
-      }
-
+      if(DMGen_list[i]->GenDM(vec, det_int, dist_part))
+        record_trial(i, vec);
     } 
   }
   cout << "Run complete\n";
+  if(pmax_key!="" && SigGen->get_pMax()>0)
+    Update_PMax_Cache(pmax_cache, pmax_key, SigGen->get_pMax());
 
 
 
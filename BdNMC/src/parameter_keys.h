@@ -13,6 +13,7 @@ const string angle_lower_limit_key = "min_scatter_angle";
 const string angle_upper_limit_key = "max_scatter_angle";
 const string timing_key = "timing_cut";
 const string scatter_dist_filename_key = "scatter_dist_filename";
+const string pmax_cache_key = "pmax_cache";
 
 const string production_distribution_key = "production_distribution";
 const string particle_list_file_key = "particle_list_file";
@@ -28,6 +29,11 @@ const string zmin_key = "zmin";
 const string zmax_key = "zmax";
 const string part_list_pos_key = "particle_list_position";
 const string part_list_weight_key = "particle_list_weight";
+const string part_list_batch_key = "particle_list_batch_size";
+const string part_list_shard_key = "particle_list_shard";
+const string part_list_shards_key = "particle_list_shards";
+const string part_list_alias_key = "particle_list_alias";
+const string part_list_acceptance_key = "particle_list_acceptance";
 
 const string dist_mod_key = "dist_mod";
 const string pos_offset_key = "position_offset";
@@ -55,9 +61,11 @@ const string efficiency_key = "efficiency";
 const string POTkey = "POT";
 const string pi0_ratio_key = "pi0_per_POT";
 const string burn_in_key = "burn_max";
+const string emission_bias_key = "emission_bias";
 const string burn_timeout_key = "burn_timeout";
 const string repeat_key = "repeat_count";
 const string max_trials_key = "max_trials";
+const string threads_key = "threads";
 const string seed_key = "seed";
 const string p_cross_key = "proton_target_cross_section";
 
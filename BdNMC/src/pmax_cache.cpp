@@ -0,0 +1,93 @@
+#include "pmax_cache.h"
+#include <iostream>
+#include <fstream>
+#include <sstream>
+#include <iomanip>
+#include <vector>
+#include <utility>
+#include <cstdio>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/file.h>
+#include <sys/stat.h>
+
+using std::string;      using std::vector;
+using std::pair;        using std::cerr;
+
+//Reads the entries of a cache file, skipping malformed lines.
+static vector<pair<double, string> > read_entries(const string &file){
+    vector<pair<double, string> > entries;
+    std::ifstream in(file);
+    string line;
+    while(std::getline(in, line)){
+        if(line.empty() || line[0]=='#')
+            continue;
+        std::istringstream ss(line);
+        double pmax;
+        string key;
+        if(!(ss >> pmax) || !std::getline(ss >> std::ws, key))
+            continue;
+        entries.push_back(std::make_pair(pmax, key));
+    }
+    return entries;
+}
+
+bool Read_PMax_Cache(const string &file, const string &key, double &pmax){
+    vector<pair<double, string> > entries = read_entries(file);
+    for(auto &entry : entries){
+        if(entry.second==key && entry.first>0){
+            pmax = entry.first;
+            return true;
+        }
+    }
+    return false;
+}
+
+void Update_PMax_Cache(const string &file, const string &key, double pmax){
+    //Jobs sharing the file take turns, each one merging into what the previous one wrote.
+    string lockfile = file + ".lock";
+    int lock = open(lockfile.c_str(), O_RDWR|O_CREAT, 0664);
+    if(lock<0 || flock(lock, LOCK_EX)!=0){
+        cerr << "Unable to lock pmax_cache file " << lockfile << std::endl;
+        if(lock>=0)
+            close(lock);
+        return;
+    }
+    vector<pair<double, string> > entries = read_entries(file);
+    bool found = false;
+    for(auto &entry : entries){
+        if(entry.second==key){
+            if(pmax>entry.first)
+                entry.first = pmax;
+            found = true;
+        }
+    }
+    if(!found)
+        entries.push_back(std::make_pair(pmax, key));
+    vector<char> tmpname(file.begin(), file.end());
+    const string suffix = ".XXXXXX";
+    tmpname.insert(tmpname.end(), suffix.begin(), suffix.end());
+    tmpname.push_back('\0');
+    int fd = mkstemp(tmpname.data());
+    string tmpfile = tmpname.data();
+    if(fd<0){
+        cerr << "Unable to write pmax_cache file " << tmpfile << std::endl;
+    }
+    else{
+        //mkstemp creates the file readable by its owner only
+        fchmod(fd, 0664);
+        close(fd);
+        std::ofstream out(tmpfile);
+        out << "# pMax followed by the model, detector and channel key\n";
+        out << std::setprecision(17);
+        for(auto &entry : entries)
+            out << entry.first << " " << entry.second << "\n";
+        out.close();
+        if(!out || std::rename(tmpfile.c_str(), file.c_str())!=0){
+            cerr << "Unable to update pmax_cache file " << file << std::endl;
+            std::remove(tmpfile.c_str());
+        }
+    }
+    flock(lock, LOCK_UN);
+    close(lock);
+}
@@ -0,0 +1,17 @@
+#ifndef GUARD_pmax_cache_h
+#define GUARD_pmax_cache_h
+
+#include <string>
+
+//A pMax cache file holds one line per configuration: the pMax found for it,
+//then the key describing the model, detector and channels. Lines starting
+//with # are comments.
+
+//Sets pmax to the cached value for key. Returns false if the file or the key is missing.
+bool Read_PMax_Cache(const std::string &file, const std::string &key, double &pmax);
+//Stores pmax for key, keeping the larger of it and any cached value.
+//The file is read and rewritten under an flock on <file>.lock, through a unique
+//temporary file and a rename, so concurrent jobs neither lose updates nor read a partial file.
+void Update_PMax_Cache(const std::string &file, const std::string &key, double pmax);
+
+#endif
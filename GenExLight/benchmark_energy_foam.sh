@@ -0,0 +1,38 @@
+#!/bin/bash
+# Compares the per-energy foams with the energy-dimension foam (-e) on the
+# same BdNMC input: foam initialization time, events/s and the agreement of
+# the kinematic distributions (compare_foam_modes.C).
+#
+# usage: ./benchmark_energy_foam.sh <bdnmc.root> <xsec.root> <mA> <ratio> <dm_type> [seed]
+
+if [ $# -lt 5 ]; then
+  echo "usage: $0 <bdnmc.root> <xsec.root> <mA> <ratio> <dm_type> [seed]"
+  exit 1
+fi
+
+INPUT=$1
+XSEC=$2
+MASS=$3
+RATIO=$4
+DM_TYPE=$5
+SEED=${6:-900}
+OUTDIR=${OUTDIR:-./benchmark_energy_foam}
+
+mkdir -p ${OUTDIR}
+
+for MODE in per_energy energy_dim; do
+  EXTRA=""
+  if [ "${MODE}" == "energy_dim" ]; then
+    EXTRA="-e"
+  fi
+  echo "======== ${MODE} ========"
+  START=$(date +%s.%N)
+  ./evgen.exe -i ${INPUT} -x ${XSEC} -f root -t ${DM_TYPE} -m ${MASS} -r ${RATIO} -s ${SEED} \
+      -o ${OUTDIR}/hepevt_${MODE} ${EXTRA} > ${OUTDIR}/${MODE}.log
+  END=$(date +%s.%N)
+  grep "Foam cache:\|Energy-dimension foam initialized\|Final number of events\|Generation took" ${OUTDIR}/${MODE}.log
+  echo "Wall time: $(echo "${END} - ${START}" | bc) s"
+done
+
+echo "======== Kinematic distributions ========"
+root -l -b -q "compare_foam_modes.C(\"${OUTDIR}/hepevt_per_energy.root\",\"${OUTDIR}/hepevt_energy_dim.root\",\"${OUTDIR}/compare_foam_modes.pdf\")"
@@ -0,0 +1,38 @@
+#!/bin/bash
+# Runs evgen with every phase space engine (-g) on the same BdNMC input and
+# reports their throughput, integrand calls per event and weight variance,
+# then compares the outgoing e+e- distributions of each engine with the
+# foam engine (compare_foam_modes.C).
+#
+# usage: ./benchmark_engines.sh <bdnmc.root> <xsec.root> <mA> <ratio> <dm_type> [seed]
+
+if [ $# -lt 5 ]; then
+  echo "usage: $0 <bdnmc.root> <xsec.root> <mA> <ratio> <dm_type> [seed]"
+  exit 1
+fi
+
+INPUT=$1
+XSEC=$2
+MASS=$3
+RATIO=$4
+DM_TYPE=$5
+SEED=${6:-900}
+OUTDIR=${OUTDIR:-./benchmark_engines}
+ENGINES="foam rejection weighted"
+
+mkdir -p ${OUTDIR}
+
+for ENGINE in ${ENGINES}; do
+  echo "======== ${ENGINE} ========"
+  ./evgen.exe -i ${INPUT} -x ${XSEC} -f root -t ${DM_TYPE} -m ${MASS} -r ${RATIO} -s ${SEED} \
+      -g ${ENGINE} -o ${OUTDIR}/hepevt_${ENGINE} > ${OUTDIR}/${ENGINE}.log
+  grep "Foam cache:\|Phase space engine\|explored maximum\|Final number of events\|Generation took" ${OUTDIR}/${ENGINE}.log
+done
+
+for ENGINE in ${ENGINES}; do
+  if [ "${ENGINE}" == "foam" ]; then
+    continue
+  fi
+  echo "======== ${ENGINE} vs foam ========"
+  root -l -b -q "compare_foam_modes.C(\"${OUTDIR}/hepevt_foam.root\",\"${OUTDIR}/hepevt_${ENGINE}.root\",\"${OUTDIR}/compare_${ENGINE}.pdf\")"
+done
@@ -42,13 +42,22 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 #include <vector>
 #include <utility>
 #include <queue> 
+#include <map>
+#include <list>
+#include <algorithm>
 //#include <cstdlib>
 #include <unistd.h>
+#include <fcntl.h>
+#include <sys/file.h>
+#include <sys/wait.h>
 #include <sstream>
 #include <stdlib.h> 
+#include <cstdio>
+#include <cstring>
 
 #include <TMath.h>
 #include <TFile.h>
+#include <TKey.h>
 #include <TH1.h>
 #include <TH2.h>
 #include <TCanvas.h>
@@ -60,6 +69,8 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 #include <TLorentzVector.h>
 #include <TDatabasePDG.h>
 #include <TGraph.h>
+#include <TSystem.h>
+#include <TStopwatch.h>
 #include "TTreeReader.h"
 #include "TTreeReaderValue.h"
 
@@ -111,6 +122,15 @@ double mV;
 string dm_type;
 double q2_out;
 
+//verbosity of the printout: errors only, setup and periodic progress
+//reports, or also every generated event and the foam build-up
+enum { kLogSilent = 0, kLogProgress = 1, kLogDebug = 2 };
+int verbosity = kLogProgress;
+ostream null_stream(0);
+
+/// @returns cout if the verbosity is at least level, a stream discarding the output otherwise
+ostream& logs(const int level) { return (verbosity >= level) ? cout : null_stream; }
+
 
 double mel2(const TLorentzVector& pX, const TLorentzVector& pN, const TLorentzVector& pX2, const TLorentzVector& pN2, const TLorentzVector& pV) {
 
@@ -218,6 +238,9 @@ double mel2(const TLorentzVector& pX, const TLorentzVector& pN, const TLorentzVe
 //TDensity DEFINITION
 ////////////////////////////////////////////////////////////////////////
 
+///Number of integrand evaluations, for the phase space engine report
+long density_calls = 0;
+
 ///Class density for Foam
 class TDensity: public TFoamIntegrand 
 {
@@ -233,11 +256,18 @@ class TDensity: public TFoamIntegrand
     Double_t eventWeight;
     Double_t ene;
 
+    ///flux spectrum of the incoming DM, when set the last variable is its energy
+    TH1D * flux;
+
 
   public:
 
     /// Constructor
-    TDensity(double e){ _decay = new TDecay(); ene=e;};
+    TDensity(double e){ _decay = new TDecay(); ene=e; flux=0;};
+
+    /// Constructor for a single foam over the DM energy as well
+    /// @param f spectrum normalized to unit mean over its bins
+    TDensity(TH1D *f){ _decay = new TDecay(); ene=0.; flux=f;};
 
     /// Destructor
     virtual ~TDensity(){ delete _decay; };
@@ -260,6 +290,7 @@ class TDensity: public TFoamIntegrand
 
 Double_t TDensity::Density(int nDim, Double_t *Xarg)
 {	
+  density_calls++;
 
   //setup decaying particle
 
@@ -268,6 +299,19 @@ Double_t TDensity::Density(int nDim, Double_t *Xarg)
   double mB = 40.; 
 
   double eA = ene;
+  int nKin = nDim;
+  double fluxW = 1.;
+  if(flux) {
+    nKin = nDim-1;
+    const double emin = flux->GetXaxis()->GetXmin();
+    const double emax = flux->GetXaxis()->GetXmax();
+    eA = emin + Xarg[nKin]*(emax-emin);
+    fluxW = flux->GetBinContent(flux->GetXaxis()->FindFixBin(eA));
+    if(fluxW <= 0.) {
+      eventWeight = 0.;
+      return 0.;
+    }
+  }
   double mA = mX;
   //double mV = 0.05;
 
@@ -295,7 +339,7 @@ Double_t TDensity::Density(int nDim, Double_t *Xarg)
   }
 
   //put rnd numbers into queue
-  for( int i = 0; i < nDim; i++)
+  for( int i = 0; i < nKin; i++)
   {
     rndQueue.push( Xarg[i] );
   }  
@@ -329,6 +373,7 @@ Double_t TDensity::Density(int nDim, Double_t *Xarg)
   weight *= 1.0; //for now |ME|^2 is unity
 
   weight *= mel2(pb[1],pb[2],pf[1],pf[2],pf[3]);
+  weight *= fluxW;
 
   //convert GeV^-2 to mb if matrix element is in GeV^-2(natural units) - uncomment if needed
   //weight *= 0.3894;
@@ -343,20 +388,17 @@ Double_t TDensity::Density(int nDim, Double_t *Xarg)
 };
 
 
-TFoam* init_foam(const double ene) {
+TFoam* init_foam(TDensity *rho, TRandom *PseRan, Int_t kDim = 3*Nop-4) {
 
-  Int_t  kDim   =     3*Nop-4;   // total dimension
   Int_t  nCells   =     10000;   // Number of Cells
   Int_t  nSampl   =     10000;   // Number of MC events per cell in build-up
   Int_t  nBin     =       8;   // Number of bins in build-up
   Int_t  OptRej   =       1;   // Wted events for OptRej=0; wt=1 for OptRej=1 (default)
   Int_t  OptDrive =       2;   // (D=2) Option, type of Drive =0,1,2 for TrueVol,Sigma,WtMax
   Int_t  EvPerBin =      25;   // Maximum events (equiv.) per bin in buid-up
-  Int_t  Chat     =       1;   // Chat level
+  Int_t  Chat     = verbosity >= kLogDebug;   // Chat level
   //=========================================================
-  TRandom *PseRan   = new TRandom3();  // Create random number generator
   TFoam *foam    = new TFoam("FoamX");   // Create Simulator
-  TDensity    *rho= new TDensity(ene);   //Create density
   PseRan->SetSeed(4357);
   //=========================================================
   //cout<<"*****   Demonstration Program for Foam version "<<FoamX->GetVersion()<<"    *****"<<endl;
@@ -383,31 +425,555 @@ TFoam* init_foam(const double ene) {
   return foam;
 }
 
-map<int,TFoam*> foams;
-
-TFoam *cachefoam = 0;
-double cacheene, cachemv, cachemx, cachedecay;
-TChain *cachet = 0;
-//TTree *newcachet = 0;
-//TFile *newcachef = 0;
-map<double,map<double,map<int,int>>> cachemap;
+// Foams are built per energy bin of the incoming DM, foam_step MeV wide and
+// labelled by the lower edge in MeV. Each bin is evaluated at its centre, or
+// halfway between the threshold and the upper edge for the threshold bin.
+int foam_step = 1;
 
-TFoam *get_foam(const double ene, const string& cachedir) {
+int foam_bin(const double ene) {
   int mev = (int)(ene*1000.+1e-4);
-  TFoam *foam;
-  foam = init_foam((0.001*mev>mX+mV)?0.001*(mev+0.5):0.5*(0.001*(mev+1)+mX+mV));
-  foams[mev] = foam;
-  return foam;
+  return mev - mev%foam_step;
+}
+
+double foam_energy(const int mev) {
+  return (0.001*mev>mX+mV)?0.001*(mev+0.5*foam_step):0.5*(0.001*(mev+foam_step)+mX+mV);
 }
 
+////////////////////////////////////////////////////////////////////////
+//PHASE SPACE ENGINES
+////////////////////////////////////////////////////////////////////////
 
-TGenPhaseSpace *_vdecay = 0;
+///Phase space engine: "foam" (adaptive TFoam, default), "rejection" (flat
+///sampling accepted against the maximum weight found by exploration) or
+///"weighted" (flat sampling, every sample is an event with its weight),
+///the last two as in Helper/TDeacyTRandom*
+string engine_name = "foam";
+
+///Number of flat samples used to find the maximum and mean weight
+const int engine_explore = 100000;
+
+///Counts the generated events, integrand calls and the spread of the
+///sampling weights of all engines, for the final report
+struct TEngineStats
+{
+  long nEvents, nCalls, nOverflow;
+  ///sampling weights relative to the engine envelope or mean, and their number
+  long nSamples;
+  double sumW, sumW2, time;
+
+  TEngineStats(): nEvents(0), nCalls(0), nOverflow(0), nSamples(0), sumW(0.), sumW2(0.), time(0.) {};
+
+  void Report();
+};
+
+void TEngineStats::Report()
+{
+  const double meanW = nSamples ? sumW/nSamples : 0.;
+  const double relVar = meanW > 0. ? sumW2/nSamples/(meanW*meanW) - 1. : 0.;
+  logs(kLogProgress) << "Phase space engine " << engine_name << ": " << nEvents << " events, "
+                     << (nEvents ? double(nCalls)/nEvents : 0.) << " integrand calls per event, "
+                     << "relative weight variance " << relVar << ", "
+                     << (time > 0. ? nEvents/time : 0.) << " events/s" << endl;
+  if(nOverflow) {
+    // the rejection engine undersamples these points, shown at every verbosity
+    cerr << "Warning: " << nOverflow << " phase space samples of the " << engine_name
+         << " engine were above the explored maximum weight, its unweighted events are biased" << endl;
+  }
+}
+
+TEngineStats engine_stats;
+
+///Generates 2->3 phase space points at one DM energy. After MakeEvent the
+///outgoing momenta are in pf[], as after TFoam::MakeEvent
+class TPhaseSpaceEngine
+{
+  public:
+
+    virtual ~TPhaseSpaceEngine(){};
+
+    /// @returns weight of the event relative to the mean, 1 for unweighted engines
+    virtual double MakeEvent() = 0;
+};
+
+///Adaptive TFoam sampling, the weight spread is the one TFoam monitors
+class TFoamEngine: public TPhaseSpaceEngine
+{
+  private:
+
+    TFoam *foam;
+    long nEvents;
+
+  public:
+
+    TFoamEngine(TFoam *f): foam(f), nEvents(0) {};
+
+    /// Adds the weight spread of this foam to engine_stats
+    virtual ~TFoamEngine();
+
+    double MakeEvent();
+};
+
+TFoamEngine::~TFoamEngine()
+{
+  if(!nEvents) return;
+  double aveWt, wtMax, sigma;
+  foam->GetWtParams(0.0005, aveWt, wtMax, sigma);
+  if(aveWt <= 0.) return;
+  // sampling weights relative to their mean, events of this foam counted once each
+  engine_stats.nSamples += nEvents;
+  engine_stats.sumW += nEvents;
+  engine_stats.sumW2 += nEvents*(1. + sigma*sigma/(aveWt*aveWt));
+}
+
+double TFoamEngine::MakeEvent()
+{
+  const long calls = density_calls;
+  TStopwatch sw;
+  foam->MakeEvent();
+  engine_stats.time += sw.RealTime();
+  engine_stats.nCalls += density_calls-calls;
+  engine_stats.nEvents++;
+  nEvents++;
+  return 1.;
+}
+
+///Flat sampling of the phase space variables, either accepted against the
+///maximum weight (rejection) or returned with their weight (weighted)
+class TFlatEngine: public TPhaseSpaceEngine
+{
+  private:
+
+    TDensity *rho;
+    TRandom *ran;
+    bool weighted;
+    double maxWt, meanWt;
+    vector<double> x;
+
+    /// @returns integrand at a flat random point
+    double Sample();
+
+  public:
+
+    /// Explores the integrand to find its maximum and its mean over non-zero points
+    TFlatEngine(TDensity *r, TRandom *pr, const bool w);
+
+    /// @returns false if the exploration found no non-zero weight, MakeEvent cannot sample then
+    bool Valid() const { return maxWt > 0.; }
+
+    double MakeEvent();
+};
+
+TFlatEngine::TFlatEngine(TDensity *r, TRandom *pr, const bool w): rho(r), ran(pr), weighted(w), maxWt(0.), meanWt(0.)
+{
+  x.resize(3*Nop-4);
+  long nonzero = 0;
+  for(int i = 0; i < engine_explore; i++) {
+    const double wt = Sample();
+    if(wt <= 0.) continue;
+    maxWt = std::max(maxWt, wt);
+    meanWt += wt;
+    nonzero++;
+  }
+  if(nonzero) meanWt /= nonzero;
+}
+
+double TFlatEngine::Sample()
+{
+  for(size_t i = 0; i < x.size(); i++) x[i] = ran->Rndm();
+  return rho->Density(x.size(), &x[0]);
+}
+
+double TFlatEngine::MakeEvent()
+{
+  const long calls = density_calls;
+  TStopwatch sw;
+  double wt = 0., rel = 1.;
+  if(weighted) {
+    // zero-weight samples would be empty events, the mean excludes them
+    do { wt = Sample(); } while(wt <= 0.);
+    rel = wt/meanWt;
+    engine_stats.nSamples++;
+    engine_stats.sumW += rel;
+    engine_stats.sumW2 += rel*rel;
+  }
+  else {
+    while(true) {
+      wt = Sample();
+      engine_stats.nSamples++;
+      engine_stats.sumW += wt/maxWt;
+      engine_stats.sumW2 += (wt/maxWt)*(wt/maxWt);
+      if(wt > maxWt) engine_stats.nOverflow++;
+      if(ran->Rndm()*maxWt <= wt) break;
+    }
+  }
+  engine_stats.time += sw.RealTime();
+  engine_stats.nCalls += density_calls-calls;
+  engine_stats.nEvents++;
+  return weighted ? rel : 1.;
+}
+
+////////////////////////////////////////////////////////////////////////
+//FOAM CACHE
+////////////////////////////////////////////////////////////////////////
+
+///Approximate resident size of one initialized foam (10000 cells), in MB
+const double foam_size_mb = 2.5;
+
+///Keeps initialized foams (or the flat engines, if selected) in memory,
+///keyed by MeV energy bin, evicting the least recently used one once the
+///memory cap is reached. Foams are looked up in a prebuilt foam library
+///first, if one is opened. If a cache
+///directory is given, built foams are also written to a ROOT file for the
+///current (mA, ratio, dm_type) so later jobs can read them back. The shared
+///file is only read while running, new foams go to a file of this job that
+///Close merges into a copy of the shared one under a lock and renames into
+///place, so concurrent jobs neither corrupt it nor lose each other's foams.
+class TFoamCache
+{
+  private:
+
+    struct FoamEntry {
+      TPhaseSpaceEngine *engine;
+      ///0 for the flat engines
+      TFoam *foam;
+      TDensity *rho;
+      TRandom *pseran;
+      list<int>::iterator lru;
+    };
+
+    map<int,FoamEntry> entries;
+    ///most recently used bin at the front
+    list<int> lru;
+    size_t maxFoams;
+
+    TFile *diskFile;
+    TFile *libFile;
+    ///shared cache file name, empty without a cache directory
+    string diskName;
+    ///foams built by this job, merged into diskName by Close
+    TFile *jobFile;
+    bool writable;
+    ///reseeds every foam so jobs sharing a cache do not repeat events
+    TRandom3 seeder;
+
+    long nHits, nBuilt, nLoaded, nEvicted;
+    ///time spent initializing foams, in s
+    double buildTime;
+
+    void Evict();
+    TFoam *Load(TFile *file, const string& name);
+    void Store(TFoam *foam, const string& name);
+    bool Merge();
+
+  public:
+
+    TFoamCache(): maxFoams(1), diskFile(0), libFile(0), jobFile(0), writable(false), nHits(0), nBuilt(0), nLoaded(0), nEvicted(0), buildTime(0.) {};
 
-void generate_interaction(const double ene, const TVector3& mom,
-    TLorentzVector& pV, TLorentzVector& pEp, TLorentzVector& pEm, const string& cachedir) {
-    TFoam *foam = get_foam(ene, cachedir);
+    /// @param maxmem memory cap in MB
+    void SetMaxMemory(const double maxmem);
+    void SetSeed(const UInt_t seed){ seeder.SetSeed(seed); };
+    /// Opens the on-disk foam file for the current model point, if it exists
+    /// @param readonly do not store new foams, used by parallel workers
+    bool OpenDisk(const string& cachedir, const bool readonly = false);
+    /// Opens a foam library written by build_foam_library, foams are read on first use
+    bool OpenLibrary(const string& libfile);
 
-    foam->MakeEvent();           
+    /// @returns initialized engine for MeV bin mev
+    TPhaseSpaceEngine *Get(const int mev);
+
+    void Report();
+    /// Frees all foams, merges new ones into the on-disk cache file and closes it
+    void Close();
+};
+
+void TFoamCache::SetMaxMemory(const double maxmem)
+{
+  maxFoams = (maxmem > foam_size_mb) ? (size_t)(maxmem/foam_size_mb) : 1;
+  logs(kLogProgress) << "Foam cache holds up to " << maxFoams << " foams (" << maxmem << " MB)" << endl;
+}
+
+bool TFoamCache::OpenDisk(const string& cachedir, const bool readonly)
+{
+  if(cachedir.empty()) return true;
+  gSystem->mkdir(cachedir.c_str(), true);
+  string fname = Form("%s/foams_%s_mA_%.3f_ratio_%.2f_step_%d.root", cachedir.c_str(), dm_type.c_str(), mV, mX/mV, foam_step);
+  diskName = fname;
+  writable = !readonly;
+  if(gSystem->AccessPathName(fname.c_str())) {
+    logs(kLogProgress) << "No foam cache file " << fname << " to read" << (writable ? ", it is created at the end" : "") << endl;
+    return true;
+  }
+  // keep the current directory, output trees must not end up in the cache file
+  TDirectory::TContext ctx;
+  diskFile = TFile::Open(fname.c_str(), "READ");
+  if(!diskFile || diskFile->IsZombie()) {
+    cerr << "Could not open foam cache file " << fname << endl;
+    diskFile = 0;
+    return false;
+  }
+  logs(kLogProgress) << "Using foam cache file: " << fname << endl;
+  return true;
+}
+
+bool TFoamCache::OpenLibrary(const string& libfile)
+{
+  if(libfile.empty()) return true;
+  TDirectory::TContext ctx;
+  libFile = TFile::Open(libfile.c_str(), "READ");
+  if(!libFile || libFile->IsZombie()) {
+    cerr << "Could not open foam library " << libfile << endl;
+    libFile = 0;
+    return false;
+  }
+  TTree *index = (TTree *)libFile->Get("foam_index");
+  if(!index || index->GetEntries() == 0) {
+    cerr << "Foam library " << libfile << " has no foam_index" << endl;
+    return false;
+  }
+  double lib_mV, lib_mX;
+  int lib_step;
+  std::string *lib_dm = 0;
+  index->SetBranchAddress("mV",&lib_mV);
+  index->SetBranchAddress("mX",&lib_mX);
+  index->SetBranchAddress("step",&lib_step);
+  index->SetBranchAddress("dm_type",&lib_dm);
+  index->GetEntry(0);
+  if(std::abs(lib_mV-mV) > 1e-6 || std::abs(lib_mX-mX) > 1e-6 || *lib_dm != dm_type) {
+    cerr << "Foam library " << libfile << " was built for " << *lib_dm << " mV=" << lib_mV
+         << " mX=" << lib_mX << ", not for this model point" << endl;
+    return false;
+  }
+  if(foam_step != lib_step) {
+    logs(kLogProgress) << "Using foam library energy step of " << lib_step << " MeV" << endl;
+    foam_step = lib_step;
+  }
+  logs(kLogProgress) << "Using foam library: " << libfile << " (" << index->GetEntries() << " foams)" << endl;
+  return true;
+}
+
+TFoam *TFoamCache::Load(TFile *file, const string& name)
+{
+  if(!file) return 0;
+  return (TFoam *)file->Get(name.c_str());
+}
+
+void TFoamCache::Store(TFoam *foam, const string& name)
+{
+  if(!writable) return;
+  TDirectory::TContext ctx;
+  if(!jobFile) {
+    const string fname = Form("%s.%s.%d.tmp", diskName.c_str(), gSystem->HostName(), gSystem->GetPid());
+    jobFile = TFile::Open(fname.c_str(), "RECREATE");
+    if(!jobFile || jobFile->IsZombie()) {
+      cerr << "Could not open foam cache file " << fname << ", new foams are not cached" << endl;
+      jobFile = 0;
+      writable = false;
+      return;
+    }
+  }
+  jobFile->WriteTObject(foam, name.c_str());
+}
+
+bool TFoamCache::Merge()
+{
+  const string jobName = jobFile->GetName();
+  jobFile->Close();
+  jobFile = 0;
+
+  // jobs sharing the cache directory take turns, each merging into what the previous one left
+  const string lockName = diskName + ".lock";
+  const int lock = open(lockName.c_str(), O_RDWR | O_CREAT, 0664);
+  if(lock < 0 || flock(lock, LOCK_EX) != 0) {
+    cerr << "Could not lock " << lockName << ", new foams are left in " << jobName << endl;
+    if(lock >= 0) close(lock);
+    return false;
+  }
+
+  TDirectory::TContext ctx;
+  const string mergedName = jobName + ".merge";
+  bool ok = gSystem->AccessPathName(diskName.c_str()) || gSystem->CopyFile(diskName.c_str(), mergedName.c_str(), kTRUE) == 0;
+  TFile *merged = ok ? TFile::Open(mergedName.c_str(), "UPDATE") : 0;
+  TFile *job = TFile::Open(jobName.c_str(), "READ");
+  ok = merged && !merged->IsZombie() && job && !job->IsZombie();
+  int added = 0;
+  if(ok) {
+    TIter next(job->GetListOfKeys());
+    while(TKey *key = (TKey *)next()) {
+      if(merged->GetListOfKeys()->FindObject(key->GetName())) continue;
+      TObject *foam = key->ReadObj();
+      merged->WriteTObject(foam, key->GetName());
+      delete foam;
+      added++;
+    }
+    merged->Close();
+    // readers that already opened the old file keep reading it
+    ok = rename(mergedName.c_str(), diskName.c_str()) == 0;
+  }
+  if(job) job->Close();
+  if(ok) {
+    gSystem->Unlink(jobName.c_str());
+    logs(kLogProgress) << "Added " << added << " foams to foam cache file " << diskName << endl;
+  }
+  else {
+    gSystem->Unlink(mergedName.c_str());
+    cerr << "Could not merge new foams into " << diskName << ", they are left in " << jobName << endl;
+  }
+  flock(lock, LOCK_UN);
+  close(lock);
+  return ok;
+}
+
+void TFoamCache::Evict()
+{
+  int mev = lru.back();
+  FoamEntry &e = entries[mev];
+  delete e.engine;
+  delete e.foam;
+  delete e.rho;
+  delete e.pseran;
+  entries.erase(mev);
+  lru.pop_back();
+  nEvicted++;
+}
+
+TPhaseSpaceEngine *TFoamCache::Get(const int mev)
+{
+  map<int,FoamEntry>::iterator it = entries.find(mev);
+  if(it != entries.end()) {
+    lru.splice(lru.begin(), lru, it->second.lru);
+    nHits++;
+    return it->second.engine;
+  }
+
+  while(entries.size() >= maxFoams) Evict();
+
+  FoamEntry e;
+  e.rho = new TDensity(foam_energy(mev));
+  e.foam = 0;
+  const string name = Form("foam_%d", mev);
+  if(engine_name == "foam") {
+    e.foam = Load(libFile, name);
+    if(!e.foam) e.foam = Load(diskFile, name);
+    if(!e.foam) e.foam = Load(jobFile, name);
+  }
+  if(engine_name != "foam") {
+    e.pseran = new TRandom3();
+    TStopwatch sw;
+    TFlatEngine *flat = new TFlatEngine(e.rho, e.pseran, engine_name == "weighted");
+    buildTime += sw.RealTime();
+    nBuilt++;
+    if(!flat->Valid()) {
+      // rejection would never accept and weights would be divided by zero
+      cerr << "The " << engine_name << " engine found no non-zero phase space weight in " << engine_explore
+           << " samples of the " << mev << " MeV bin (E = " << foam_energy(mev) << " GeV), use -g foam" << endl;
+      exit(EXIT_FAILURE);
+    }
+    e.engine = flat;
+  }
+  else if(e.foam) {
+    // the integrand is not persistent, attach a fresh one
+    e.foam->SetRho(e.rho);
+    e.pseran = e.foam->GetPseRan();
+    nLoaded++;
+  }
+  else {
+    e.pseran = new TRandom3();
+    TStopwatch sw;
+    e.foam = init_foam(e.rho, e.pseran);
+    buildTime += sw.RealTime();
+    nBuilt++;
+    Store(e.foam, name);
+  }
+  if(e.foam) e.engine = new TFoamEngine(e.foam);
+  e.pseran->SetSeed(seeder.Integer(kMaxUInt-1)+1);
+
+  lru.push_front(mev);
+  e.lru = lru.begin();
+  entries[mev] = e;
+  return e.engine;
+}
+
+void TFoamCache::Report()
+{
+  logs(kLogProgress) << "Foam cache: " << nBuilt << " built, " << nLoaded << " loaded from library/disk, "
+       << nHits << " hits, " << nEvicted << " evicted, " << buildTime << " s initializing" << endl;
+}
+
+void TFoamCache::Close()
+{
+  while(!entries.empty()) Evict();
+  if(diskFile) {
+    diskFile->Close();
+    diskFile = 0;
+  }
+  if(jobFile) Merge();
+  if(libFile) {
+    libFile->Close();
+    libFile = 0;
+  }
+}
+
+TFoamCache foam_cache;
+
+TPhaseSpaceEngine *get_engine(const double ene) {
+  return foam_cache.Get(foam_bin(ene));
+}
+
+// Single foam over the phase space and the incoming DM energy, so a whole
+// input file is generated from one initialization. The energy is sampled
+// from spectrum times the cross section.
+TFoam *init_energy_foam(TH1D *spectrum, TRandom *PseRan) {
+  TDensity *rho = new TDensity(spectrum);
+  return init_foam(rho, PseRan, 3*Nop-3);
+}
+
+// Builds the foams of every energy bin from threshold up to maxE and writes
+// them to one file, with a foam_index tree listing the bins and model point.
+int build_foam_library(const string& libfile, const double maxE) {
+  TFile *lf = new TFile(libfile.c_str(), "RECREATE");
+  if(!lf->IsOpen()) {
+    cerr << "Unable to open foam library file: " << libfile << endl;
+    return -1;
+  }
+  int bin, step = foam_step;
+  double ene, lib_mV = mV, lib_mX = mX;
+  std::string lib_dm = dm_type;
+  TTree *index = new TTree("foam_index","Energy bins of the foams in this library");
+  index->Branch("bin",&bin);
+  index->Branch("ene",&ene);
+  index->Branch("mV",&lib_mV);
+  index->Branch("mX",&lib_mX);
+  index->Branch("step",&step);
+  index->Branch("dm_type",&lib_dm);
+
+  const int first = foam_bin(mX+mV), last = foam_bin(maxE);
+  logs(kLogProgress) << "Building foam library " << libfile << ": " << (last-first)/foam_step+1
+       << " foams from " << first << " to " << last << " MeV" << endl;
+  for(bin = first; bin <= last; bin += foam_step) {
+    ene = foam_energy(bin);
+    TDensity *rho = new TDensity(ene);
+    TRandom *pseran = new TRandom3();
+    TFoam *foam = init_foam(rho, pseran);
+    lf->WriteTObject(foam, Form("foam_%d", bin));
+    index->Fill();
+    logs(kLogProgress) << "Foam for bin " << bin << " MeV (E = " << ene << " GeV) done" << endl;
+    delete foam;
+    delete rho;
+    delete pseran;
+  }
+  lf->cd();
+  index->Write();
+  lf->Close();
+  return 0;
+}
+
+
+TGenPhaseSpace *_vdecay = 0;
+
+// Decays the dark photon of the last foam event and rotates the
+// products along the incoming DM momentum
+void generate_interaction(const TVector3& mom,
+    TLorentzVector& pV, TLorentzVector& pEp, TLorentzVector& pEm) {
 
     double mass[Ndp] = {0.000511,0.000511};
     _vdecay->SetDecay(pf[3], Ndp, mass);
@@ -442,78 +1008,324 @@ TGraph* get_xsec(const string& file) {
   return g;
 }
 
+////////////////////////////////////////////////////////////////////////
+//CROSS SECTION TABLE
+////////////////////////////////////////////////////////////////////////
+
+///Number of grid points of the cross section table
+const int xsec_table_points = 100000;
+///Largest relative deviation from the TGraph accepted without a warning
+const double xsec_table_tolerance = 1e-3;
+///Energies at which the table is checked against the TGraph at startup,
+///ten per grid point with debug verbosity
+const int xsec_table_check_samples = 10000;
+
+///Cross section tabulated on a uniform energy grid, so a lookup is an index
+///computation and a linear interpolation instead of a search through gxsec
+class TXsecTable
+{
+  private:
+
+    vector<double> val;
+    double emin, emax, invStep;
+    ///used outside the tabulated range
+    TGraph *graph;
+
+  public:
+
+    /// @param npoints number of grid points between the first and last graph point
+    TXsecTable(TGraph *g, const int npoints);
+
+    /// @returns cross section at ene
+    double Eval(const double ene) const {
+      if(ene < emin || ene >= emax) return graph->Eval(ene);
+      const double x = (ene-emin)*invStep;
+      const int i = std::min((int)x, (int)val.size()-2);
+      return val[i] + (x-i)*(val[i+1]-val[i]);
+    };
+
+    /// @returns largest relative deviation from the TGraph over nsamples energies
+    double Check(const int nsamples) const;
+};
+
+TXsecTable::TXsecTable(TGraph *g, const int npoints): graph(g)
+{
+  double dummy;
+  g->ComputeRange(emin,dummy,emax,dummy);
+  invStep = (npoints-1)/(emax-emin);
+  val.resize(npoints);
+  for(int i = 0; i < npoints; i++) {
+    val[i] = g->Eval(emin + i/invStep);
+  }
+}
+
+double TXsecTable::Check(const int nsamples) const
+{
+  double maxdev = 0.;
+  for(int i = 0; i < nsamples; i++) {
+    // offset so the samples fall between grid points
+    const double ene = emin + (i+0.37)*(emax-emin)/nsamples;
+    const double ref = graph->Eval(ene);
+    if(ref == 0.) continue;
+    maxdev = std::max(maxdev, std::abs(Eval(ene)-ref)/std::abs(ref));
+  }
+  return maxdev;
+}
+
+
+
+///Width of the energy strata of the stratified output mode, in GeV
+const double stratum_width = 0.1;
+
+////////////////////////////////////////////////////////////////////////
+//HEPEVT OUTPUT
+////////////////////////////////////////////////////////////////////////
 
+///Size of the hepevt output buffer
+const size_t hepevt_buffer_size = 1 << 20;
 
-void DumpHepevt(TTree *out_tree, string &file){
-  // Here we dump all the information in to a hepevt file, including POT per event. 
-  // TLorentzVector pointer should point to something, don't know why 
+///Writes the hepevt records while events are generated, through a large
+///stdio buffer or, if compression is asked for, piped to gzip or zstd
+class THepevtWriter
+{
+  private:
+
+    FILE *out;
+    ///true if out is a pipe to a compressor
+    bool piped;
+    ///append the event normalization to the event line (weighted outputs)
+    bool withNorm;
+    ///write the POT as a fixed width placeholder that SetPot overwrites
+    bool potPlaceholder;
+    string fname;
+    ///bytes written so far, and the offsets of the POT fields
+    long written;
+    vector<long> potOffsets;
+
+  public:
+
+    THepevtWriter(): out(0), piped(false), withNorm(false), potPlaceholder(false), written(0) {};
+
+    void SetWithNorm(const bool w){ withNorm = w; };
+    void SetPotPlaceholder(const bool p){ potPlaceholder = p; };
+
+    /// @returns name of the hepevt file written for output name file
+    static string FileName(const string& file, const string& compression) {
+      return file + ".txt" + (compression.empty() ? "" : "." + compression);
+    };
+
+    /// @param compression "" for plain text, "gz" or "zst"
+    bool Open(const string& file, const string& compression);
+
+    /// Writes one event, the DM line first, then the dark photon, e+ and e-
+    void Write(const int ievt, const string& name, const int origin_id, const double pot, const double q2,
+               const double norm, const TLorentzVector& xmom, const TLorentzVector& orig, const TLorentzVector& dgam,
+               const TLorentzVector& epos, const TLorentzVector& eneg, const TLorentzVector& vtx);
+
+    /// Sets the POT per event of the events written with a placeholder, after Close.
+    /// Plain text files are patched in place, the value of compressed files is
+    /// written to the file name followed by .pot
+    bool SetPot(const double pot);
+
+    /// Copies the events of a hepevt file, numbering them from first
+    /// @param pot if not negative, replaces the POT per event of the event lines
+    /// @returns number of events copied, -1 if the file could not be read
+    int Append(const string& file, const string& compression, const int first, const double pot = -1.);
+
+    void Close();
+};
+
+bool THepevtWriter::Open(const string& file, const string& compression)
+{
+  fname = FileName(file, compression);
+  if(compression.empty()) {
+    out = fopen(fname.c_str(), "w");
+  }
+  else if(compression == "gz" || compression == "zst") {
+    const string cmd = (compression == "gz" ? "gzip -c > '" : "zstd -q -c > '") + fname + "'";
+    out = popen(cmd.c_str(), "w");
+    piped = true;
+  }
+  else {
+    cerr << "Unknown hepevt compression: " << compression << endl;
+    return false;
+  }
+  if(!out) {
+    cerr << "Unable to open hepevt file: " << fname << endl;
+    return false;
+  }
+  setvbuf(out, 0, _IOFBF, hepevt_buffer_size);
+  logs(kLogProgress) << "Writing hepevt file: " << fname << endl;
+  return true;
+}
+
+void THepevtWriter::Write(const int ievt, const string& name, const int origin_id, const double pot, const double q2,
+    const double norm, const TLorentzVector& xmom, const TLorentzVector& orig, const TLorentzVector& dgam,
+    const TLorentzVector& epos, const TLorentzVector& eneg, const TLorentzVector& vtx)
+{
   const double cm = 100.;
-  TLorentzVector *vtx = 0;
-  TLorentzVector *xmom = 0;
-  TLorentzVector *dgam = 0;
-  TLorentzVector *eneg = 0;
-  TLorentzVector *epos = 0;
-  TLorentzVector *orig = 0 ;
-  TLorentzVector *inX_pr = 0;
-  TLorentzVector *vV_pr = 0;
-  TLorentzVector *outE_pr = 0;
-  TLorentzVector *outP_pr = 0;
-  TLorentzVector *intpos_pr = 0;
-  Double_t out_q2, w, out_pot;
-  Int_t origin_id; 
-  std::string *name = 0;
-
-  out_tree->SetBranchAddress("evt_weight",&w);
-  out_tree->SetBranchAddress("vtx",&vtx);
-  out_tree->SetBranchAddress("inX",&xmom);
-  out_tree->SetBranchAddress("origin",&orig);
-  out_tree->SetBranchAddress("origin_id",&origin_id);
-  out_tree->SetBranchAddress("vV",&dgam);
-
-  // These two are swapped, for some reason...
-  out_tree->SetBranchAddress("outE",&epos);
-  out_tree->SetBranchAddress("outP",&eneg);
-
-  out_tree->SetBranchAddress("vtx_pr",&intpos_pr);
-  out_tree->SetBranchAddress("inX_pr",&inX_pr);
-  out_tree->SetBranchAddress("vV_pr",&vV_pr);
-  out_tree->SetBranchAddress("outE_pr",&outP_pr);
-  out_tree->SetBranchAddress("outP_pr",&outE_pr);
-  out_tree->SetBranchAddress("q2",&out_q2);
-  out_tree->SetBranchAddress("origin_name",&name);
-  out_tree->SetBranchAddress("total_pot",&out_pot);
-
-  ofstream outputFile;
-  cout << "Writing hepevt file: " << file + ".txt" << endl; 
-  outputFile.open((file+".txt").c_str());
-  Int_t n_entries = (Int_t) out_tree->GetEntries();
-  Double_t tree_weight = (Double_t) out_tree ->GetWeight(); 
-  cout << "Number of entries: " << n_entries << endl; 
-
-  for(Int_t ievt = 0; ievt < n_entries; ievt++){
-      out_tree->GetEntry(ievt);
-      outputFile << ievt << " " << 4 << " " << *name << " " << origin_id << " " << (out_pot/n_entries)/tree_weight << " " << out_q2 << endl; 
-       //    status      pdg         mother1     mother2     daugher1  daughter2
-      outputFile << 2 << " " << 41 << " " << 0 << " " << 0 << " " << 2 <<" "<< 2 << " "
-		 << xmom->X() <<" " << xmom->Y() << " " << xmom->Z() <<" " << xmom->T() <<" "<< xmom->M() <<" "
-		 << orig->X() * cm << " " << orig->Y() * cm << " " << orig->Z() * cm << " " << orig->T() <<endl;
-      outputFile << 2 << " " << 80 << " " << 1 << " " << 1 << " " << 3 <<" "<< 4 << " "
-		 << dgam->X() <<" " << dgam->Y() << " " << dgam->Z() <<" " <<dgam->E() <<" "<< dgam->M()  <<" "
-		 << vtx->X() * cm << " " << vtx->Y() * cm << " " << vtx->Z() * cm << " " << vtx->T() <<endl;
-      outputFile << 1 << " " << -11 << " " << 2 << " " << 2 << " " << 0 <<" "<< 0 << " "
-		 << epos->X() <<" " << epos->Y() << " " << epos->Z() <<" " <<epos->E() <<" "<< epos->M()  <<" "
-		 << vtx->X() * cm << " " << vtx->Y() * cm << " " << vtx->Z() * cm << " " << vtx->T() <<endl;
-      outputFile << 1 << " " << 11 << " " << 2 << " " << 2 << " " << 0 <<" "<< 0 << " "
-		 << eneg->X() <<" " << eneg->Y() << " " << eneg->Z() <<" " <<eneg->E() <<" "<< eneg->M()  <<" "
-		 << vtx->X() * cm << " " << vtx->Y() * cm << " " << vtx->Z() * cm << " " << vtx->T() <<endl;
+  if(withNorm) written += fprintf(out, "%d 4 %s %d %g %g %g\n", ievt, name.c_str(), origin_id, pot, q2, norm);
+  else if(potPlaceholder) {
+    written += fprintf(out, "%d 4 %s %d ", ievt, name.c_str(), origin_id);
+    potOffsets.push_back(written);
+    written += fprintf(out, "%.6e %g\n", pot, q2);
+  }
+  else written += fprintf(out, "%d 4 %s %d %g %g\n", ievt, name.c_str(), origin_id, pot, q2);
+  //           status pdg mother1 mother2 daughter1 daughter2
+  written += fprintf(out, "2 41 0 0 2 2 %g %g %g %g %g %g %g %g %g\n",
+          xmom.X(), xmom.Y(), xmom.Z(), xmom.T(), xmom.M(), orig.X()*cm, orig.Y()*cm, orig.Z()*cm, orig.T());
+  written += fprintf(out, "2 80 1 1 3 4 %g %g %g %g %g %g %g %g %g\n",
+          dgam.X(), dgam.Y(), dgam.Z(), dgam.E(), dgam.M(), vtx.X()*cm, vtx.Y()*cm, vtx.Z()*cm, vtx.T());
+  written += fprintf(out, "1 -11 2 2 0 0 %g %g %g %g %g %g %g %g %g\n",
+          epos.X(), epos.Y(), epos.Z(), epos.E(), epos.M(), vtx.X()*cm, vtx.Y()*cm, vtx.Z()*cm, vtx.T());
+  written += fprintf(out, "1 11 2 2 0 0 %g %g %g %g %g %g %g %g %g\n",
+          eneg.X(), eneg.Y(), eneg.Z(), eneg.E(), eneg.M(), vtx.X()*cm, vtx.Y()*cm, vtx.Z()*cm, vtx.T());
+}
+
+bool THepevtWriter::SetPot(const double pot)
+{
+  if(potOffsets.empty()) return true;
+  char field[32];
+  const int width = snprintf(field, sizeof(field), "%.6e", pot);
+  // the placeholder has the width of the expected POT, the same unless the exponent gains a digit
+  char placeholder[32];
+  FILE *f = piped ? 0 : fopen(fname.c_str(), "r+");
+  bool patch = f && fseek(f, potOffsets[0], SEEK_SET) == 0 && fread(placeholder, 1, width+1, f) == (size_t)width+1
+               && placeholder[width] == ' ';
+  if(patch) {
+    for(size_t i = 0; i < potOffsets.size() && patch; i++) {
+      patch = fseek(f, potOffsets[i], SEEK_SET) == 0 && fwrite(field, 1, width, f) == (size_t)width;
+    }
+    patch = (fclose(f) == 0) && patch;
+    if(!patch) cerr << "Unable to set the POT per event in " << fname << endl;
+    return patch;
   }
-  outputFile.close();
+  if(f) fclose(f);
+  // compressed outputs cannot be patched, the POT per event goes next to them,
+  // and so does a value wider than the placeholder
+  const string potname = fname + ".pot";
+  FILE *potfile = fopen(potname.c_str(), "w");
+  if(!potfile) {
+    cerr << "Unable to write " << potname << endl;
+    return false;
+  }
+  fprintf(potfile, "%g\n", pot);
+  fclose(potfile);
+  logs(kLogProgress) << "POT per event of " << fname << " written to " << potname << endl;
+  return true;
+}
+
+int THepevtWriter::Append(const string& file, const string& compression, const int first, const double pot)
+{
+  const string fname = FileName(file, compression);
+  FILE *in = 0;
+  if(compression.empty()) in = fopen(fname.c_str(), "r");
+  else in = popen(((compression == "gz" ? "gzip -dc '" : "zstd -q -dc '") + fname + "'").c_str(), "r");
+  if(!in) return -1;
+
+  // every event is one header line followed by four particle lines
+  char line[1024];
+  int nlines = 0;
+  while(fgets(line, sizeof(line), in)) {
+    if(nlines%5 == 0) {
+      const char *rest = strchr(line, ' ');
+      // the POT is the fifth field: number, 4, name, origin id, POT
+      const char *potField = rest;
+      for(int i = 0; i < 3 && potField; i++) potField = strchr(potField+1, ' ');
+      const char *afterPot = potField ? strchr(potField+1, ' ') : 0;
+      if(pot >= 0. && afterPot) {
+        fprintf(out, "%d%.*s %g%s", first + nlines/5, (int)(potField-rest), rest, pot, afterPot);
+      }
+      else {
+        fprintf(out, "%d%s", first + nlines/5, rest ? rest : "\n");
+      }
+    }
+    else {
+      fputs(line, out);
+    }
+    nlines++;
+  }
+  if(compression.empty()) fclose(in);
+  else pclose(in);
+  return nlines/5;
+}
+
+void THepevtWriter::Close()
+{
+  if(!out) return;
+  if(piped) pclose(out);
+  else fclose(out);
+  out = 0;
+}
+
 
+string worker_output(const string& outf, const int worker) {
+  return outf + Form("_part%d", worker);
 }
 
+// Waits for the worker processes of a parallel run and merges their event
+// trees and hepevt files, in worker order, into the final output. Unless
+// weighted, the hepevt POT per event is set from the merged number of events.
+int merge_workers(string &outf, const int nworkers, const vector<pid_t>& pids, const string& compression, const bool weighted) {
+  int failed = 0;
+  for(size_t k = 0; k < pids.size(); k++) {
+    int status;
+    waitpid(pids[k], &status, 0);
+    if(!WIFEXITED(status) || WEXITSTATUS(status) != 0) {
+      cerr << "Worker " << k << " failed" << endl;
+      failed++;
+    }
+  }
+  if(failed) {
+    cerr << failed << " of " << nworkers << " workers failed, partial outputs are kept" << endl;
+    return -1;
+  }
 
+  TChain chain("event_tree");
+  for(int k = 0; k < nworkers; k++) {
+    chain.Add((worker_output(outf, k)+".root").c_str());
+  }
+  chain.LoadTree(0);
+  // all workers share maxW, hence the weight of their trees
+  const double tree_weight = chain.GetTree()->GetWeight();
+
+  double pot = -1.;
+  if(!weighted && chain.GetEntries() > 0) {
+    Double_t total_pot;
+    chain.SetBranchAddress("total_pot", &total_pot);
+    chain.GetEntry(0);
+    chain.ResetBranchAddresses();
+    pot = total_pot/chain.GetEntries()/tree_weight;
+  }
 
+  TFile *of = new TFile((outf+".root").c_str(), "RECREATE");
+  TTree *ot = chain.CloneTree(-1, "fast");
+  ot->SetWeight(tree_weight);
+  logs(kLogProgress) << "Merged " << ot->GetEntries() << " events from " << nworkers << " workers" << endl;
+  of->cd();
+  ot->Write();
+  of->Close();
+
+  THepevtWriter hepevt;
+  if(!hepevt.Open(outf, compression)) return -1;
+  int nevt = 0;
+  for(int k = 0; k < nworkers; k++) {
+    const int n = hepevt.Append(worker_output(outf, k), compression, nevt, pot);
+    if(n < 0) {
+      cerr << "Unable to read the hepevt output of worker " << k << endl;
+      hepevt.Close();
+      return -1;
+    }
+    nevt += n;
+  }
+  hepevt.Close();
 
+  for(int k = 0; k < nworkers; k++) {
+    gSystem->Unlink((worker_output(outf, k)+".root").c_str());
+    gSystem->Unlink(THepevtWriter::FileName(worker_output(outf, k), compression).c_str());
+  }
+  return 0;
+}
 
 
 int main(int argc, char** argv)
@@ -522,7 +1334,15 @@ int main(int argc, char** argv)
   //inegral, its error and mc weight
   string infn = "";
   string xsecdir = "";
-  string cachedir = "cache";
+  string cachedir = ""; // no on-disk foam cache by default
+  double maxmem = 1024.; // memory cap of the foam cache in MB
+  string libfile = ""; // prebuilt foam library
+  bool build_library = false;
+  double emax = -1.; // overrides the maximum DM energy of the input
+  bool energy_foam = false; // one foam with the DM energy as a dimension
+  int nworkers = 1; // number of worker processes
+  string compression = ""; // hepevt compression, gz or zst
+  string output_mode = "unweighted"; // unweighted, weighted or stratified events
   string outf = "";
   string outn = "";
   string inputmode = "txt"; // Default input mode: txt 
@@ -534,7 +1354,7 @@ int main(int argc, char** argv)
   int seed = -1;
 
   char c;
-  while((c = getopt(argc, argv, "i:x:c:o:s:f:t:m:r:")) != -1) {
+  while((c = getopt(argc, argv, "i:x:c:M:L:Bb:E:ej:v:z:w:g:o:s:f:t:m:r:")) != -1) {
     switch(c) {
       case 'i':
         infn = optarg; // input files
@@ -545,6 +1365,39 @@ int main(int argc, char** argv)
       case 'c':
         cachedir = optarg; // cache directory 
         break;
+      case 'M':
+        std::istringstream(optarg) >> maxmem; // foam cache memory cap (MB)
+        break;
+      case 'L':
+        libfile = optarg; // foam library
+        break;
+      case 'B':
+        build_library = true; // write the foam library given with -L and exit
+        break;
+      case 'b':
+        std::istringstream(optarg) >> foam_step; // foam energy bin width (MeV)
+        break;
+      case 'E':
+        std::istringstream(optarg) >> emax; // maximum DM energy (GeV)
+        break;
+      case 'e':
+        energy_foam = true; // single foam over DM energy and phase space
+        break;
+      case 'j':
+        std::istringstream(optarg) >> nworkers; // number of worker processes
+        break;
+      case 'v':
+        std::istringstream(optarg) >> verbosity; // 0 silent, 1 progress, 2 debug (every event)
+        break;
+      case 'z':
+        compression = optarg; // compress the hepevt output (gz or zst)
+        break;
+      case 'w':
+        output_mode = optarg; // unweighted, weighted or stratified events
+        break;
+      case 'g':
+        engine_name = optarg; // phase space engine: foam, rejection or weighted
+        break;
       case 'o':
         outf = optarg;  // output file 
         break;
@@ -565,17 +1418,75 @@ int main(int argc, char** argv)
     }
   }
   
-  if(infn.empty()||xsecdir.empty()) {
+  if(build_library) {
+    if(libfile.empty()||(infn.empty()&&emax<=0)) {
+      cerr << "Need to supply a library file and an input file or maximum energy" << endl;
+      return -1;
+    }
+  }
+  else if(infn.empty()||xsecdir.empty()) {
     cerr << "Need to supply input file " << endl;
     return -1;
   }
+  if(foam_step < 1) {
+    cerr << "Foam energy step must be at least 1 MeV" << endl;
+    return -1;
+  }
+  if(nworkers < 1) {
+    cerr << "Need at least one worker process" << endl;
+    return -1;
+  }
+  if(output_mode != "unweighted" && output_mode != "weighted" && output_mode != "stratified") {
+    cerr << "Unknown output mode: " << output_mode << endl;
+    return -1;
+  }
+  if(engine_name != "foam" && engine_name != "rejection" && engine_name != "weighted") {
+    cerr << "Unknown phase space engine: " << engine_name << endl;
+    return -1;
+  }
+  if((energy_foam || build_library) && engine_name != "foam") {
+    cerr << "The energy-dimension foam and the foam library need the foam engine" << endl;
+    return -1;
+  }
+  if(energy_foam && output_mode != "unweighted") {
+    cerr << "The energy-dimension foam only produces unweighted events" << endl;
+    return -1;
+  }
+
+  // Parallel mode: fork before any file is opened. Each worker runs the rest
+  // of main on its share of the input with its own foams and random streams,
+  // seeded from -s, and writes a partial output that the parent merges.
+  int worker = -1;
+  const string final_outf = outf;
+  if(nworkers > 1 && !build_library) {
+    TRandom3 seeder(seed);
+    vector<pid_t> pids;
+    for(int k = 0; k < nworkers; k++) {
+      const int wseed = seeder.Integer(1000000000)+1;
+      pid_t pid = fork();
+      if(pid < 0) {
+        cerr << "Unable to start worker " << k << endl;
+        return -1;
+      }
+      if(pid == 0) {
+        worker = k;
+        seed = wseed;
+        outf = worker_output(final_outf, k);
+        break;
+      }
+      pids.push_back(pid);
+    }
+    if(worker < 0) {
+      return merge_workers(outf, nworkers, pids, compression, output_mode != "unweighted" || engine_name == "weighted");
+    }
+  }
 
   mX = stod(ratio) * stod(mass);
   mV = stod(mass);
   dm_type = dm;
-  cout << "Dark matter type: " << dm_type << endl; 
-  cout << "Dark photon mass: " << mass << endl;
-  cout << "Dark sector mass ratio: " << ratio << endl; 
+  logs(kLogProgress) << "Dark matter type: " << dm_type << endl; 
+  logs(kLogProgress) << "Dark photon mass: " << mass << endl;
+  logs(kLogProgress) << "Dark sector mass ratio: " << ratio << endl; 
 
   TTree *intree = new TTree;
   double ene, len, L1, px, py, pz, vx, vy, vz, vt, impwt, maxE;
@@ -583,9 +1494,13 @@ int main(int argc, char** argv)
   Int_t origin_id;
   TTree *pot_tree = new TTree;
   double tot_pot, pot_per_event;
-  double pot_final; 
+  double pot_final = 0.; 
 
-  if(inputmode=="txt"){
+  if(infn.empty()){
+    maxE = emax;
+  }
+
+  else if(inputmode=="txt"){
     intree->ReadFile(infn.c_str(),"pi0/C:L/D:pname/C:w/D:E:px:py:pz:m:vx:vy:vz:vt:ex:ey:ez:et:L1:L2:id/L");
     intree->SetBranchAddress("E",&ene);
     intree->SetBranchAddress("L",&len);
@@ -619,13 +1534,19 @@ int main(int argc, char** argv)
     intree->SetBranchAddress("dm_origin_t0",&vt);
     intree->SetBranchAddress("channel_name", &name);
     intree->SetBranchAddress("id",&origin_id);
-    maxE = intree->GetMaximum("dm1_energy");
+    maxE = intree->GetMaximum("dm_energy");
     pot_tree = (TTree *)fin->Get("pot_tree");
     pot_tree->SetBranchAddress("tot_pot",&tot_pot);
     pot_tree->GetEntry(0);
     //delete fin; 
   }
 
+  if(emax > 0) maxE = emax;
+
+  if(build_library) {
+    return build_foam_library(libfile, maxE);
+  }
+
   TGraph *xsec = get_xsec(xsecdir);
   if(!xsec) {
     cerr << "Failed to make xsec" << endl;
@@ -640,33 +1561,100 @@ int main(int argc, char** argv)
     return -1;
   }
 
+  const TXsecTable xsec_table(xsec, xsec_table_points);
+  const int xsec_check_samples = verbosity >= kLogDebug ? 10*xsec_table_points : xsec_table_check_samples;
+  const double xsec_dev = xsec_table.Check(xsec_check_samples);
+  logs(kLogProgress) << "Cross section table: " << xsec_table_points << " points, max relative deviation from gxsec "
+       << xsec_dev << " over " << xsec_check_samples << " energies" << endl;
+  if(xsec_dev > xsec_table_tolerance) {
+    cout << "Warning: cross section table deviates from gxsec by more than " << xsec_table_tolerance << endl;
+  }
+
+
+
+  // In energy-dimension mode the spectrum is binned foam_step MeV wide above
+  // threshold, and the entries of each bin are kept to attach the foam events to
+  TH1D *spectrum = 0;
+  vector<vector<int> > bin_entries;
+  vector<vector<double> > bin_cumw;
+  if(energy_foam) {
+    const double elo = mX+mV;
+    const int nbins = std::max(1, (int)std::ceil((maxE-elo)*1000./foam_step));
+    spectrum = new TH1D("dm_spectrum","DM flux above threshold;E [GeV]",nbins,elo,elo+0.001*nbins*foam_step);
+    spectrum->SetDirectory(0);
+    bin_entries.resize(nbins+2);
+    bin_cumw.resize(nbins+2);
+  }
+
+  // Single pass over the input: only the branches entering the weight are
+  // read, and the weights are kept so the accept loop reads back just the
+  // accepted entries. Entries below threshold are marked with a negative weight.
+  const long nEntries = intree->GetEntries();
+  vector<double> weights(nEntries, -1.);
+  intree->SetBranchStatus("*",0);
+  if(inputmode=="root") {
+    intree->SetBranchStatus("dm_energy",1);
+    intree->SetBranchStatus("dm_weight",1);
+    intree->SetBranchStatus("dm_L",1);
+  }
+  else {
+    intree->SetBranchStatus("E",1);
+    intree->SetBranchStatus("w",1);
+    intree->SetBranchStatus("L",1);
+  }
 
+  // Stratified output accepts entries against the maximum weight of their
+  // energy stratum instead of the global one
+  vector<int> strata;
+  vector<double> stratum_maxW;
+  if(output_mode == "stratified") {
+    strata.assign(nEntries, -1);
+    stratum_maxW.assign((int)((maxE-(mX+mV))/stratum_width)+1, 0.);
+  }
 
   double maxW = 0.;
-  for(int i = 0; i < intree->GetEntries(); ++i) {
+  double sumW = 0.;
+  for(long i = 0; i < nEntries; ++i) {
     intree->GetEntry(i);
     if(ene <= mX+mV) continue;
-    double thisW = impwt * xsec->Eval(ene) * len;
+    double thisW = impwt * xsec_table.Eval(ene) * len;
+    weights[i] = thisW;
     if(maxW < thisW) {
       maxW = thisW;
     }
+    sumW += thisW;
+    if(!strata.empty()) {
+      const int k = std::min((int)((ene-(mX+mV))/stratum_width), (int)stratum_maxW.size()-1);
+      strata[i] = k;
+      stratum_maxW[k] = std::max(stratum_maxW[k], thisW);
+    }
+    if(energy_foam) {
+      const int b = spectrum->GetXaxis()->FindFixBin(ene);
+      spectrum->Fill(ene, impwt * len);
+      bin_entries[b].push_back(i);
+      bin_cumw[b].push_back((bin_cumw[b].empty() ? 0. : bin_cumw[b].back()) + thisW);
+    }
   }
+  intree->SetBranchStatus("*",1);
 
   for(int i = 0; i < pot_tree->GetEntries(); i++){
     pot_tree->GetEntry(i);
-    cout << "Partial POT" << tot_pot << endl;
+    logs(kLogDebug) << "Partial POT" << tot_pot << endl;
     pot_final += tot_pot; 
 
   }
 
   const double invGeV2_to_mb = 0.3894; // convert xsec in GeV^-2 to mb
-  cout << "Max w represents " << maxW*invGeV2_to_mb << " mb*m" << endl;
+  logs(kLogProgress) << "Max w represents " << maxW*invGeV2_to_mb << " mb*m" << endl;
   const double density = 1.396; // g/cm3
   const double molar_mass = 40.; // g/mol
   const double avogadro = 6.022e23;
   const double mbm_to_cm3 = 1e-27 * 100.; // convert mb*m to cm3;
   const double interaction_weight = (maxW*invGeV2_to_mb*mbm_to_cm3)*density*avogadro/molar_mass;
-  cout << "1 tree entry represents " << interaction_weight << " interactions" << endl;
+  logs(kLogProgress) << "1 tree entry represents " << interaction_weight << " interactions" << endl;
+  if(output_mode != "unweighted") {
+    logs(kLogProgress) << "Output mode " << output_mode << ": each entry represents event_norm times as many" << endl;
+  }
   // translation and rotation from beamline coordinate system
   // to detector coordinate system
   const TVector3 det_centre(55.02, 72.59,  672.70);
@@ -682,9 +1670,29 @@ int main(int argc, char** argv)
 
   _vdecay = new TGenPhaseSpace;
 
+  foam_cache.SetMaxMemory(maxmem);
+  foam_cache.SetSeed(seed+2);
+  if(!foam_cache.OpenLibrary(libfile) || !foam_cache.OpenDisk(cachedir, worker >= 0)) {
+    return -1;
+  }
+
+  TFoam *efoam = 0;
+  if(energy_foam) {
+    if(spectrum->Integral() <= 0.) {
+      cerr << "No input entries above threshold" << endl;
+      return -1;
+    }
+    spectrum->Scale(spectrum->GetNbinsX()/spectrum->Integral());
+    TStopwatch sw;
+    TRandom *efoam_ran = new TRandom3();
+    efoam = init_energy_foam(spectrum, efoam_ran);
+    efoam_ran->SetSeed(seed+3);
+    logs(kLogProgress) << "Energy-dimension foam initialized in " << sw.RealTime() << " s" << endl;
+  }
+
   int ievt = 0;
   
-  // hepevt output moved to external function 
+  // hepevt output is streamed by THepevtWriter
 
   TRandom3 *r = new TRandom3(seed);
   TRandom3 *r_timing = new TRandom3(seed+1);
@@ -700,6 +1708,8 @@ int main(int argc, char** argv)
   TLorentzVector inX_pr, vV_pr, outE_pr, outP_pr, intpos_pr, out_Ar;
   Int_t org_id;
   Double_t out_q2, weight, out_pot;
+  // interactions represented by an event, in units of the tree weight
+  Double_t event_norm = 1.;
   std::string *name_out = 0;
 
 
@@ -724,68 +1734,131 @@ int main(int argc, char** argv)
     ot->Branch("q2",&out_q2);
     ot->Branch("origin_name", &name_out);
     ot->Branch("total_pot",&out_pot);
+    ot->Branch("event_norm",&event_norm);
   }
 
-  cout << "output file name: " << outf << endl; 
-  for(int i = 0; i < intree->GetEntries(); ++i) {
-    intree->GetEntry(i);
-    if(ene <= mX+mV) continue;
-    double thisW = impwt * xsec->Eval(ene) * len;
-    if(r->Uniform() < thisW/maxW) {
-      TVector3 xmom(px,py,pz);
+  // The hepevt file is written while generating, so the POT per event uses
+  // the expected number of events of the input instead of the final count.
+  // Unweighted outputs keep the POT per generated event: it is written as a
+  // fixed width placeholder and set at the end (by the parent for parallel
+  // workers, while merging).
+  pot_per_event = pot_final/(sumW/maxW)/interaction_weight;
+  const bool weighted_output = output_mode != "unweighted" || engine_name == "weighted";
+  THepevtWriter hepevt;
+  hepevt.SetWithNorm(weighted_output);
+  hepevt.SetPotPlaceholder(!weighted_output && worker < 0);
+  if(!hepevt.Open(outf, compression)) {
+    return -1;
+  }
+
+  logs(kLogProgress) << "output file name: " << outf << endl; 
+  // In energy-dimension mode the number of events is drawn around the expected
+  // number of accepted entries, each foam event is attached to an input entry
+  // of its energy bin picked with probability proportional to its weight.
+  // Parallel workers take contiguous entry ranges, so merging in worker order
+  // keeps the event order of a serial run.
+  long first = 0, last = nEntries;
+  if(energy_foam) {
+    last = r->Poisson(sumW/maxW/nworkers);
+  }
+  else if(worker >= 0) {
+    first = nEntries*worker/nworkers;
+    last = nEntries*(worker+1)/nworkers;
+  }
+  const long report_every = std::max(1L, (last-first)/10);
+  TStopwatch genTime;
+  for(long i = first; i < last; ++i) {
+    if(verbosity >= kLogProgress && i > first && (i-first)%report_every == 0) {
+      const double elapsed = genTime.RealTime();
+      genTime.Continue();
+      cout << "Processed " << i-first << "/" << last-first << " entries, " << ievt << " events (acceptance "
+           << double(ievt)/(i-first) << "), " << ievt/elapsed << " events/s" << endl;
+    }
+    double thisW;
+    if(energy_foam) {
+      efoam->MakeEvent();
+      const int b = spectrum->GetXaxis()->FindFixBin(pb[1].E());
+      const vector<double>& cumw = bin_cumw[b];
+      if(cumw.empty()) continue;
+      const size_t k = upper_bound(cumw.begin(), cumw.end(), r->Uniform()*cumw.back()) - cumw.begin();
+      const int entry = bin_entries[b][std::min(k, cumw.size()-1)];
+      intree->GetEntry(entry);
+      thisW = weights[entry];
+    }
+    else {
+      thisW = weights[i];
+      if(thisW < 0.) continue;
+      event_norm = 1.;
+      if(output_mode == "weighted") {
+        if(thisW <= 0.) continue;
+        event_norm = thisW/maxW;
+      }
+      else if(output_mode == "stratified") {
+        const double wmax = stratum_maxW[strata[i]];
+        if(wmax <= 0. || r->Uniform() >= thisW/wmax) continue;
+        event_norm = wmax/maxW;
+      }
+      else if(r->Uniform() >= thisW/maxW) continue;
+      intree->GetEntry(i);
+      event_norm *= get_engine(ene)->MakeEvent();
+    }
+    TVector3 xmom(px,py,pz);
+    if(verbosity >= kLogDebug) {
       cout << "Len and L1: " << len << " " << L1 << endl;
       cout << "Origin: " << vx << " " << vy << " " << vz << endl;
       cout << "Momentum before scattering: " << px << " " << py << " " << pz << " " << ene << endl;
       cout << "Total POT: " << pot_final << endl; 
       cout << "\n" << endl;
-      double lpos = r->Uniform() * len + L1;
-      TVector3 orig(vx,vy,vz);
-      const TVector3& dir = xmom.Unit();
-      TVector3 vtx = orig + lpos * dir;
-      TLorentzVector dgam, epos, eneg;
-      TLorentzVector dgam_pr, epos_pr, eneg_pr, vX_pr, vertex_pr;
-      generate_interaction(ene, xmom, dgam, epos, eneg, cachedir);
-
-      cout <<"Transferred momentum to Ar q2: " << q2_out << endl;
-
-      vt *= 1e9; // time is in s, needs to be in ns
-
-      if(root_option) {
-        TLorentzVector vX(xmom.X(),xmom.Y(),xmom.Z(),ene);
-        TLorentzVector vertex(vtx.X(),vtx.Y(),vtx.Z(),vt);
-        vertex_pr = vertex;
-
-        // Stuff for outgoing 4-momentum scattering
-        out_Ar = pf[2];
-        inX_pr = pf[1];
-
-        dgam_pr = dgam;
-        epos_pr = epos;
-        eneg_pr = eneg;
-      }
-      // transform all vectors into detector coordinate system
-      vtx -= det_centre;
-      orig -= det_centre;
-      vtx *= det_rot;
-      orig *= det_rot;
-      const double cm = 100.; // cm per m
-      const double c = 0.299792; // m per ns
-      const TVector3 Vbeam(0,0,-4.); 
-      const double t0 = (det_centre-Vbeam).Mag() / c; 
-      double ivt = vt + lpos / ( xmom.Mag()/ene * c) - t0;
-
-      const double beam_time = 4687.5 + r_timing->Uniform() * 9600.;
-      ivt += beam_time;
-      
-      xmom *= det_rot;
-      dgam *= det_rot;
-      epos *= det_rot;
-      eneg *= det_rot;
-
-      // out
-      out_Ar *= det_rot;
-      inX_pr *= det_rot;
-      
+    }
+    double lpos = r->Uniform() * len + L1;
+    TVector3 orig(vx,vy,vz);
+    const TVector3& dir = xmom.Unit();
+    TVector3 vtx = orig + lpos * dir;
+    TLorentzVector dgam, epos, eneg;
+    TLorentzVector dgam_pr, epos_pr, eneg_pr, vX_pr, vertex_pr;
+    generate_interaction(xmom, dgam, epos, eneg);
+
+    if(verbosity >= kLogDebug) cout <<"Transferred momentum to Ar q2: " << q2_out << endl;
+
+    vt *= 1e9; // time is in s, needs to be in ns
+
+    if(root_option) {
+      TLorentzVector vX(xmom.X(),xmom.Y(),xmom.Z(),ene);
+      TLorentzVector vertex(vtx.X(),vtx.Y(),vtx.Z(),vt);
+      vertex_pr = vertex;
+
+      // Stuff for outgoing 4-momentum scattering
+      out_Ar = pf[2];
+      inX_pr = pf[1];
+
+      dgam_pr = dgam;
+      epos_pr = epos;
+      eneg_pr = eneg;
+    }
+    // transform all vectors into detector coordinate system
+    vtx -= det_centre;
+    orig -= det_centre;
+    vtx *= det_rot;
+    orig *= det_rot;
+    const double cm = 100.; // cm per m
+    const double c = 0.299792; // m per ns
+    const TVector3 Vbeam(0,0,-4.); 
+    const double t0 = (det_centre-Vbeam).Mag() / c; 
+    double ivt = vt + lpos / ( xmom.Mag()/ene * c) - t0;
+
+    const double beam_time = 4687.5 + r_timing->Uniform() * 9600.;
+    ivt += beam_time;
+    
+    xmom *= det_rot;
+    dgam *= det_rot;
+    epos *= det_rot;
+    eneg *= det_rot;
+
+    // out
+    out_Ar *= det_rot;
+    inX_pr *= det_rot;
+    
+    if(verbosity >= kLogDebug) {
       cout << ievt << " " << 4 << " " << *name << " " << origin_id << endl;
        //    status      pdg         mother1     mother2     daugher1  daughter2
       cout << 2 << " " << 41 << " " << 0 << " " << 0 << " " << 2 <<" "<< 2 << " "
@@ -801,42 +1874,52 @@ int main(int argc, char** argv)
 		 << eneg.X() <<" " << eneg.Y() << " " << eneg.Z() <<" " <<eneg.E() <<" "<< eneg.M()  <<" "
 		 << vtx.X() * cm << " " << vtx.Y() * cm << " " << vtx.Z() * cm << " " << ivt <<endl;
 
-     cout << "\n" << endl;
+      cout << "\n" << endl;
+    }
 
-     ievt++;
+   hepevt.Write(ievt, *name, origin_id, pot_per_event, q2_out, event_norm, TLorentzVector(xmom, ene),
+                TLorentzVector(orig, vt), dgam, epos, eneg, TLorentzVector(vtx, ivt));
+   ievt++;
 
-    if(root_option) {
-        TLorentzVector vX(xmom.X(),xmom.Y(),xmom.Z(),ene);
-        TLorentzVector O(orig.X(),orig.Y(),orig.Z(), vt);
-        TLorentzVector vertex(vtx.X(),vtx.Y(),vtx.Z(),ivt);
-        origin = O; 
-        weight = thisW; 
-        intpos = vertex;
-        inX = vX;
-        vV = dgam;
-        outE = eneg;
-        outP = epos;
-        intpos_pr = vertex_pr;
-        //inX_pr = vX_pr;
-        vV_pr = dgam_pr;
-        outE_pr = eneg_pr;
-        outP_pr = epos_pr;
-        name_out = name; 
-        out_q2 = q2_out;
-        org_id = origin_id;
-        out_pot = pot_final; 
-        ot->Fill();
-      }
+  if(root_option) {
+      TLorentzVector vX(xmom.X(),xmom.Y(),xmom.Z(),ene);
+      TLorentzVector O(orig.X(),orig.Y(),orig.Z(), vt);
+      TLorentzVector vertex(vtx.X(),vtx.Y(),vtx.Z(),ivt);
+      origin = O; 
+      weight = thisW; 
+      intpos = vertex;
+      inX = vX;
+      vV = dgam;
+      outE = eneg;
+      outP = epos;
+      intpos_pr = vertex_pr;
+      //inX_pr = vX_pr;
+      vV_pr = dgam_pr;
+      outE_pr = eneg_pr;
+      outP_pr = epos_pr;
+      name_out = name; 
+      out_q2 = q2_out;
+      org_id = origin_id;
+      out_pot = pot_final; 
+      ot->Fill();
     }
   }
+  genTime.Stop();
 
 
    if(root_option) {
     of->cd();
-    cout << "Final number of events: " << ievt << endl;
-    DumpHepevt(ot, outf);
+    logs(kLogProgress) << "Final number of events: " << ievt << endl;
+    logs(kLogProgress) << "Generation took " << genTime.RealTime() << " s (" << ievt/genTime.RealTime() << " events/s)" << endl;
+    foam_cache.Report();
+    foam_cache.Close();
+    engine_stats.Report();
+    hepevt.Close();
     ot->Write();
     of->Close();
+    if(ievt > 0 && !hepevt.SetPot(pot_final/ievt/interaction_weight)) {
+      return -1;
+    }
   }
   
 
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+##################################################
+# Wall time cost model of the grid jobs
+#
+# dark_tridents_job.sh ends its log with a DARKTRIDENT_METRICS line giving
+# the point, the number of events and the seconds spent in setup, BdNMC and
+# evgen. This script collects those lines from job logs into a model file:
+#
+#   python grid/cost_model.py -o grid/cost_model.json /pnfs/.../run_400/
+#
+# Each log is counted once, so the same directories can be read again as new
+# jobs finish. jobsub_dark_tridents.py --cost_model grid/cost_model.json then
+# splits the requested events (nevts x n_jobs) of each point into jobs that
+# fit --target_walltime, and sets --expected-lifetime from the prediction.
+##################################################
+import os, optparse, sys, json, math, io
+
+
+METRICS_TAG = "DARKTRIDENT_METRICS"
+# --expected-lifetime is the predicted job time times this factor
+LIFETIME_SAFETY = 1.5
+
+
+def point_key(mA, ratio, decay_channel, dm_type):
+    return "{:.3f} {:.2f} {} {}".format(float(mA), float(ratio), decay_channel, dm_type)
+
+def read_metrics(filename):
+    # the last metrics line of a log, None for logs of jobs that did not get to the end
+    record = None
+    for line in io.open(filename, errors="replace"):
+      if line.startswith(METRICS_TAG):
+        record = dict(f.split("=", 1) for f in line.split()[1:] if "=" in f)
+    return record
+
+def collect(paths, model):
+    """
+    Adds the metrics of the logs in paths (files, or directories searched
+    recursively for *.log) to model, keyed by log path. Returns the number of
+    logs added.
+    """
+    logs = []
+    for path in paths:
+      if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+          logs += [os.path.join(root, f) for f in files if f.endswith(".log")]
+      else:
+        logs.append(path)
+
+    added = 0
+    for log in logs:
+      log = os.path.abspath(log)
+      if log in model["jobs"]:
+        continue
+      record = read_metrics(log)
+      if record is None or not record.get("decay_channel") or int(record.get("nevts", 0) or 0) <= 0:
+        continue
+      model["jobs"][log] = record
+      added += 1
+    return added
+
+def load(filename):
+    if os.path.isfile(filename):
+      return json.load(open(filename))
+    return {"jobs": {}}
+
+def save(model, filename):
+    with open(filename + ".tmp", "w") as f:
+      json.dump(model, f, indent=1, sort_keys=True)
+    os.rename(filename + ".tmp", filename)
+
+def rates(model):
+    """
+    Per point (point_key): the jobs, events per second of BdNMC and of evgen,
+    and the mean setup time, from all the jobs of the point.
+    """
+    totals = {}
+    for record in model["jobs"].values():
+      key = point_key(record["mA"], record["ratio"], record["decay_channel"], record["dm_type"])
+      t = totals.setdefault(key, {"jobs": 0, "events": 0, "setup_seconds": 0., "bdnmc_seconds": 0., "evgen_seconds": 0.})
+      t["jobs"] += 1
+      t["events"] += int(record["nevts"])
+      for k in ["setup_seconds", "bdnmc_seconds", "evgen_seconds"]:
+        t[k] += float(record[k])
+
+    points = {}
+    for key, t in totals.items():
+      # one second floors keep jobs that finished within the clock resolution finite
+      points[key] = {"jobs": t["jobs"],
+                     "bdnmc_rate": t["events"]/max(t["bdnmc_seconds"], 1.),
+                     "evgen_rate": t["events"]/max(t["evgen_seconds"], 1.),
+                     "setup_seconds": t["setup_seconds"]/t["jobs"]}
+    return points
+
+def predict(points, mA, ratio, decay_channel, dm_type):
+    """
+    (seconds per event, setup seconds) of a point: its own rates when it has
+    jobs, otherwise those of the nearest mass with the same ratio, channel and
+    dm_type. None when there is no such job.
+    """
+    key = point_key(mA, ratio, decay_channel, dm_type)
+    if key not in points:
+      same = [k for k in points if k.split()[1:] == key.split()[1:]]
+      if len(same) == 0:
+        return None
+      key = min(same, key = lambda k: abs(float(k.split()[0]) - float(mA)))
+    p = points[key]
+    return 1./p["bdnmc_rate"] + 1./p["evgen_rate"], p["setup_seconds"]
+
+def plan(points, mA, ratio, decay_channel, dm_type, total_events, target_seconds, max_jobs = 1000):
+    """
+    Splits total_events of a point into the fewest jobs that each fit in
+    target_seconds. Returns (n_jobs, events per job, predicted seconds per job),
+    or None when the model knows nothing of the point's channel.
+    """
+    prediction = predict(points, mA, ratio, decay_channel, dm_type)
+    if prediction is None:
+      return None
+    seconds_per_event, setup_seconds = prediction
+    budget = max(target_seconds - setup_seconds, 0.1*target_seconds)
+    n_jobs = int(math.ceil(total_events*seconds_per_event/budget))
+    n_jobs = min(max(n_jobs, 1), max_jobs, total_events)
+    nevts = int(math.ceil(float(total_events)/n_jobs))
+    return n_jobs, nevts, setup_seconds + nevts*seconds_per_event
+
+def lifetime(seconds):
+    # --expected-lifetime of jobsub, in whole hours
+    return "{}h".format(max(1, int(math.ceil(LIFETIME_SAFETY*seconds/3600.))))
+
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options] log files or directories")
+    parser.add_option('-o', '--output', default = "cost_model.json", help='Model file, updated when it exists. Default = %default.')
+
+    options, args = parser.parse_args()
+    model = load(options.output)
+    added = collect(args, model)
+    save(model, options.output)
+    print("Added {} job logs, {} in {}".format(added, len(model["jobs"]), options.output))
+
+    points = rates(model)
+    print("{:>6} {:>6} {:>10} {:>8} {:>5} {:>12} {:>12} {:>8}".format("mA", "ratio", "channel", "dm_type", "jobs", "BdNMC evt/s", "evgen evt/s", "setup s"))
+    for key in sorted(points, key = lambda k: (k.split()[1:], float(k.split()[0]))):
+      mA, ratio, channel, dm_type = key.split()
+      p = points[key]
+      print("{:>6} {:>6} {:>10} {:>8} {:>5} {:>12.3g} {:>12.3g} {:>8.0f}".format(mA, ratio, channel, dm_type, p["jobs"],
+                                                                                p["bdnmc_rate"], p["evgen_rate"], p["setup_seconds"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
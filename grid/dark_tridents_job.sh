@@ -10,7 +10,14 @@ ls
 
 echo
 echo "======== UNTARRING... ========"
-tar xvfz local_install_dark_tridents.tar.gz -C ./ > /dev/null
+# Slim payloads (jobsub_dark_tridents.py --payload slim) come as the layers listed in LAYERS
+if [ -n "$LAYERS" ]; then
+  for layer in ${LAYERS//,/ }; do
+    tar xzf $layer -C ./
+  done
+else
+  tar xvfz local_install_dark_tridents.tar.gz -C ./ > /dev/null
+fi
 
 echo
 echo "======== Done untarring. ls ========"
@@ -19,6 +26,34 @@ ls
 echo "======== SETUP G4, ROOT, ETC ========"
 source setup_evgen_grid.sh
 
+# Sweeps (jobsub_dark_tridents.py --sweep) ship the parameter files of all their
+# points with a table whose row $PROCESS gives the point and job of this process
+DESTDIR=$CONDOR_DIR_DARKTRIDENT
+if [ -n "$SWEEP" ]; then
+  echo
+  echo "======== SWEEP POINT OF PROCESS $PROCESS ========"
+  tar xvfz $SWEEP -C ./ > /dev/null
+  read _ MA RATIO DM_TYPE DECAY_CHANNEL NEVTS JOB NJOBS PARFILE SUBDIR FETCH <<< "$(awk -v p=$PROCESS '$1==p' sweep_table.txt)"
+  echo "mA=$MA RATIO=$RATIO DM_TYPE=$DM_TYPE DECAY_CHANNEL=$DECAY_CHANNEL NEVTS=$NEVTS JOB=$JOB/$NJOBS"
+  cp $PARFILE parameter_uboone_grid.dat
+  # BdNMC and the file names below use the process number within the point
+  export PROCESS=$JOB
+  DESTDIR=$CONDOR_DIR_DARKTRIDENT/$SUBDIR
+  mkdir -p $DESTDIR
+  # slim payload layers of this point only (flux, cross section)
+  if [ -n "$FETCH" ] && [ "$FETCH" != "-" ]; then
+    for layer in ${FETCH//,/ }; do
+      # plain cp for local paths when ifdh is not set up (jobsub_dark_tridents.py --backend local)
+      if command -v ifdh > /dev/null; then
+        ifdh cp $layer ./$(basename $layer)
+      else
+        cp $layer ./$(basename $layer)
+      fi
+      tar xzf $(basename $layer) -C ./
+    done
+  fi
+fi
+
 echo
 echo "======== UPDATE MACRO WITH RUN NUMBER ========"
 SEED=$((RUN+PROCESS))
@@ -26,11 +61,30 @@ OUTFILE="events_${MA}_${DM_TYPE}_${PROCESS}.dat"
 OUTROOT="events_${MA}_${DM_TYPE}_${PROCESS}.root"
 SUMFILE="summary_${MA}_${DM_TYPE}_${PROCESS}.dat"
 sed -i 's/\${seed}/'$SEED'/g' parameter_uboone_grid.dat
+sed -i 's/\${nshards}/'${NJOBS:-1}'/g' parameter_uboone_grid.dat
 sed -i 's/\${decay_type}/'$DM_TYPE'/g' parameter_uboone_grid.dat
 sed -i 's/\${outFile}/'$OUTFILE'/g' parameter_uboone_grid.dat
 sed -i 's/\${sumFile}/'$SUMFILE'/g' parameter_uboone_grid.dat
 sed -i 's/\${outroot}/'$OUTROOT'/g' parameter_uboone_grid.dat 
 
+# BdNMC pMax cache shared by the jobs of all points (PMAX_CACHE, set by jobsub_dark_tridents.py)
+# so that later jobs of a configuration skip the burn-in. BdNMC locks it while updating it when
+# the shared area is writable from here (--backend local), grid jobs work on a copy
+PMAX_FILE=""
+if [ -n "$PMAX_CACHE" ]; then
+  if [ -w "$(dirname $PMAX_CACHE)" ]; then
+    PMAX_FILE=$PMAX_CACHE
+  else
+    PMAX_FILE=pmax_cache.dat
+    ifdh cp $PMAX_CACHE ./$PMAX_FILE > /dev/null 2>&1 || rm -f $PMAX_FILE
+    touch $PMAX_FILE
+    cp $PMAX_FILE pmax_cache_fetched.dat
+  fi
+  sed -i 's|\${pmaxCache}|'$PMAX_FILE'|g' parameter_uboone_grid.dat
+else
+  sed -i '/\${pmaxCache}/d' parameter_uboone_grid.dat
+fi
+
 echo "PROCESS=$PROCESS"
 echo "SEED=$SEED"
 echo "OUTFILE=$OUTFILE"
@@ -44,7 +98,16 @@ cat parameter_uboone_grid.dat
 echo
 echo "======== EXECUTING BdNMC ========"
 echo "./BdNMC/bin/BDNMC parameter_uboone_grid.dat"
+SETUP_SECONDS=$SECONDS
 ./BdNMC/bin/BDNMC parameter_uboone_grid.dat
+BDNMC_SECONDS=$((SECONDS-SETUP_SECONDS))
+
+# copy a grown pMax cache back; the last job to do so wins, which at worst costs
+# a later job the burn-in of the entries it drops
+if [ "$PMAX_FILE" = "pmax_cache.dat" ] && ! cmp -s $PMAX_FILE pmax_cache_fetched.dat; then
+  ifdh rm $PMAX_CACHE > /dev/null 2>&1
+  ifdh cp $PMAX_FILE $PMAX_CACHE
+fi
 
 echo "======= Listing BdNMC output files ========"
 
@@ -56,15 +119,24 @@ cd ../
 
 echo
 echo "======== EXECUTING GenExLight ========"
-echo "./evgen.exe -i ./BdNMC/events_${MA}_${DM_TYPE}_${PROCESS}.root -x ./xsec/cross_section_${MA}_ratio_${RATIO}_${DM_TYPE}_fix.root -f root -t ${DM_TYPE} -o hepevt_${MA}_${DM_TYPE}_${PROCESS}"
-./evgen.exe -i ./BdNMC/events_${MA}_${DM_TYPE}_${PROCESS}.root -x ./xsec/cross_section_${MA}_ratio_${RATIO}_${DM_TYPE}_fix.root -f root -t ${DM_TYPE} -o hepevt_${MA}_${DM_TYPE}_${PROCESS} -m ${MA} -r ${RATIO} -s ${SEED}
+FOAMLIB=""
+if [ -f ./xsec/foam_library_${MA}_ratio_${RATIO}_${DM_TYPE}.root ]; then
+  FOAMLIB="-L ./xsec/foam_library_${MA}_ratio_${RATIO}_${DM_TYPE}.root"
+fi
+echo "./evgen.exe -i ./BdNMC/events_${MA}_${DM_TYPE}_${PROCESS}.root -x ./xsec/cross_section_${MA}_ratio_${RATIO}_${DM_TYPE}_fix.root -f root -t ${DM_TYPE} -o hepevt_${MA}_${DM_TYPE}_${PROCESS} ${FOAMLIB}"
+EVGEN_START=$SECONDS
+./evgen.exe -i ./BdNMC/events_${MA}_${DM_TYPE}_${PROCESS}.root -x ./xsec/cross_section_${MA}_ratio_${RATIO}_${DM_TYPE}_fix.root -f root -t ${DM_TYPE} -o hepevt_${MA}_${DM_TYPE}_${PROCESS} -m ${MA} -r ${RATIO} -s ${SEED} ${FOAMLIB}
+EVGEN_SECONDS=$((SECONDS-EVGEN_START))
+
+# Read back by grid/cost_model.py to plan the splitting of later submissions
+echo "DARKTRIDENT_METRICS mA=$MA ratio=$RATIO dm_type=$DM_TYPE decay_channel=$DECAY_CHANNEL nevts=$NEVTS setup_seconds=$SETUP_SECONDS bdnmc_seconds=$BDNMC_SECONDS evgen_seconds=$EVGEN_SECONDS"
 
 echo
-echo "Moving output to CONDOR_DIR_DARKTRIDENT"
+echo "Moving output to $DESTDIR"
 
 #mv BdNMC/Events/*.dat $CONDOR_DIR_DARKTRIDENT
-mv BdNMC/events_${MA}_${DM_TYPE}_${PROCESS}.root $CONDOR_DIR_DARKTRIDENT
+mv BdNMC/events_${MA}_${DM_TYPE}_${PROCESS}.root $DESTDIR
 
-mv hepevt_${MA}_${DM_TYPE}_${PROCESS}.root $CONDOR_DIR_DARKTRIDENT
-mv hepevt_${MA}_${DM_TYPE}_${PROCESS}.txt $CONDOR_DIR_DARKTRIDENT
+mv hepevt_${MA}_${DM_TYPE}_${PROCESS}.root $DESTDIR
+mv hepevt_${MA}_${DM_TYPE}_${PROCESS}.txt $DESTDIR
 
@@ -23,6 +23,8 @@ echo
 echo "======== UPDATE MACRO WITH CORRECT PARAMETERS ========"
 SEED=$((RUN+PROCESS))
 sed -i 's/\${seed}/'$SEED'/g' parameter_uboone_grid.dat
+# particle list shards of the run1 templates, one per job when the project sets NJOBS, else unsharded
+sed -i 's/\${nshards}/'${NJOBS:-1}'/g' parameter_uboone_grid.dat
 OUTFILE="dark_tridents_bdnmc_alD=${ALD}_mA=${MA}_${DM_TYPE}_${PROCESS}.root"
 sed -i 's/\${outroot}/'$OUTFILE'/g' parameter_uboone_grid.dat
 
@@ -2,6 +2,9 @@
 echo "Bash version ${BASH_VERSION}..."
 echo "Submitting dark trident generator jobs..." 
 
+# The same scan as a single cluster with one tarball copy, run from the top directory:
+# python grid/jobsub_dark_tridents.py --sweep grid/sweep_uboone.txt --run_number 400 --n_jobs 5 --signal_channel 06-10-2023
+
 
 dm_type="scalar"
 m_ratio=0.60
@@ -5,7 +5,13 @@
 # Made to work with parameter_uboone_template_grid.dat                                                                                                                                                                                                                                 
 # 2020.01 -- A.Navrer-Agasson                                                                                                                                                                                                                                                   
 ##################################################                                                                                                                                                                                                                              
-import os, optparse, random, shutil, tarfile, sys
+import os, optparse, random, shutil, tarfile, sys, copy
+import hashlib, json, tempfile, threading, multiprocessing
+from multiprocessing.pool import ThreadPool
+import cost_model
+# file naming of the cross sections and foam libraries, shared with xsec/build_foam_library.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "xsec"))
+from build_foam_library import mass_string, library_name
 import subprocess, string
 import time
 
@@ -32,6 +38,15 @@ LOGDIR                = "/pnfs/uboone/scratch/users/{USER}/DarkTridentGen/{DECAY
 TEMPLATE              = "/uboone/app/users/lmoralep/DM-MicroBooNE/DarkTridentGen/templates/template_parameter_uboone_root_pi0.dat"
 FILETAG               = ""
 TARFILE_NAME          = "local_install_dark_tridents.tar.gz"
+SWEEP_TARFILE_NAME    = "sweep_parameters.tar.gz"
+DIGEST_FILE           = ".tarfile_digests.json"
+PAYLOAD_MANIFEST      = "./grid/payload_manifest.txt"
+PAYLOAD_DIR           = "./payload/"
+PMAX_CACHE_NAME       = "pmax_cache.dat"
+EXPECTED_LIFETIME     = "36h"
+TARGET_WALLTIME       = 4.
+MESONS                = {"pi0_decay": ["pi0s"], "eta_decay": ["etas"], "all": ["pi0s", "etas"]}
+PNFS_AREA             = "/pnfs/uboone/scratch/users/{USER}/DarkTridentGen/".format(USER = os.getenv("USER"))
 
 
 def get_options():
@@ -46,6 +61,25 @@ def get_options():
     
     #grid_group.add_option('--pot',default = POT, type=int, help="Number of protons on target to simulate. Default = %default.")
     grid_group.add_option('--filetag', default = FILETAG)
+    grid_group.add_option('--cost_model', default = "", help = "Cost model file of grid/cost_model.py. When given, the nevts x n_jobs "
+                          "events of each point are split into jobs that fit --target_walltime, and --expected-lifetime is set from "
+                          "the predicted job time. Default = none, n_jobs jobs of nevts events.")
+    grid_group.add_option('--target_walltime', default = TARGET_WALLTIME, type=float, help = "Target wall time of a job in hours, "
+                          "with --cost_model. Default = %default.")
+    grid_group.add_option('--backend', default = "grid", type = "choice", choices = ["grid", "local"],
+                          help = "grid: submit with jobsub. local: run the same jobs in a local process pool of --local_jobs, "
+                          "with outputs, logs and caches below --local_dir instead of /pnfs. Default = %default.")
+    grid_group.add_option('--local_jobs', default = multiprocessing.cpu_count(), type=int, help = "Processes run at once with "
+                          "--backend local. Default = %default (cores of this machine).")
+    grid_group.add_option('--local_dir', default = "./local_runs/", help = "Area of the run, log and cache directories with "
+                          "--backend local. Default = %default.")
+    grid_group.add_option('--local_scratch', default = "", help = "Directory of the per-process scratch directories with "
+                          "--backend local. Default = system temporary directory.")
+    grid_group.add_option('--payload', default = "full", type = "choice", choices = ["full", "slim"],
+                          help = "full: one tarball of the local area (--make_tar). slim: only the files each job needs, "
+                          "as layers of payload_manifest.txt that are rebuilt and uploaded when they change. Default = %default.")
+    grid_group.add_option('--sweep', default = "", help = "Grid spec file of a parameter sweep (see read_sweep). All of its points are submitted as one cluster "
+                          "with one tarball copy, n_jobs processes per point. Default = single point.")
     
     #uboone_group   = optparse.OptionGroup(parser, "uBoone Options")
     
@@ -73,7 +107,7 @@ def get_options():
 
     return options
 
-def make_parfile(options):
+def make_parfile(options, macro_name = "parameter_uboone_grid.dat"):
   template_filename = options.template
   template_string   = open(template_filename, 'r').read()
   template          = string.Template(template_string)
@@ -93,29 +127,195 @@ def make_parfile(options):
       }
     )
 
-  macro_name = "parameter_uboone_grid.dat"
   macro = open(macro_name, "w") 
   macro.write(macro_string)
   macro.close()
 
   return macro_name
 
-def make_tarfile(output_filename):
+def scratch_area(options):
+    # top of the run, log and cache directories: /pnfs, or --local_dir with --backend local
+    if options.backend == "local":
+      return os.path.abspath(options.local_dir) + "/"
+    return PNFS_AREA
+
+def split_jobs(rates, options, mA, ratio, decay_channel, dm_type):
+    """
+    (n_jobs, events per job, expected lifetime) of a point. With a cost model
+    (rates of cost_model.rates) the nevts x n_jobs events are split to fit
+    options.target_walltime; without one, or when the model has no job of the
+    channel, the jobs are those requested.
+    """
+    if rates is not None:
+      split = cost_model.plan(rates, mA, ratio, decay_channel, dm_type, options.nevts*options.n_jobs, options.target_walltime*3600.)
+      if split is not None:
+        n_jobs, nevts, seconds = split
+        print("mA {} {} {}: {} jobs of {} events, {:.1f} h each".format(mA, decay_channel, dm_type, n_jobs, nevts, seconds/3600.))
+        return n_jobs, nevts, cost_model.lifetime(seconds)
+      print("mA {} {} {}: no cost model data, keeping {} jobs of {} events".format(mA, decay_channel, dm_type, options.n_jobs, options.nevts))
+    return options.n_jobs, options.nevts, EXPECTED_LIFETIME
+
+def read_sweep(filename, options):
+    """
+    Reads a sweep spec: one "key value value ..." line per swept option, # for
+    comments. The points are all the combinations of the mA, ratio, dm_type and
+    decay_channel values; keys left out take the command line value. nevts and
+    template take one value for all points or decay_channel=value pairs, e.g.
+
+      mA            0.01 0.02 0.03
+      ratio         0.6
+      dm_type       scalar
+      decay_channel pi0_decay eta_decay
+      nevts         pi0_decay=12000 eta_decay=2500
+      template      pi0_decay=../templates/template_parameter_uboone_root_pi0.dat eta_decay=../templates/template_parameter_uboone_root_eta.dat
+    """
+    spec = {}
+    for line in open(filename):
+      fields = line.split("#")[0].split()
+      if len(fields) > 1:
+        spec[fields[0]] = fields[1:]
+
+    def per_channel(key, default, convert):
+      values = spec.get(key, [str(default)])
+      pairs = dict(v.split("=", 1) for v in values if "=" in v)
+      plain = [v for v in values if "=" not in v]
+      return lambda channel: convert(pairs.get(channel, plain[0] if plain else default))
+
+    nevts    = per_channel("nevts", options.nevts, int)
+    template = per_channel("template", options.template, str)
+    points = []
+    for channel in spec.get("decay_channel", [options.decay_channel]):
+      for dm_type in spec.get("dm_type", [options.dm_type]):
+        for ratio in [float(r) for r in spec.get("ratio", [options.ratio])]:
+          for mA in [float(m) for m in spec.get("mA", [options.mA])]:
+            points.append({"mA": mA, "ratio": ratio, "dm_type": dm_type, "decay_channel": channel,
+                           "nevts": nevts(channel), "template": template(channel)})
+    return points
+
+def make_sweep_payload(points, options, output_filename, fetched = None):
+    """
+    Writes the parameter file of every point and the table that maps each grid
+    process to its point, and tars them into output_filename. Row p of
+    sweep_table.txt is: process, mA, ratio, dm_type, decay_channel, nevts, the
+    process number within the point, processes per point, parameter file,
+    output subdirectory and the comma separated payload layers the process
+    fetches itself (fetched, one entry per point, - for none).
+    """
+    files = ["sweep_table.txt"]
+    table = open("sweep_table.txt", "w")
+    process = 0
+    for i, point in enumerate(points):
+      point_options = copy.copy(options)
+      point_options.mA       = point["mA"]
+      point_options.ratio    = point["ratio"]
+      point_options.dm_type  = point["dm_type"]
+      point_options.nevts    = point["nevts"]
+      point_options.template = point["template"]
+      parfile = make_parfile(point_options, "parameter_sweep_{}.dat".format(i))
+      files.append(parfile)
+      mA = mass_string(point["mA"], point["ratio"])
+      ratio = "{:.2f}".format(point["ratio"])
+      subdir = "{}/{}/{}/ratio_{}".format(mA, point["decay_channel"], point["dm_type"], ratio)
+      for job in range(point["n_jobs"]):
+        table.write("{} {} {} {} {} {} {} {} {} {} {}\n".format(process, mA, ratio, point["dm_type"], point["decay_channel"],
+                                                               point["nevts"], job, point["n_jobs"], parfile, subdir,
+                                                               fetched[i] if fetched else "-"))
+        process += 1
+    table.close()
 
+    tar = tarfile.open(output_filename, "w:gz")
+    for f in files:
+      tar.add(f)
+      os.remove(f)
+    tar.close()
+    return process
+
+def submit_sweep(options):
+    points = read_sweep(options.sweep, options)
+    rates = cost_model.rates(cost_model.load(options.cost_model)) if options.cost_model else None
+    lifetimes = []
+    for point in points:
+      point_options = copy.copy(options)
+      point_options.nevts = point["nevts"]
+      point["n_jobs"], point["nevts"], lifetime = split_jobs(rates, point_options, point["mA"], point["ratio"],
+                                                             point["decay_channel"], point["dm_type"])
+      lifetimes.append(lifetime)
+    # one lifetime for the whole cluster, that of the longest point
+    lifetime = max(lifetimes, key = lambda l: int(l[:-1]))
+    print("\nSweep of {} points, {} processes".format(len(points), sum(p["n_jobs"] for p in points)))
+
+    # Outputs land in {mA}/{decay_channel}/{dm_type}/ratio_{ratio} below the run directory
+    RUNDIR = "{AREA}run_{RUN_NUMBER}/{sig}/".format(AREA = scratch_area(options), RUN_NUMBER = options.run_number, sig = options.signal_channel)
+    LOGDIR = RUNDIR + "sweep_log/"
+    CACHE_PNFS_AREA = RUNDIR + "CACHE/"
+    for d in [RUNDIR, LOGDIR, CACHE_PNFS_AREA]:
+      if os.path.isdir(d) == False:
+        print(d, " directory doen't exist, so creating...\n")
+        os.makedirs(d)
+
+    cache_folder = CACHE_PNFS_AREA + str(random.randint(10000,99999)) + "/"
+    os.makedirs(cache_folder)
+
+    if options.payload == "slim":
+      # layers that every point needs are transferred with the job, the others
+      # are fetched by the processes of the points that need them
+      layers = [payload_layers(mass_string(p["mA"], p["ratio"]), p["ratio"], p["dm_type"], p["decay_channel"]) for p in points]
+      paths = make_payload(dict(kv for l in layers for kv in l.items()), scratch_area(options) + "CACHE/")
+      shared = sorted(set.intersection(*[set(l) for l in layers]))
+      tarballs = [paths[name] for name in shared]
+      fetched = [",".join(paths[name] for name in sorted(l) if name not in shared) or "-" for l in layers]
+    else:
+      if(options.make_tar):
+        print("\nTarring up local area...")
+        make_tarfile(TARFILE_NAME, tarfile_members(points[0]["mA"], points[0]["dm_type"], points[0]["ratio"],
+                                                   [(p["mA"], p["ratio"], p["dm_type"]) for p in points]))
+      tarballs = [upload_tarfile(TARFILE_NAME, scratch_area(options) + "CACHE/")]
+      fetched = None
+
+    nprocesses = make_sweep_payload(points, options, SWEEP_TARFILE_NAME, fetched)
+
+    shutil.copy(SWEEP_TARFILE_NAME,    cache_folder)
+    shutil.copy("./grid/dark_tridents_job.sh", cache_folder)
+
+    print("\nPayload:", " ".join(tarballs))
+
+    logfile = LOGDIR + "/dark_trident_sweep_{RUN}_{TIME}_\$PROCESS.log".format(RUN = options.run_number, TIME = time.strftime("%Y%m%d-%H%M%S"))
+
+    print("\nOutput logfile(s):",logfile)
+
+    env = [("RUN", options.run_number), ("ALD", options.alD), ("SWEEP", SWEEP_TARFILE_NAME)] + layers_env(options, tarballs) + pmax_cache_env(options)
+    return submit(options, env, tarballs + [cache_folder + SWEEP_TARFILE_NAME], nprocesses, RUNDIR, logfile, lifetime, cache_folder)
+
+def tarfile_members(mA, dm_type, ratio, foam_points = None):
+    """
+    The (file, name in the tarball) pairs of the local area tarball. Directories
+    are listed file by file so that every input enters the digest.
+    """
     dmodes = ["fermion","scalar"]
     ratios = [0.6, 2.0]
 
-
-    os.listdir(".")
-    tar = tarfile.open(output_filename, "w:gz")
-    #tar.add("parameter_uboone_grid.dat")
-    tar.add("./mesons/pi0s.dat", arcname="pi0s.dat")
-    tar.add("./mesons/etas.dat", arcname="etas.dat")
-    tar.add("./BdNMC/bin/BDNMC")
-    for i in os.listdir("./BdNMC/build"):
-      tar.add("BdNMC/build/"+i)
-    for i in os.listdir("./BdNMC/src"):
-      tar.add("BdNMC/src/"+i)
+    members = []
+    def add(name, arcname = None):
+      if os.path.isdir(name):
+        for root, dirs, files in os.walk(name):
+          dirs.sort()
+          for f in sorted(files):
+            members.append((os.path.join(root, f), os.path.join(root, f)))
+      else:
+        members.append((name, arcname or name))
+
+    # Binary particle lists (BdNMC/flux_to_binary.py) are used when converted,
+    # BdNMC recognizes the format by its header so the parameter files are unchanged
+    for meson in ["pi0s", "etas"]:
+      if os.path.isfile("./mesons/{}.bin".format(meson)):
+        add("./mesons/{}.bin".format(meson), "{}.dat".format(meson))
+      else:
+        add("./mesons/{}.dat".format(meson), "{}.dat".format(meson))
+    add("./BdNMC/bin/BDNMC")
+    for i in sorted(os.listdir("./BdNMC/build")):
+      add("BdNMC/build/"+i)
+    for i in sorted(os.listdir("./BdNMC/src")):
+      add("BdNMC/src/"+i)
 
     for d in dmodes:
       for ratio in ratios:
@@ -127,21 +327,248 @@ def make_tarfile(output_filename):
                       0.090, 0.095, 0.100, 0.105, 0.110, 0.115, 0.120, 0.125]
 
         for m in masses:
-          if(ratio==0.6):
-            tar.add("xsec/cross_section_{:.2f}_ratio_{:.2f}_{}_fix.root".format(m,ratio,d))
-          else:
-            tar.add("xsec/cross_section_{:.3f}_ratio_{:.2f}_{}_fix.root".format(m,ratio,d))
-    tar.add("./GenExLight/evgen.exe", arcname="evgen.exe")
-    tar.add("./grid/setup_evgen_grid.sh", arcname="setup_evgen_grid.sh")
+          add("xsec/cross_section_{}_ratio_{:.2f}_{}_fix.root".format(mass_string(m,ratio),ratio,d))
+
+    # Prebuilt foam libraries of the requested points (xsec/build_foam_library.py), optional
+    for m, r, d in (foam_points or [(mA, ratio, dm_type)]):
+      foam_library = "xsec/" + library_name(m, r, d)
+      if os.path.isfile(foam_library):
+        add(foam_library)
+    add("./GenExLight/evgen.exe", "evgen.exe")
+    add("./grid/setup_evgen_grid.sh", "setup_evgen_grid.sh")
+    return members
+
+def file_digest(name, digests):
+    # sha1 of the file content, reused from digests while its size and mtime are unchanged
+    st = os.stat(name)
+    key = "{} {} {}".format(os.path.abspath(name), st.st_size, int(st.st_mtime))
+    if key not in digests:
+      sha = hashlib.sha1()
+      with open(name, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+          sha.update(block)
+      digests[key] = sha.hexdigest()
+    return digests[key]
+
+def tarfile_digest(members):
+    """
+    Digest of a tarball built from members: the sha1 of the names and contents
+    of its inputs. Per-file digests are kept in DIGEST_FILE so that only the
+    files that changed since the last call are read again.
+    """
+    digests = {}
+    if os.path.isfile(DIGEST_FILE):
+      digests = json.load(open(DIGEST_FILE))
+    sha = hashlib.sha1()
+    for name, arcname in members:
+      sha.update("{} {}\n".format(arcname, file_digest(name, digests)).encode())
+    with open(DIGEST_FILE + ".tmp", "w") as f:
+      json.dump(digests, f, indent=0, sort_keys=True)
+    os.rename(DIGEST_FILE + ".tmp", DIGEST_FILE)
+    return sha.hexdigest()
+
+def make_tarfile(output_filename, members):
+    """
+    Tars members into output_filename unless it was already built from the same
+    inputs, and returns the digest of the inputs. The digest of the last build
+    is kept next to the tarball in output_filename.sha1.
+    """
+    digest = tarfile_digest(members)
+    if os.path.isfile(output_filename) and os.path.isfile(output_filename + ".sha1") \
+       and open(output_filename + ".sha1").read().strip() == digest:
+      print("Inputs unchanged, reusing", output_filename, digest)
+      return digest
+
+    tar = tarfile.open(output_filename + ".tmp", "w:gz")
+    for name, arcname in members:
+      tar.add(name, arcname=arcname)
     tar.close()
+    os.rename(output_filename + ".tmp", output_filename)
+    with open(output_filename + ".sha1", "w") as f:
+      f.write(digest + "\n")
+    return digest
+
+def upload_tarfile(output_filename, cache_area):
+    """
+    Copies output_filename to cache_area/<digest>/ unless a previous submission
+    already did, and returns the path of the copy. The digest is the one of
+    make_tarfile, or the sha1 of the tarball itself when it was not built here.
+    """
+    if os.path.isfile(output_filename + ".sha1"):
+      digest = open(output_filename + ".sha1").read().strip()
+    else:
+      digest = file_digest(output_filename, {})
+    cached = cache_area + digest + "/" + os.path.basename(output_filename)
+    if os.path.isfile(cached) and os.path.getsize(cached) == os.path.getsize(output_filename):
+      print("\nTarball already in cache area, not copying")
+      return cached
+    if os.path.isdir(cache_area + digest) == False:
+      os.makedirs(cache_area + digest)
+    # copied under a temporary name first, so that an interrupted copy is never reused
+    shutil.copy(output_filename, cached + ".tmp")
+    os.rename(cached + ".tmp", cached)
+    return cached
+
+
+
+def payload_layers(mA, ratio, dm_type, decay_channel, manifest = PAYLOAD_MANIFEST):
+    """
+    The slim payload of one point as {tarball name: members}, read from the
+    manifest (see payload_manifest.txt). mA is the mass string of the job
+    ($MA in dark_tridents_job.sh). The tarball of a layer is named after the
+    layer and the placeholder values its lines use, e.g. payload_flux_pi0s.tar.gz,
+    so points that need the same files share it.
+    """
+    values = {"mA": mA, "ratio": "{:.2f}".format(ratio), "dm_type": dm_type}
+    layers = {}
+    for line in open(manifest):
+      fields = line.split("#")[0].split()
+      if len(fields) < 2:
+        continue
+      layer, source = fields[0], fields[1]
+      arcname = fields[2] if len(fields) > 2 else None
+      used = [k for k in ["mA", "ratio", "dm_type", "meson"] if "{" + k + "}" in line]
+      for meson in (MESONS[decay_channel] if "meson" in used else [None]):
+        v = dict(values, meson = meson)
+        name = "_".join(["payload", layer] + [v[k] for k in used]) + ".tar.gz"
+        members = layers.setdefault(name, [])
+        found = [s.format(**v) for s in source.lstrip("?").split("|") if os.path.exists(s.format(**v))]
+        if len(found) == 0:
+          if source.startswith("?"):
+            continue
+          raise IOError("{}: no file for '{}'".format(manifest, line.strip()))
+        if os.path.isdir(found[0]):
+          for root, dirs, files in os.walk(found[0]):
+            dirs.sort()
+            for f in sorted(files):
+              members.append((os.path.join(root, f), os.path.join(root, f)))
+        else:
+          members.append((found[0], arcname.format(**v) if arcname else found[0]))
+    return dict((name, members) for name, members in layers.items() if members)
+
+def make_payload(layers, cache_area):
+    """
+    Builds the tarballs of layers (payload_layers) in PAYLOAD_DIR, only those
+    whose inputs changed, uploads the new ones to cache_area and returns
+    {tarball name: path in the cache area}.
+    """
+    if os.path.isdir(PAYLOAD_DIR) == False:
+      os.makedirs(PAYLOAD_DIR)
+    paths = {}
+    for name in sorted(layers):
+      make_tarfile(PAYLOAD_DIR + name, layers[name])
+      paths[name] = upload_tarfile(PAYLOAD_DIR + name, cache_area)
+    return paths
+
+def layers_env(options, tarballs):
+    # dark_tridents_job.sh untars the transferred layers listed in LAYERS, the full tarball otherwise
+    if options.payload == "slim":
+      return [("LAYERS", ",".join(os.path.basename(t) for t in tarballs))]
+    return []
+
+def pmax_cache_env(options):
+    # BdNMC pMax cache of dark_tridents_job.sh, one file for all the runs in the scratch area
+    return [("PMAX_CACHE", scratch_area(options) + "CACHE/" + PMAX_CACHE_NAME)]
+
+def submit(options, env, files, nprocesses, outdir, logfile, lifetime, cache_folder):
+    """
+    Runs nprocesses of the dark_tridents_job.sh in cache_folder with the
+    environment env ((name, value) pairs) and the input files: as one jobsub
+    cluster, or in a local process pool with --backend local (run_local).
+    """
+    if options.backend == "local":
+      return run_local(options, env, files, nprocesses, outdir, logfile, cache_folder + "dark_tridents_job.sh")
 
+    submit_command = ("jobsub_submit {GRID} {MEMORY} {DISK} -N {NJOBS} -d DARKTRIDENT {OUTDIR} "
+      "-G uboone "
+      "{ENV}"
+      "{FILES}"
+      "-L {LOGFILE} "
+      "file://{CACHE}/dark_tridents_job.sh".format(
+      GRID       = ("--OS=SL7 "
+                    "--resource-provides=usage_model=DEDICATED,OPPORTUNISTIC,OFFSITE "
+                    "--role=Analysis "
+                    "--expected-lifetime={} ".format(lifetime)),
+      DISK       = "--disk 4GB",
+      MEMORY     = "--memory 4GB ",
+      NJOBS      = nprocesses,
+      OUTDIR     = outdir,
+      ENV        = "".join("-e {}={} ".format(k, v) for k, v in env),
+      FILES      = "".join("-f {} ".format(f) for f in files),
+      LOGFILE    = logfile,
+      CACHE      = cache_folder)
+    )
 
+    #Ship it
+    print("\nSubmitting to grid:\n"+submit_command+"\n")
+    return subprocess.call(submit_command, shell=True)
+
+def run_local(options, env, files, nprocesses, outdir, logfile, jobscript):
+    """
+    Stands in for jobsub: runs the processes of a cluster, options.local_jobs
+    at a time. Each process runs jobscript in its own scratch directory, with
+    CONDOR_DIR_INPUT holding the input files (tarballs linked, others copied)
+    and CONDOR_DIR_DARKTRIDENT its own output directory, whose content is then
+    moved to outdir. The log of process p is logfile with $PROCESS replaced by
+    p. The scratch directories of failed processes are kept.
+    """
+    scratch = tempfile.mkdtemp(prefix = "dark_tridents_", dir = options.local_scratch or None)
+    print("\nRunning {} processes locally, {} at a time, in {}".format(nprocesses, options.local_jobs, scratch))
+    lock = threading.Lock()
+
+    def run(process):
+      workdir   = os.path.join(scratch, str(process))
+      inputdir  = os.path.join(workdir, "input")
+      outputdir = os.path.join(workdir, "output")
+      os.makedirs(inputdir)
+      os.makedirs(outputdir)
+      for f in files + [jobscript]:
+        if f.endswith(".tar.gz"):
+          os.symlink(os.path.abspath(f), os.path.join(inputdir, os.path.basename(f)))
+        else:
+          shutil.copy(f, inputdir)
+      job_env = dict(os.environ)
+      job_env.update((k, str(v)) for k, v in env)
+      job_env.update({"PROCESS": str(process), "CONDOR_DIR_INPUT": inputdir, "CONDOR_DIR_DARKTRIDENT": outputdir})
+
+      start = time.time()
+      with open(logfile.replace("\\$PROCESS", str(process)), "w") as log:
+        status = subprocess.call(["bash", os.path.join(inputdir, os.path.basename(jobscript))], env = job_env, cwd = inputdir,
+                                 stdout = log, stderr = subprocess.STDOUT)
+      with lock:
+        # sweeps write to point subdirectories, merged into those of the other processes
+        for root, dirs, names in os.walk(outputdir):
+          dest = os.path.join(outdir, os.path.relpath(root, outputdir))
+          if os.path.isdir(dest) == False:
+            os.makedirs(dest)
+          for name in names:
+            shutil.move(os.path.join(root, name), os.path.join(dest, name))
+        print("Process {} finished with status {} in {:.0f} s".format(process, status, time.time() - start))
+      if status == 0:
+        shutil.rmtree(workdir)
+      return status
+
+    start = time.time()
+    pool = ThreadPool(options.local_jobs)
+    statuses = pool.map(run, range(nprocesses), chunksize = 1)
+    pool.close()
+    failed = [p for p, s in enumerate(statuses) if s != 0]
+    print("\n{} of {} processes succeeded in {:.0f} s".format(nprocesses - len(failed), nprocesses, time.time() - start))
+    if failed:
+      print("Failed processes:", " ".join(str(p) for p in failed), "- scratch directories kept in", scratch)
+      return 1
+    os.rmdir(scratch)
+    return 0
 
 def main():
 
     print("Job submission")
 
     options       = get_options()
+    if options.sweep:
+      return submit_sweep(options)
+    rates         = cost_model.rates(cost_model.load(options.cost_model)) if options.cost_model else None
+    options.n_jobs, options.nevts, lifetime = split_jobs(rates, options, options.mA, options.ratio, options.decay_channel, options.dm_type)
     parfile       = make_parfile(options)
     MA_DIR        = options.mA
     SIGNAL        = options.signal_channel
@@ -151,7 +578,7 @@ def main():
     DM_TYPE       = options.dm_type
 
     # Create a run number directory                                                                                                                                                                                                                                               
-    RUNDIR = "/pnfs/uboone/scratch/users/{USER}/DarkTridentGen/run_{RUN_NUMBER}/{sig}/{mA}/{DECAY_CHAN}/".format( USER = os.getenv("USER"), DECAY_CHAN = decay_channel, mA = MA_DIR, RUN_NUMBER = options.run_number, sig = SIGNAL)
+    RUNDIR = "{AREA}run_{RUN_NUMBER}/{sig}/{mA}/{DECAY_CHAN}/".format( AREA = scratch_area(options), DECAY_CHAN = decay_channel, mA = MA_DIR, RUN_NUMBER = options.run_number, sig = SIGNAL)
     print(RUNDIR)
 
     if os.path.isdir(RUNDIR) == False:
@@ -159,21 +586,21 @@ def main():
         os.makedirs(RUNDIR)
 
     # Create a output file directory                                                                                                                                                                                                                                              
-    OUTDIR = "/pnfs/uboone/scratch/users/{USER}/DarkTridentGen/run_{RUN_NUMBER}/{sig}/{mA}/{DECAY_CHAN}/{dm}/files/".format( USER = os.getenv("USER"), DECAY_CHAN = decay_channel, mA = MA_DIR, RUN_NUMBER = options.run_number, sig = SIGNAL, dm=DM_TYPE)
+    OUTDIR = "{AREA}run_{RUN_NUMBER}/{sig}/{mA}/{DECAY_CHAN}/{dm}/files/".format( AREA = scratch_area(options), DECAY_CHAN = decay_channel, mA = MA_DIR, RUN_NUMBER = options.run_number, sig = SIGNAL, dm=DM_TYPE)
 
     if os.path.isdir(OUTDIR) == False:
         print(OUTDIR, " directory doen't exist, so creating...\n")
         os.makedirs(OUTDIR)
 
     # Create a log file directory                                                                                                                                                                                                                                                 
-    LOGDIR = "/pnfs/uboone/scratch/users/{USER}/DarkTridentGen/run_{RUN_NUMBER}/{sig}/{mA}/{DECAY_CHAN}/{dm}/log/".format( USER = os.getenv("USER"), DECAY_CHAN = decay_channel, mA = MA_DIR, RUN_NUMBER = options.run_number, sig = SIGNAL, dm=DM_TYPE)
+    LOGDIR = "{AREA}run_{RUN_NUMBER}/{sig}/{mA}/{DECAY_CHAN}/{dm}/log/".format( AREA = scratch_area(options), DECAY_CHAN = decay_channel, mA = MA_DIR, RUN_NUMBER = options.run_number, sig = SIGNAL, dm=DM_TYPE)
 
     if os.path.isdir(LOGDIR) == False:
         print(LOGDIR, " directory doen't exist, so creating...\n")
         os.makedirs(LOGDIR)
     
     # Create a cache file directory  
-    CACHE_PNFS_AREA = "/pnfs/uboone/scratch/users/{USER}/DarkTridentGen/run_{RUN_NUMBER}/{sig}/{mA}/{DECAY_CHAN}/{dm}/CACHE/".format(USER = os.getenv("USER"), DECAY_CHAN = decay_channel, mA = MA_DIR, RUN_NUMBER = options.run_number, sig = SIGNAL, dm=DM_TYPE)
+    CACHE_PNFS_AREA = "{AREA}run_{RUN_NUMBER}/{sig}/{mA}/{DECAY_CHAN}/{dm}/CACHE/".format(AREA = scratch_area(options), DECAY_CHAN = decay_channel, mA = MA_DIR, RUN_NUMBER = options.run_number, sig = SIGNAL, dm=DM_TYPE)
 
     if os.path.isdir(CACHE_PNFS_AREA) == False:
       print(CACHE_PNFS_AREA, " directory doen't exist, so creating...\n")
@@ -183,56 +610,29 @@ def main():
     cache_folder = CACHE_PNFS_AREA + str(random.randint(10000,99999)) + "/"
     os.makedirs(cache_folder)
 
-    if(make_tar):
-      print("\nTarring up local area...")
-      make_tarfile(TARFILE_NAME, options.mA, options.dm_type, options.ratio)  
+    if options.payload == "slim":
+      tarballs = sorted(make_payload(payload_layers(mass_string(options.mA, options.ratio), options.ratio, options.dm_type, decay_channel),
+                                         scratch_area(options) + "CACHE/").values())
+    else:
+      if(make_tar):
+        print("\nTarring up local area...")
+        make_tarfile(TARFILE_NAME, tarfile_members(options.mA, options.dm_type, options.ratio))
+      tarballs = [upload_tarfile(TARFILE_NAME, scratch_area(options) + "CACHE/")]
 
-    #always copy jobfile and tarball to cache area
+    #always copy jobfile to cache area, the tarballs only when their content is not there yet
     shutil.copy("./parameter_uboone_grid.dat",    cache_folder)
-    shutil.copy(TARFILE_NAME,    cache_folder)
     shutil.copy("./grid/dark_tridents_job.sh", cache_folder)
 
-    print("\nTarball of local area:", cache_folder + TARFILE_NAME)
+    print("\nPayload:", " ".join(tarballs))
 
     logfile = LOGDIR + "/dark_trident_{mA}_{RUN}_{TIME}_\$PROCESS.log".format(mA  = MA_DIR, RUN = options.run_number, TIME = time.strftime("%Y%m%d-%H%M%S"))
 
     print("\nOutput logfile(s):",logfile)
 
-    submit_command = ("jobsub_submit {GRID} {MEMORY} {DISK} -N {NJOBS} -d DARKTRIDENT {OUTDIR} "
-      "-G uboone "
-      "-e RUN={RUN} "
-      "-e MA={MASS:.2f} "
-      "-e RATIO={RATIO:.2f} "
-      "-e ALD={ALD} "
-      "-e DM_TYPE={DMTYPE} "
-      "-e NEVTS={NEVTS} "
-      "-f {TARFILE} "
-      "-f {PARFILE} "
-      "-L {LOGFILE} "
-      "file://{CACHE}/dark_tridents_job.sh".format(
-      GRID       = ("--OS=SL7 "
-                    "--resource-provides=usage_model=DEDICATED,OPPORTUNISTIC,OFFSITE "
-                    "--role=Analysis "
-                    "--expected-lifetime=36h "),
-      DISK       = "--disk 4GB",
-      MEMORY     = "--memory 4GB ",
-      NJOBS      = options.n_jobs,
-      OUTDIR     = OUTDIR,
-      RUN        = options.run_number,
-      MASS       = options.mA,
-      RATIO      = options.ratio,
-      ALD        = options.alD,
-      DMTYPE     = options.dm_type,
-      NEVTS      = options.nevts,
-      TARFILE    = cache_folder + TARFILE_NAME,
-      LOGFILE    = logfile,
-      PARFILE    = cache_folder + "parameter_uboone_grid.dat",
-      CACHE      = cache_folder)
-  )
-
-  #Ship it                                                                                                                                                                                                                                                                      
-    print("\nSubmitting to grid:\n"+submit_command+"\n")
-    status = subprocess.call(submit_command, shell=True)
+    env = [("RUN", options.run_number), ("MA", mass_string(options.mA, options.ratio)), ("RATIO", "{:.2f}".format(options.ratio)),
+           ("ALD", options.alD), ("DM_TYPE", options.dm_type), ("DECAY_CHANNEL", decay_channel),
+           ("NEVTS", options.nevts), ("NJOBS", options.n_jobs)] + layers_env(options, tarballs) + pmax_cache_env(options)
+    return submit(options, env, tarballs + [cache_folder + "parameter_uboone_grid.dat"], options.n_jobs, OUTDIR, logfile, lifetime, cache_folder)
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -1,23 +1,23 @@
 import os, optparse, random, shutil, tarfile, sys
 import subprocess, string
 import time
+from jobsub_dark_tridents import make_tarfile
 
-def make_tarfile(output_filename):
-    os.listdir(".")
-    tar = tarfile.open(output_filename, "w:gz")
-    tar.add("./mesons/pi0s.dat", arcname="pi0s.dat")
-    tar.add("./mesons/etas.dat", arcname="etas.dat")
-    tar.add("./mesons/rhc_pi0s.dat", arcname="rhc_pi0s.dat")
-    tar.add("./mesons/rhc_etas.dat", arcname="rhc_etas.dat")
-    tar.add("./BdNMC/bin/BDNMC")
-    for i in os.listdir("./BdNMC/build"):
-      tar.add("BdNMC/build/"+i)
-    for i in os.listdir("./BdNMC/src"):
-      tar.add("BdNMC/src/"+i)
-    for i in os.listdir("./xsec"):
-        tar.add("./xsec/"+i)
-    tar.add("./GenExLight/evgen.exe", arcname="evgen.exe")
-    tar.close()
+def tarfile_members():
+    members = []
+    members.append(("./mesons/pi0s.dat", "pi0s.dat"))
+    members.append(("./mesons/etas.dat", "etas.dat"))
+    members.append(("./mesons/rhc_pi0s.dat", "rhc_pi0s.dat"))
+    members.append(("./mesons/rhc_etas.dat", "rhc_etas.dat"))
+    members.append(("./BdNMC/bin/BDNMC", "./BdNMC/bin/BDNMC"))
+    for d in ["./BdNMC/build", "./BdNMC/src", "./xsec"]:
+      for root, dirs, files in os.walk(d):
+        dirs.sort()
+        for f in sorted(files):
+          members.append((os.path.join(root, f), os.path.join(root, f)))
+    members.append(("./GenExLight/evgen.exe", "evgen.exe"))
+    return members
 
 
-make_tarfile("dark_trident_generator_4_grid_V2.tar.gz")
\ No newline at end of file
+# rebuilt only when one of the inputs changed, see jobsub_dark_tridents.make_tarfile
+make_tarfile("dark_trident_generator_4_grid_V2.tar.gz", tarfile_members())
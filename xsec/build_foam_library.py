@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+##################################################
+# Builds the TFoam library of one (mA, ratio, dm_type) point
+# so that evgen.exe can sample from prebuilt foams (-L option)
+# instead of initializing a foam per energy bin on the grid.
+##################################################
+import os, optparse, subprocess, sys
+
+
+EVGEN    = "../GenExLight/evgen.exe"
+MA       = 0.05
+RATIO    = 0.6
+DM_TYPE  = "fermion"
+STEP     = 10
+OUTDIR   = "."
+
+
+def mass_string(mA, ratio):
+    # mA as in the cross section file names: two decimals for ratio 0.6, three otherwise
+    return "{:.2f}".format(mA) if ratio == 0.6 else "{:.3f}".format(mA)
+
+
+def library_name(mA, ratio, dm_type):
+    # Same naming as the cross section files used by dark_tridents_job.sh
+    return "foam_library_{}_ratio_{:.2f}_{}.root".format(mass_string(mA, ratio), ratio, dm_type)
+
+
+def get_options():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option('--mA', default = MA, type=float, help='Dark photon mass in GeV. Default = %default.')
+    parser.add_option('--ratio', default = RATIO, type=float, help='Dark matter to dark photon mass ratio. Default = %default.')
+    parser.add_option('--dm_type', default = DM_TYPE, help='Dark matter type (fermion or scalar). Default = %default.')
+    parser.add_option('--flux', default = "", help='BdNMC dm_dist_root output, the library covers energies up to its maximum DM energy.')
+    parser.add_option('--emax', default = -1., type=float, help='Maximum DM energy in GeV, used instead of (or to override) --flux.')
+    parser.add_option('--step', default = STEP, type=int, help='Width of the foam energy bins in MeV. Default = %default.')
+    parser.add_option('--outdir', default = OUTDIR, help='Directory to write the library to. Default = %default.')
+    parser.add_option('--evgen', default = EVGEN, help='Path to evgen.exe. Default = %default.')
+
+    options, remainder = parser.parse_args()
+
+    if options.flux == "" and options.emax <= 0:
+        parser.error("either --flux or --emax is required")
+
+    return options
+
+
+def main():
+    options = get_options()
+    libfile = os.path.join(options.outdir, library_name(options.mA, options.ratio, options.dm_type))
+
+    command = [options.evgen, "-B", "-L", libfile,
+               "-b", str(options.step),
+               "-t", options.dm_type,
+               "-m", str(options.mA),
+               "-r", str(options.ratio)]
+    if options.flux != "":
+        command += ["-i", options.flux, "-f", "root"]
+    if options.emax > 0:
+        command += ["-E", str(options.emax)]
+
+    print("Building foam library for mA = {} GeV, ratio = {}, {} DM".format(options.mA, options.ratio, options.dm_type))
+    print(" ".join(command))
+    return subprocess.call(command)
+
+
+if __name__ == "__main__":
+    sys.exit(main())